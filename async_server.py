@@ -0,0 +1,537 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import client
+import distributed_computing as dis_comp
+import wire_compression
+import staging
+import asyncio
+import concurrent.futures
+import threading
+import time
+import json
+import socket
+import io
+
+
+class AsyncConnection:
+    """ Frames messages over asyncio streams,
+    exactly like client.Connection does over a socket.
+    """
+    def __init__(self, reader, writer, buffer_size=client.RECV_BUFFER_SIZE, version=1):
+        self.reader = reader
+        self.writer = writer
+        self.buffer_size = buffer_size
+        self.version = version
+        self.length_size = client.LENGTH_SIZES[version]
+        self.heartbeat = None
+        self.codecs = {}
+        self.slots = 1
+        self.staging = False
+        self.client_inputs = []
+        self.local = False
+        self.peer_uid = None
+        self.compression_stats = wire_compression.CompressionStats()
+        # Time to wait for a message before giving up on the other end (None for ever).
+        self.timeout = None
+        # Messages written while a file is streamed (see send_file), sent after it.
+        self.held = None
+        self.file_lock = asyncio.Lock()
+
+    def close(self):
+        self.writer.close()
+
+    def set_version(self, version):
+        """ Use a given version of the protocol from now on.
+        """
+        self.version = version
+        self.length_size = client.LENGTH_SIZES[version]
+
+    async def send_hello(self, max_version=client.PROTOCOL_VERSION):
+        """ Negotiate the version of the protocol with a server.
+        return: the version chosen.
+        """
+        self.set_version(1)
+        await self.send_typed_msg(client.HELLO, json.dumps(client.client_hello(max_version)).encode())
+        (msg_type, msg_bytes) = await self.recv_typed_msg()
+        if msg_type != client.HELLO:
+            raise RuntimeError("protocol negotiation failed")
+        self.agree(json.loads(msg_bytes.decode()))
+        return self.version
+
+    async def accept_hello(self, max_version=client.PROTOCOL_VERSION, heartbeat=0, compression=None, staging=False):
+        """ Negotiate the version of the protocol, the heartbeats,
+        the compression and the staging of inputs with a client.
+        return: the version chosen.
+        """
+        self.set_version(1)
+        (msg_type, msg_bytes) = await self.recv_typed_msg()
+        if msg_type != client.HELLO:
+            raise RuntimeError("protocol negotiation failed")
+        hello = json.loads(msg_bytes.decode())
+        self.peer_uid = client.peer_uid(self.writer.get_extra_info('socket'))
+        reply = client.answer_hello(hello, max_version, heartbeat, compression, staging,
+            self.peer_uid is not None)
+        await self.send_typed_msg(client.HELLO, json.dumps(reply).encode())
+        self.agree(reply)
+        self.client_inputs = hello.get('inputs', [])
+        if self.heartbeat:
+            self.timeout = client.HEARTBEAT_MISSES * self.heartbeat
+        return self.version
+
+    def agree(self, reply):
+        """ Use what the server answered to a hello.
+        """
+        self.set_version(reply['version'])
+        self.heartbeat = reply.get('heartbeat')
+        self.codecs = {int(task_type): codec for (task_type, codec) in reply.get('compression', {}).items()}
+        self.slots = reply.get('slots', 1)
+        self.staging = reply.get('staging', False)
+        self.local = reply.get('local', False)
+
+    def write_typed_msg(self, msg_type, bytes_msg):
+        """ Queue a message with a type encoded over 1 bytes little,
+        without waiting for it to be sent.
+        """
+        msg_length = len(bytes_msg) if bytes_msg is not None else 0
+        header = msg_type.to_bytes(1, 'little') + msg_length.to_bytes(self.length_size, 'little')
+        if self.held is not None:
+            self.held.append(header + bytes_msg if msg_length > 0 else header)
+            return
+        self.writer.write(header)
+        if msg_length > 0:
+            self.writer.write(bytes_msg)
+
+    async def send_typed_msg(self, msg_type, bytes_msg):
+        """ Send a message with a type encoded over 1 bytes little.
+        """
+        self.write_typed_msg(msg_type, bytes_msg)
+        await self.writer.drain()
+
+    async def send_stream(self, bytes_msg):
+        """ Send some bytes as a stream of one chunk (or an empty stream).
+        """
+        if bytes_msg:
+            self.writer.write(len(bytes_msg).to_bytes(self.length_size, 'little'))
+            self.writer.write(bytes_msg)
+        self.writer.write((0).to_bytes(self.length_size, 'little'))
+        await self.writer.drain()
+
+    async def send_file(self, msg_type, bytes_msg, fileobj, executor):
+        """ Send a message with a type, followed by the content of a binary file
+        as a stream of sized chunks read one by one with the executor.
+        The other messages written meanwhile are held until the end of the stream,
+        and files are sent one at a time.
+        """
+        loop = asyncio.get_event_loop()
+        async with self.file_lock:
+            self.write_typed_msg(msg_type, bytes_msg)
+            self.held = []
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(executor, fileobj.read, client.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.writer.write(len(chunk).to_bytes(self.length_size, 'little'))
+                    self.writer.write(chunk)
+                    await self.writer.drain()
+                self.writer.write((0).to_bytes(self.length_size, 'little'))
+            finally:
+                (held, self.held) = (self.held, None)
+                for msg in held:
+                    self.writer.write(msg)
+            await self.writer.drain()
+
+    async def recv_msg(self, msg_length):
+        """ Receive a message of a given length.
+        """
+        try:
+            if self.timeout is None:
+                return await self.reader.readexactly(msg_length)
+            return await asyncio.wait_for(self.reader.readexactly(msg_length), self.timeout)
+        except asyncio.IncompleteReadError:
+            raise RuntimeError("socket connection broken")
+        except asyncio.TimeoutError:
+            raise RuntimeError("client not responding")
+
+    async def recv_typed_msg(self):
+        """ Receive a message with a type encoded over 1 bytes little.
+        """
+        header = await self.recv_msg(1 + self.length_size)
+        msg_length = int.from_bytes(header[1:], 'little')
+        msg_bytes = await self.recv_msg(msg_length) if msg_length > 0 else None
+        return (header[0], msg_bytes)
+
+    async def recv_stream(self, fileobj, executor, codec=None):
+        """ Receive a stream of sized chunks (terminated by an empty chunk)
+        by pieces of at most buffer_size bytes, and write them to a binary
+        file with the executor so that the event loop never blocks on disk.
+        If fileobj is None, the stream is received and discarded.
+        return: the number of bytes received.
+        """
+        if codec is not None and fileobj is not None:
+            return await self.recv_compressed_stream(fileobj, executor, codec)
+        loop = asyncio.get_event_loop()
+        total_length = 0
+        while True:
+            msg_length = int.from_bytes(await self.recv_msg(self.length_size), 'little')
+            if msg_length == 0:
+                break
+            total_length += msg_length
+            while msg_length > 0:
+                piece = await self.recv_msg(min(msg_length, self.buffer_size))
+                if fileobj is not None:
+                    await loop.run_in_executor(executor, fileobj.write, piece)
+                msg_length -= len(piece)
+        return total_length
+
+    async def recv_compressed_stream(self, fileobj, executor, codec):
+        """ Receive a stream sent by client.Connection.send_compressed_stream,
+        decompressing and writing its chunks with the executor.
+        return: the number of bytes received.
+        """
+        loop = asyncio.get_event_loop()
+        decompress = wire_compression.CODECS[codec][1]
+        def write(chunk):
+            data = memoryview(chunk)[1:]
+            cpu_time = 0.0
+            if chunk[0] == wire_compression.COMPRESSED:
+                start = wire_compression.thread_time()
+                data = decompress(data)
+                cpu_time = wire_compression.thread_time() - start
+            fileobj.write(data)
+            self.compression_stats.add(len(data), len(chunk), cpu_time)
+        total_length = 0
+        while True:
+            msg_length = int.from_bytes(await self.recv_msg(self.length_size), 'little')
+            if msg_length == 0:
+                break
+            total_length += msg_length
+            await loop.run_in_executor(executor, write, await self.recv_msg(msg_length))
+        return total_length
+
+
+class AsyncTasksServer:
+    """ A TCP server driving the connections of all clients from a single
+    event loop, speaking the same protocol as TasksThreadingTCPServer.
+    Everything that may block on disk (writing and saving results)
+    is handed to a pool of threads.
+    """
+    def __init__(self, server_address, tasks_manager, prefetch=0, adaptive_prefetch=True,
+            buffer_size=None, max_workers=None, heartbeat=0, compression=None, staging=None,
+            local_path=None):
+        self.server_address = server_address
+        # Path of a unix socket the clients on the same machine can connect through, if any.
+        self.local_path = local_path
+        self.tasks_manager = tasks_manager
+        self.prefetch = prefetch
+        self.adaptive_prefetch = adaptive_prefetch
+        self.buffer_size = buffer_size
+        self.heartbeat = heartbeat
+        self.compression = compression
+        self.compression_stats = wire_compression.CompressionStats()
+        self.staging = staging
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        # Set (from any thread) once the server listens, with its actual address.
+        self.ready = threading.Event()
+        self.loop = None
+        self.all_done = None
+        # Connections of the clients, by the tasks handling them.
+        self.handlers = {}
+        # Replaced by a new event each time the state of a task changes.
+        self.tasks_changed = None
+
+    def serve_forever(self):
+        """ Run the event loop until all tasks are done or shutdown() is called.
+        """
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    def shutdown(self):
+        """ Stop serving. May be called from any thread.
+        """
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.all_done.set)
+
+    def server_close(self):
+        self.executor.shutdown(wait=True)
+
+    async def serve(self):
+        self.all_done = asyncio.Event()
+        self.tasks_changed = asyncio.Event()
+        (host, port) = self.server_address
+        server = await asyncio.start_server(self.handle, host or None, port,
+            reuse_address=True, backlog=socket.SOMAXCONN)
+        self.server_address = server.sockets[0].getsockname()[:2]
+        local_server = None
+        if self.local_path is not None:
+            dis_comp.remove_stale_socket(self.local_path)
+            local_server = await asyncio.start_unix_server(self.handle, self.local_path, backlog=socket.SOMAXCONN)
+        self.ready.set()
+        # Wake up waiting clients when tasks are added to the tasks manager.
+        def tasks_added():
+            self.loop.call_soon_threadsafe(self.notify_tasks_changed)
+        self.tasks_manager.add_tasks_listener(tasks_added)
+        if self.tasks_manager.all_tasks_done():
+            self.all_done.set()
+        try:
+            await self.all_done.wait()
+        finally:
+            self.tasks_manager.remove_tasks_listener(tasks_added)
+            # Stop accepting clients, then close the connections of all clients
+            # and wait for their handlers to finish what they were doing.
+            server.close()
+            if local_server is not None:
+                local_server.close()
+            for connection in self.handlers.values():
+                connection.close()
+            self.notify_tasks_changed()
+            await asyncio.gather(*self.handlers, return_exceptions=True)
+            await server.wait_closed()
+            if local_server is not None:
+                await local_server.wait_closed()
+                dis_comp.remove_stale_socket(self.local_path)
+
+    async def handle(self, reader, writer):
+        """ Handle the connection of a client until all tasks are done.
+        """
+        if self.buffer_size is not None:
+            client.set_socket_buffers(writer.get_extra_info('socket'), self.buffer_size)
+        client.set_no_delay(writer.get_extra_info('socket'))
+        connection = AsyncConnection(reader, writer, self.buffer_size or client.RECV_BUFFER_SIZE)
+        connection.compression_stats = self.compression_stats
+        client_name = dis_comp.describe_client(writer.get_extra_info('peername'), writer.get_extra_info('socket'))
+        handler = asyncio.current_task()
+        self.handlers[handler] = connection
+        all_done = False
+        try:
+            await connection.accept_hello(heartbeat=self.heartbeat, compression=self.compression,
+                staging=self.staging is not None)
+            if self.prefetch > 0 or connection.slots > 1 or connection.staging:
+                window = dis_comp.PrefetchWindow.for_client(self.prefetch, self.adaptive_prefetch, connection.slots)
+                inputs = None
+                if connection.staging:
+                    inputs = staging.ClientInputs(self.staging, connection.client_inputs)
+                all_done = await self.give_batched_work(connection, window, client_name, inputs)
+            else:
+                all_done = await self.give_work(connection, client_name)
+        except (RuntimeError, OSError) as err:
+            print("Runtime Error: {}".format(err))
+        finally:
+            connection.close()
+            del self.handlers[handler]
+        if all_done:
+            self.all_done.set()
+
+    async def update(self, task_id, work_done, result, client_name=None, timings=None):
+        """ Update the tasks manager, in the executor if a result has to be saved,
+        then wake up waiting clients.
+        """
+        if result is None:
+            self.tasks_manager.update(task_id, work_done, result, client_name, timings)
+        else:
+            await self.loop.run_in_executor(self.executor, self.tasks_manager.update,
+                task_id, work_done, result, client_name, timings)
+        self.notify_tasks_changed()
+
+    def notify_tasks_changed(self):
+        self.tasks_changed.set()
+        self.tasks_changed = asyncio.Event()
+
+    async def wait_tasks_changed(self):
+        """ Wait for the state of a task to change, or for a straggler
+        to be worth looking for if speculative execution is on.
+        """
+        if not self.tasks_manager.speculating():
+            await self.tasks_changed.wait()
+            return
+        try:
+            await asyncio.wait_for(self.tasks_changed.wait(), dis_comp.SPECULATION_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+    def cancel_soon(self, connection, task_id, timed_out=False):
+        """ Tell a client to cancel a task. May be called from any thread.
+        The message is only queued, not to wait for the client
+        concurrently with its handler.
+        Clients not knowing about cancellations are disconnected
+        if the task timed out.
+        """
+        if connection.heartbeat is not None:
+            self.loop.call_soon_threadsafe(connection.write_typed_msg,
+                dis_comp.CANCEL, task_id.to_bytes(4, 'little'))
+        elif timed_out:
+            self.loop.call_soon_threadsafe(connection.close)
+
+    async def recv_result_header(self, connection):
+        """ Receive the header of a result, skipping heartbeats.
+        """
+        while True:
+            (msg_type, header) = await connection.recv_typed_msg()
+            if msg_type != client.HEARTBEAT:
+                return (msg_type, header)
+
+    async def retrieve_result(self, connection, task):
+        """ Stream the result of a task into its temporary file.
+        return: the path of the temporary file (None for a NO_OUT task, see Task.received_result).
+        """
+        if task.task_type == dis_comp.NO_OUT:
+            await connection.recv_stream(None, self.executor)
+            return None
+        temp_file = await self.loop.run_in_executor(self.executor, task.open_result_file)
+        try:
+            if connection.local and task.task_type == dis_comp.FILE_OUT:
+                # Only the path of the result file is sent (see dis_comp.send_result_path).
+                handoff = io.BytesIO()
+                await connection.recv_stream(handoff, self.executor)
+                await self.loop.run_in_executor(self.executor, temp_file.close)
+                await self.loop.run_in_executor(self.executor, dis_comp.adopt_result_file,
+                    temp_file.name, handoff.getvalue(), connection.peer_uid)
+            else:
+                await connection.recv_stream(temp_file, self.executor, connection.codecs.get(task.task_type))
+        except BaseException:
+            await self.loop.run_in_executor(self.executor, temp_file.close)
+            task.discard_result(task.received_result(temp_file))
+            raise
+        await self.loop.run_in_executor(self.executor, temp_file.close)
+        return task.received_result(temp_file)
+
+    async def give_work(self, connection, client_name=None):
+        """ Give tasks to a client (named client_name) one at a time.
+        Return True once all tasks are done.
+        """
+        # The task given to the client, to cancel it from other threads.
+        given = {'task_id': None}
+        def cancel(task_id, timed_out):
+            if task_id == given['task_id']:
+                self.cancel_soon(connection, 0, timed_out)
+        self.tasks_manager.add_cancel_listener(cancel)
+        try:
+            while True:
+                (task_id, task) = self.tasks_manager.get_next_task(block=False)
+                if task_id is None:
+                    if self.tasks_manager.all_tasks_done():
+                        return True
+                    await self.wait_tasks_changed()
+                    continue
+                given['task_id'] = task_id
+                cancelled = False
+                timings = {} if self.tasks_manager.tracer is not None else None
+                try:
+                    send_start = time.monotonic()
+                    await connection.send_typed_msg(task.task_type, str.encode(task.command))
+                    sent_time = time.monotonic()
+                    if connection.heartbeat is not None:
+                        (msg_type, header) = await self.recv_result_header(connection)
+                        if msg_type != dis_comp.TASK_RESULT:
+                            raise RuntimeError("unexpected message type {}".format(msg_type))
+                        (_, wait, duration, status) = dis_comp.unpack_result_header(header)
+                        cancelled = not dis_comp.result_done(status)
+                        if timings is not None:
+                            dis_comp.add_client_timings(timings, time.monotonic(), wait, duration)
+                    if cancelled:
+                        await connection.recv_stream(None, self.executor)
+                        result = None
+                    else:
+                        upload_start = time.monotonic()
+                        result = await self.retrieve_result(connection, task)
+                        if timings is not None:
+                            timings['send'] = (send_start, sent_time)
+                            timings.setdefault('execute', (sent_time, upload_start))
+                            timings['upload'] = (upload_start, time.monotonic())
+                except BaseException:
+                    await self.update(task_id, False, None)
+                    raise
+                finally:
+                    given['task_id'] = None
+                await self.update(task_id, not cancelled, result, client_name, timings)
+        finally:
+            self.tasks_manager.remove_cancel_listener(cancel)
+
+    async def send_inputs(self, connection, inputs, hashes):
+        """ Send to a client the input files it asked for (by their hashes),
+        streamed by chunks read with the executor (see AsyncConnection.send_file).
+        The ones which cannot be read are answered with INPUT_MISSING,
+        for the tasks reading them to fail.
+        """
+        try:
+            for file_hash in hashes:
+                try:
+                    f = await self.loop.run_in_executor(self.executor, open, inputs.server_inputs.path(file_hash), 'rb')
+                except (OSError, KeyError) as err:
+                    print("Cannot send input {}: {}".format(file_hash, err))
+                    await connection.send_typed_msg(dis_comp.INPUT_MISSING, file_hash.encode())
+                    continue
+                try:
+                    await connection.send_file(dis_comp.INPUT_DATA, file_hash.encode(), f, self.executor)
+                finally:
+                    await self.loop.run_in_executor(self.executor, f.close)
+                inputs.sent(file_hash)
+        except (RuntimeError, OSError) as err:
+            # The stream may be cut in the middle.
+            print("Runtime Error: {}".format(err))
+            connection.close()
+
+    async def give_batched_work(self, connection, window, client_name=None, inputs=None):
+        """ Keep up to window.size tasks in flight on a client (named client_name),
+        sending them in batches and retrieving results as they finish.
+        If inputs is given (a staging.ClientInputs), the inputs of tasks
+        are sent with them, and the files the client asks for are sent
+        by other tasks of the event loop.
+        Return True once all tasks are done.
+        """
+        session = dis_comp.ClientSession(self.tasks_manager, window,
+            lambda task_id: self.cancel_soon(connection, task_id), inputs)
+        # Input files being sent.
+        sending = set()
+        try:
+            while True:
+                batch = session.next_batch(block=False)
+                if batch:
+                    if inputs is None:
+                        batch_msg = dis_comp.pack_tasks_batch(batch)
+                    else:
+                        # Inputs may have to be read to be hashed.
+                        batch_msg = await self.loop.run_in_executor(self.executor, dis_comp.pack_tasks_batch, batch, inputs)
+                    await connection.send_typed_msg(dis_comp.TASKS_BATCH, batch_msg)
+                    session.batch_sent(batch)
+                if not session.in_flight:
+                    if self.tasks_manager.all_tasks_done():
+                        return True
+                    await self.wait_tasks_changed()
+                    continue
+                (msg_type, header) = await self.recv_result_header(connection)
+                if msg_type == dis_comp.FETCH_INPUTS and inputs is not None:
+                    fetch = self.loop.create_task(self.send_inputs(connection, inputs, json.loads(header.decode())))
+                    sending.add(fetch)
+                    fetch.add_done_callback(sending.discard)
+                    continue
+                (task_id, task, cancelled, timings) = session.result_received(msg_type, header)
+                if cancelled:
+                    await connection.recv_stream(None, self.executor)
+                    await self.update(task_id, False, None)
+                    continue
+                try:
+                    upload_start = time.monotonic()
+                    result = await self.retrieve_result(connection, task)
+                except BaseException:
+                    await self.update(task_id, False, None)
+                    raise
+                if timings is not None:
+                    timings['upload'] = (upload_start, time.monotonic())
+                await self.update(task_id, True, result, client_name, timings)
+        finally:
+            for fetch in list(sending):
+                fetch.cancel()
+            if session.in_flight:
+                await self.loop.run_in_executor(self.executor, session.give_back)
+                self.notify_tasks_changed()
+            else:
+                session.give_back()
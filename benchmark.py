@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import distributed_computing as dis_comp
+import async_server
+import client
+import start_computing_server
+import scheduling
+import tasks_file
+import tracing
+import argparse
+import asyncio
+import contextlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+def bench_dispatch(args):
+    """ Measure the cost of giving a task and getting it back done
+    through the tasks manager, for growing numbers of tasks.
+    The cost per task should stay flat whatever the number of tasks.
+    """
+    print("{:>10} {:>12} {:>14}".format("tasks", "total (s)", "per task (us)"))
+    for tasks_number in args.sizes:
+        tasks_list = [dis_comp.Task("true", None, dis_comp.NO_OUT)] * tasks_number
+        tasks_manager = dis_comp.TasksManager(tasks_list, show_progress=False)
+        start = time.perf_counter()
+        while True:
+            (task_id, _) = tasks_manager.get_next_task(block=False)
+            if task_id is None:
+                break
+            tasks_manager.update(task_id, True, None)
+        elapsed = time.perf_counter() - start
+        assert tasks_manager.all_tasks_done()
+        print("{:>10} {:>12.3f} {:>14.3f}".format(tasks_number, elapsed, elapsed / tasks_number * 1e6))
+
+
+def legacy_send_msg(sock, bytes_msg):
+    """ Framing layer before the Connection class, for comparison.
+    """
+    bytes_sent = 0
+    msg_length = len(bytes_msg)
+    while bytes_sent < msg_length:
+        sent = sock.send(bytes_msg[bytes_sent:])
+        if sent == 0:
+            raise RuntimeError("socket connection broken")
+        bytes_sent = bytes_sent + sent
+    return bytes_sent
+
+def legacy_send_typed_msg(sock, msg_type, bytes_msg):
+    legacy_send_msg(sock, msg_type.to_bytes(1, 'little'))
+    legacy_send_msg(sock, len(bytes_msg).to_bytes(4, 'little'))
+    legacy_send_msg(sock, bytes_msg)
+
+def legacy_recv_msg(sock, msg_length, max_chunk_length=2048):
+    chunks = []
+    bytes_recvd = 0
+    while bytes_recvd < msg_length:
+        chunk = sock.recv(min(msg_length-bytes_recvd, max_chunk_length))
+        if chunk == b'':
+            raise RuntimeError("socket connection broken")
+        chunks.append(chunk)
+        bytes_recvd = bytes_recvd + len(chunk)
+    return b''.join(chunks)
+
+def legacy_recv_typed_msg(sock):
+    msg_type = int.from_bytes(legacy_recv_msg(sock, 1), 'little')
+    msg_length = int.from_bytes(legacy_recv_msg(sock, 4), 'little')
+    return (msg_type, legacy_recv_msg(sock, msg_length))
+
+def socket_pair():
+    """ Return two TCP sockets connected through the loopback interface.
+    """
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(1)
+    sender = socket.create_connection(listener.getsockname())
+    (receiver, _) = listener.accept()
+    listener.close()
+    return (sender, receiver)
+
+def measure_throughput(send, recv, msg_size, total_size):
+    """ Send messages of msg_size bytes from a thread, for a total of
+    about total_size bytes, and return the throughput in MB/s.
+    """
+    msg = bytes(msg_size)
+    msgs_number = max(1, total_size // msg_size)
+    sender = threading.Thread(target=lambda: [send(msg) for _ in range(msgs_number)])
+    start = time.perf_counter()
+    sender.start()
+    for _ in range(msgs_number):
+        recv()
+    elapsed = time.perf_counter() - start
+    sender.join()
+    return msgs_number * msg_size / elapsed / 1e6
+
+def bench_framing(args):
+    """ Compare the throughput of typed messages through the loopback interface
+    with the previous framing layer and with client.Connection.
+    """
+    print("{:>12} {:>16} {:>16}".format("msg size", "legacy (MB/s)", "current (MB/s)"))
+    for msg_size in args.sizes:
+        (sender, receiver) = socket_pair()
+        legacy = measure_throughput(
+            lambda msg: legacy_send_typed_msg(sender, 0, msg),
+            lambda: legacy_recv_typed_msg(receiver),
+            msg_size, args.total)
+        sender.close(); receiver.close()
+        (sender, receiver) = socket_pair()
+        sending = client.Connection(sender, version=client.PROTOCOL_VERSION)
+        receiving = client.Connection(receiver, version=client.PROTOCOL_VERSION)
+        current = measure_throughput(
+            lambda msg: sending.send_typed_msg(0, msg),
+            receiving.recv_typed_msg,
+            msg_size, args.total)
+        sender.close(); receiver.close()
+        print("{:>12} {:>16.1f} {:>16.1f}".format(msg_size, legacy, current))
+
+
+async def fake_client(address):
+    """ A client answering every task immediately with an empty result.
+    """
+    try:
+        (reader, writer) = await asyncio.open_connection(*address)
+    except OSError:
+        # Too late, all tasks are already done.
+        return
+    connection = async_server.AsyncConnection(reader, writer)
+    try:
+        await connection.send_hello()
+        while True:
+            (msg_type, msg_bytes) = await connection.recv_typed_msg()
+            for (task_id, _) in dis_comp.unpack_tasks_batch(msg_bytes):
+                await connection.send_typed_msg(dis_comp.TASK_RESULT, dis_comp.pack_result_header(task_id, 0, 0))
+                await connection.send_stream(None)
+    except (RuntimeError, OSError):
+        pass
+    connection.close()
+
+async def fake_clients(address, clients_number):
+    await asyncio.gather(*[fake_client(address) for _ in range(clients_number)])
+
+def run_fake_clients(address, clients_number):
+    """ Run fake clients in their own event loop (in a separate process,
+    not to compete with the server for the interpreter lock).
+    """
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(fake_clients(address, clients_number))
+    loop.close()
+
+def start_server(engine, tasks_manager, prefetch):
+    """ Start a server of the given engine in a thread on an ephemeral port.
+    return: the server and its thread.
+    """
+    if engine == 'asyncio':
+        server = async_server.AsyncTasksServer(('localhost', 0), tasks_manager, prefetch)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        server.ready.wait()
+    else:
+        server = dis_comp.TasksThreadingTCPServer(('localhost', 0), tasks_manager, prefetch)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+    return (server, thread)
+
+def bench_load(args):
+    """ Measure the dispatch throughput (tasks/s) of each server engine
+    for growing numbers of connected clients answering instantly.
+    """
+    print("{:>8} {:>12} {:>12} {:>10}".format("engine", "clients", "tasks/s", "time (s)"))
+    for engine in args.engines:
+        for clients_number in args.clients:
+            tasks_list = [dis_comp.Task("true", None, dis_comp.NO_OUT)] * args.tasks
+            tasks_manager = dis_comp.TasksManager(tasks_list, show_progress=False)
+            (server, thread) = start_server(engine, tasks_manager, args.prefetch)
+            address = server.server_address[:2]
+            clients = multiprocessing.Process(target=run_fake_clients, args=(address, clients_number))
+            start = time.perf_counter()
+            clients.start()
+            tasks_manager.wait_all_tasks_done()
+            elapsed = time.perf_counter() - start
+            # Closing the server disconnects the clients.
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            clients.join()
+            print("{:>8} {:>12} {:>12.0f} {:>10.3f}".format(engine, clients_number, args.tasks / elapsed, elapsed))
+
+
+def write_tasks_files(directory, tasks_number):
+    """ Write a tasks file and a results file of tasks_number lines.
+    return: their paths.
+    """
+    tasks_path = os.path.join(directory, 'tasks.txt')
+    results_path = os.path.join(directory, 'results.txt')
+    with open(tasks_path, 'w') as tasks, open(results_path, 'w') as results:
+        for i in range(tasks_number):
+            tasks.write("./process --input data/{0}.png --output {0}.png\n".format(i))
+            results.write(os.path.join(directory, 'out', str(i % 100), '{}.txt\n'.format(i)))
+    return (tasks_path, results_path)
+
+def bench_ingest(args):
+    """ Compare the time until the first task can be given, the time until
+    all tasks are known, and the memory used by the tasks, when loading
+    the tasks files at once and when reading them while giving tasks.
+    """
+    print("{:>10} {:>8} {:>16} {:>14} {:>16}".format("tasks", "mode", "first task (s)", "all tasks (s)", "bytes per task"))
+    for tasks_number in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            (tasks_path, results_path) = write_tasks_files(directory, tasks_number)
+            for mode in ['load', 'stream']:
+                (first, elapsed, _) = ingest(mode, tasks_path, results_path)
+                # Measured again, tracing memory slows everything down.
+                (_, _, memory) = ingest(mode, tasks_path, results_path, trace=True)
+                print("{:>10} {:>8} {:>16.3f} {:>14.3f} {:>16.0f}".format(
+                    tasks_number, mode, first, elapsed, memory / tasks_number))
+
+def ingest(mode, tasks_path, results_path, trace=False):
+    """ Load or read the tasks of a tasks file into a tasks manager.
+    return: (time to the first task, time to all tasks, memory used in bytes if traced)
+    """
+    dis_comp.CREATED_DIRECTORIES.clear()
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    if mode == 'load':
+        (tasks_list, invalid) = start_computing_server.load_tasks(tasks_path, results_path)
+        tasks_manager = dis_comp.TasksManager(tasks_list, show_progress=False, invalid=invalid)
+        thread = None
+    else:
+        tasks_list = tasks_file.TasksFile(tasks_path, results_path)
+        tasks_manager = dis_comp.TasksManager(tasks_list, show_progress=False, complete=False)
+        thread = threading.Thread(target=tasks_list.read, args=(tasks_manager,))
+        thread.start()
+    tasks_manager.get_next_task()
+    first = time.perf_counter() - start
+    if thread is not None:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    memory = None
+    if trace:
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    tasks_manager.close()
+    return (first, elapsed, memory)
+
+
+def combinations_tasks(sets_number, images_number=10):
+    """ Tasks like the ones of create_tasks.py: for each set of scribbles, one task
+    per combination of images, from the smallest to the largest combinations.
+    The duration of a task grows with the square of its number of images.
+    return: (tasks_list, durations) where tasks are annotated with a rough cost.
+    """
+    rng = random.Random(0)
+    tasks_list = []
+    durations = []
+    for scribbles_set in range(100, 100 + sets_number):
+        for size in range(1, images_number + 1):
+            for comb in itertools.combinations(range(1, images_number + 1), size):
+                command = './run.sh "../datasets/axel" "{}" "{}" "true"'.format(scribbles_set, list(comb))
+                tasks_list.append(dis_comp.Task(command, None, dis_comp.NO_OUT, cost=size ** 2))
+                durations.append(0.1 * size ** 2 * rng.lognormvariate(0, 0.3))
+    return (tasks_list, durations)
+
+def simulate(tasks_manager, durations, clients_number):
+    """ Simulate clients_number clients executing the tasks of a tasks manager,
+    each task taking its duration (in simulated seconds).
+    return: the makespan, time at which the last task is done.
+    """
+    now = 0.0
+    # Tasks running: heap of (end time, task_id)
+    running = []
+    idle = clients_number
+    while True:
+        while idle > 0:
+            (task_id, _) = tasks_manager.get_next_task(block=False)
+            if task_id is None:
+                break
+            heapq.heappush(running, (now + durations[task_id], task_id))
+            idle -= 1
+        if not running:
+            return now
+        (now, task_id) = heapq.heappop(running)
+        tasks_manager.update(task_id, True, None)
+        idle += 1
+
+def bench_schedule(args):
+    """ Compare the makespans of simulated runs of tasks getting longer
+    towards the end of the tasks file, giving them in order (fifo),
+    or the most expensive first from their cost annotations (hints)
+    or from the durations of a previous run (history).
+    """
+    (tasks_list, durations) = combinations_tasks(args.sets)
+    hintless_list = [dis_comp.Task(task.command, None, task.task_type) for task in tasks_list]
+    print("{} tasks, {:.0f} s of work".format(len(tasks_list), sum(durations)))
+    print("{:>8} {:>10} {:>14} {:>14}".format("clients", "order", "makespan (s)", "/ lower bound"))
+    with tempfile.TemporaryDirectory() as directory:
+        history = scheduling.RuntimeHistory(os.path.join(directory, 'history.json'))
+        for (task, duration) in zip(tasks_list, durations):
+            history.record(task.command, duration)
+        for clients_number in args.clients:
+            lower_bound = max(sum(durations) / clients_number, max(durations))
+            for (order, tasks_manager) in [
+                    ('fifo', dis_comp.TasksManager(tasks_list, show_progress=False)),
+                    ('hints', dis_comp.TasksManager(tasks_list, show_progress=False, by_cost=True)),
+                    ('history', dis_comp.TasksManager(hintless_list, show_progress=False, by_cost=True,
+                        history=history))]:
+                makespan = simulate(tasks_manager, durations, clients_number)
+                print("{:>8} {:>10} {:>14.1f} {:>14.3f}".format(clients_number, order, makespan, makespan / lower_bound))
+
+
+def parse_distribution(spec):
+    """ Parse a distribution of values (in seconds or bytes):
+    fixed:VALUE, uniform:LOW:HIGH, exp:MEAN or lognormal:MEDIAN:SIGMA.
+    return: a function drawing a value from a random.Random.
+    """
+    (name, *params) = spec.split(':')
+    draws = {
+        'fixed': (1, lambda rng, value: value),
+        'uniform': (2, lambda rng, low, high: rng.uniform(low, high)),
+        'exp': (1, lambda rng, mean: rng.expovariate(1 / mean) if mean > 0 else 0.0),
+        'lognormal': (2, lambda rng, median, sigma: median * rng.lognormvariate(0, sigma))}
+    if name not in draws or len(params) != draws[name][0]:
+        raise argparse.ArgumentTypeError("unknown distribution {} (eg. fixed:0.01, uniform:0:0.02, exp:0.01, lognormal:0.01:0.5)".format(spec))
+    try:
+        params = [float(param) for param in params]
+    except ValueError:
+        raise argparse.ArgumentTypeError("parameters of {} are not numbers".format(spec))
+    draw = draws[name][1]
+    return lambda rng: max(0.0, draw(rng, *params))
+
+def synthetic_tasks(directory, tasks_number, duration, result_size):
+    """ Tasks sleeping for a duration and writing a result of a size
+    drawn from their distributions, with their results in directory.
+    return: (tasks_list, total duration, total size of the results)
+    """
+    rng = random.Random(0)
+    tasks_list = []
+    total_duration = 0.0
+    total_size = 0
+    for task_id in range(tasks_number):
+        seconds = round(duration(rng), 4)
+        size = int(result_size(rng))
+        command = 'sleep {}; head -c {} /dev/zero'.format(seconds, size)
+        tasks_list.append(dis_comp.Task(command, os.path.join(directory, '{}.txt'.format(task_id))))
+        total_duration += seconds
+        total_size += size
+    return (tasks_list, total_duration, total_size)
+
+def run_client(address, slots):
+    """ A client as started by start_computing_client.py, in a thread.
+    """
+    try:
+        sock = socket.create_connection(address)
+    except OSError:
+        # Too late, all tasks are already done.
+        return
+    client.set_no_delay(sock)
+    connection = client.Connection(sock)
+    try:
+        connection.send_hello(slots=slots)
+        while dis_comp.handle_work(connection, dis_comp.Slots(slots)):
+            pass
+    except (RuntimeError, OSError):
+        pass
+    connection.close()
+
+def start_clients(address, clients_number, slots, in_process):
+    """ Start clients connecting to a server at address, in threads of this process
+    or as processes running start_computing_client.py.
+    return: a function waiting for them to end.
+    """
+    if in_process:
+        threads = [threading.Thread(target=run_client, args=(address, slots)) for _ in range(clients_number)]
+        for thread in threads:
+            thread.start()
+        return lambda: [thread.join() for thread in threads]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'start_computing_client.py')
+    processes = [subprocess.Popen([sys.executable, script, '-a', address[0], '-p', str(address[1]), '--slots', str(slots)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for _ in range(clients_number)]
+    return lambda: [process.wait() for process in processes]
+
+def overheads(trace_path):
+    """ The time each task spent between being given to a client and being saved,
+    besides executing (sending, waiting on the client, uploading, saving), from a trace.
+    """
+    overheads = []
+    with open(trace_path) as f:
+        for line in f:
+            trace = json.loads(line)
+            if trace['status'] != 'done':
+                continue
+            given = sum(trace['queue'])
+            saved = sum(trace['save'])
+            overheads.append(saved - given - trace['execute'][1])
+    return sorted(overheads)
+
+def run_cluster(args, engine, clients_number):
+    """ Run synthetic tasks on a server of an engine and clients on localhost.
+    return: the measures of the run.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        (tasks_list, total_duration, total_size) = synthetic_tasks(directory, args.tasks, args.duration, args.resultSize)
+        trace_path = os.path.join(directory, 'trace.jsonl')
+        tasks_manager = dis_comp.TasksManager(tasks_list, show_progress=False, tracer=tracing.Tracer(trace_path))
+        # Clients and servers print what they do.
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            (server, thread) = start_server(engine, tasks_manager, args.prefetch)
+            start = time.perf_counter()
+            wait_clients = start_clients(server.server_address[:2], clients_number, args.slots, args.inProcess)
+            tasks_manager.wait_all_tasks_done()
+            elapsed = time.perf_counter() - start
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            wait_clients()
+            tasks_manager.close()
+        latencies = overheads(trace_path)
+    return {'tasks/s': args.tasks / elapsed,
+        'efficiency': total_duration / (elapsed * clients_number * args.slots),
+        'p50 (ms)': tracing.percentile(latencies, 0.5) * 1e3,
+        'p90 (ms)': tracing.percentile(latencies, 0.9) * 1e3,
+        'p99 (ms)': tracing.percentile(latencies, 0.99) * 1e3,
+        'MB/s': total_size / elapsed / 1e6}
+
+def bench_cluster(args):
+    """ Run synthetic tasks on a server and clients on localhost, through the real
+    tasks manager, servers and clients, and measure the tasks done per second,
+    the share of the time of the clients spent executing tasks (efficiency),
+    the percentiles of the time tasks spent besides executing (dispatch latency)
+    and the throughput of results.
+    With a baseline file, the measures are compared to the ones recorded there
+    (for the same configuration), and they are recorded if asked to:
+    the benchmark fails if tasks/s dropped, or the median latency grew,
+    by more than the tolerance.
+    """
+    baseline = {}
+    if args.baseline is not None and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    columns = ['tasks/s', 'efficiency', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'MB/s']
+    print("{:>8} {:>8} {:>6}".format("engine", "clients", "slots") + ''.join(" {:>11}".format(column) for column in columns)
+        + (" {:>11}".format("vs baseline") if baseline else ''))
+    regressions = []
+    for engine in args.engines:
+        for clients_number in args.clients:
+            measures = run_cluster(args, engine, clients_number)
+            config = '{} clients={} slots={} prefetch={} tasks={} duration={} size={}'.format(engine, clients_number,
+                args.slots, args.prefetch, args.tasks, args.durationSpec, args.resultSizeSpec)
+            line = "{:>8} {:>8} {:>6}".format(engine, clients_number, args.slots) + ''.join(" {:>11.3f}".format(measures[column]) for column in columns)
+            if config in baseline:
+                previous = baseline[config]
+                change = measures['tasks/s'] / previous['tasks/s'] - 1
+                line += " {:>+10.1f}%".format(change * 100)
+                if change < -args.tolerance or measures['p50 (ms)'] > previous['p50 (ms)'] * (1 + args.tolerance):
+                    regressions.append(config)
+            elif baseline:
+                line += " {:>11}".format("new")
+            print(line)
+            if args.save:
+                baseline[config] = measures
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+    if regressions:
+        sys.exit("Regressions against the baseline:\n  " + '\n  '.join(regressions))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--version', action='version', version='0.1')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    parser_dispatch = subparsers.add_parser('dispatch',
+                        help='cost of the tasks manager dispatch for growing numbers of tasks.')
+    parser_dispatch.set_defaults(func=bench_dispatch)
+    parser_dispatch.add_argument('-s', '--sizes', metavar='N', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000],
+                        help='numbers of tasks to dispatch.')
+
+    parser_framing = subparsers.add_parser('framing',
+                        help='throughput of the framing layer compared to the previous one.')
+    parser_framing.set_defaults(func=bench_framing)
+    parser_framing.add_argument('-s', '--sizes', metavar='bytes', type=int, nargs='+',
+                        default=[100, 10000, 1000000, 100000000],
+                        help='sizes of the messages.')
+    parser_framing.add_argument('-t', '--total', metavar='bytes', type=int, default=1000000000,
+                        help='number of bytes to send for each size.')
+
+    parser_load = subparsers.add_parser('load',
+                        help='dispatch throughput of the server engines for growing numbers of clients.')
+    parser_load.set_defaults(func=bench_load)
+    parser_load.add_argument('-c', '--clients', metavar='N', type=int, nargs='+',
+                        default=[10, 100, 1000, 2000],
+                        help='numbers of connected clients.')
+    parser_load.add_argument('-t', '--tasks', metavar='N', type=int, default=100000,
+                        help='number of tasks to dispatch.')
+    parser_load.add_argument('-e', '--engines', nargs='+', choices=['threads', 'asyncio'],
+                        default=['threads', 'asyncio'], help='server engines to compare.')
+    parser_load.add_argument('--prefetch', metavar='K', type=int, default=4,
+                        help='maximum number of tasks in flight per client.')
+
+    parser_ingest = subparsers.add_parser('ingest',
+                        help='time and memory to load tasks files at once or to read them while giving tasks.')
+    parser_ingest.set_defaults(func=bench_ingest)
+    parser_ingest.add_argument('-s', '--sizes', metavar='N', type=int, nargs='+',
+                        default=[100000, 1000000],
+                        help='numbers of lines of the tasks files.')
+
+    parser_schedule = subparsers.add_parser('schedule',
+                        help='simulated makespan of tasks given in order or the most expensive first.')
+    parser_schedule.set_defaults(func=bench_schedule)
+    parser_schedule.add_argument('-c', '--clients', metavar='N', type=int, nargs='+',
+                        default=[16, 64, 256],
+                        help='numbers of simulated clients.')
+    parser_schedule.add_argument('-s', '--sets', metavar='N', type=int, default=14,
+                        help='number of sets of scribbles (1023 tasks each).')
+
+    parser_cluster = subparsers.add_parser('cluster',
+                        help='tasks/s, dispatch latency and throughput of a server and clients on localhost.')
+    parser_cluster.set_defaults(func=bench_cluster)
+    parser_cluster.add_argument('-c', '--clients', metavar='N', type=int, nargs='+',
+                        default=[4, 16],
+                        help='numbers of clients.')
+    parser_cluster.add_argument('--slots', metavar='N', type=int, default=1,
+                        help='number of tasks each client executes at the same time.')
+    parser_cluster.add_argument('-t', '--tasks', metavar='N', type=int, default=2000,
+                        help='number of tasks.')
+    parser_cluster.add_argument('-d', '--duration', metavar='distribution', default='fixed:0.01',
+                        help='distribution of the durations of tasks in seconds: fixed:VALUE, \
+                        uniform:LOW:HIGH, exp:MEAN or lognormal:MEDIAN:SIGMA (default: fixed:0.01).')
+    parser_cluster.add_argument('-r', '--resultSize', metavar='distribution', default='fixed:1000',
+                        help='distribution of the sizes of results in bytes (default: fixed:1000).')
+    parser_cluster.add_argument('-e', '--engines', nargs='+', choices=['threads', 'asyncio'],
+                        default=['threads', 'asyncio'], help='server engines to compare.')
+    parser_cluster.add_argument('--prefetch', metavar='K', type=int, default=0,
+                        help='maximum number of tasks in flight per client (0 for one at a time).')
+    parser_cluster.add_argument('--inProcess', action='store_true',
+                        help='run the clients in threads of the benchmark instead of processes.')
+    parser_cluster.add_argument('-b', '--baseline', metavar='filepath', default=None,
+                        help='JSON file of the measures of previous runs, to compare with.')
+    parser_cluster.add_argument('--save', action='store_true',
+                        help='record the measures into the baseline file.')
+    parser_cluster.add_argument('--tolerance', metavar='ratio', type=float, default=0.1,
+                        help='relative change of tasks/s or of the median latency taken for a regression (default: 0.1).')
+
+    args = parser.parse_args()
+    if args.func is bench_cluster:
+        if args.save and args.baseline is None:
+            parser.error('--save requires --baseline')
+        (args.durationSpec, args.resultSizeSpec) = (args.duration, args.resultSize)
+        args.duration = parse_distribution(args.duration)
+        args.resultSize = parse_distribution(args.resultSize)
+    args.func(args)
@@ -5,68 +5,405 @@
 # pylint configuration
 # pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
 
+import wire_compression
+import os
+import json
+import socket
+import struct
 
-def send_msg(sock, bytes_msg):
-    """ Send a single message from a socket.
-    """
-    bytes_sent = 0
-    msg_length = len(bytes_msg)
-    # Send as many times as need to send the complete message.
-    while bytes_sent < msg_length:
-        sent = sock.send(bytes_msg[bytes_sent:])
-        if sent == 0:
-            raise RuntimeError("socket connection broken")
-        bytes_sent = bytes_sent + sent
-    assert bytes_sent == msg_length
-    return bytes_sent
-
-def send_sized_msg(sock, bytes_msg):
-    """ Send first the size of the message (coded on 4 bytes little)
-    and then the message itself.
+# Highest version of the protocol supported.
+# 1: sizes are coded on 4 bytes little.
+# 2: sizes are coded on 8 bytes little.
+PROTOCOL_VERSION = 2
+LENGTH_SIZES = {1: 4, 2: 8}
+
+# Type of the message exchanged first by both ends to negotiate the protocol.
+# It is always framed with the version 1 of the protocol.
+HELLO = 255
+
+# Type of the message sent regularly by a client while executing a task,
+# if both ends agreed on it in their hello (see Connection.send_hello).
+HEARTBEAT = 19
+
+# Number of heartbeats a client may miss before being considered dead.
+HEARTBEAT_MISSES = 3
+
+# Size of the chunks of a stream.
+CHUNK_SIZE = 1 << 20
+
+# Default size of the buffer receiving messages.
+RECV_BUFFER_SIZE = 1 << 20
+
+
+def set_socket_buffers(sock, buffer_size):
+    """ Ask the kernel for send and receive buffers of the given size.
     """
-    msg_length = len(bytes_msg) if bytes_msg is not None else 0
-    send_msg(sock, msg_length.to_bytes(4, 'little'))
-    if msg_length > 0:
-        send_msg(sock, bytes_msg)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+
 
-def send_typed_msg(sock, msg_type, bytes_msg):
-    """ Send a message with a type encoded over 1 bytes little.
+def set_no_delay(sock):
+    """ Send small messages at once on a TCP socket (disable Nagle's algorithm):
+    a result is sent as a header, chunks and an end marker before waiting for
+    the next task, and the last of them would otherwise wait for the delayed
+    acknowledgement of the previous ones (about 40 ms per task).
     """
-    send_msg(sock, msg_type.to_bytes(1, 'little'))
-    send_sized_msg(sock, bytes_msg)
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 
+def is_local(sock):
+    """ Whether a socket is a unix socket, connecting two ends on the same machine.
+    """
+    return getattr(socket, 'AF_UNIX', None) is not None and sock.family == socket.AF_UNIX
 
+def peer_uid(sock):
+    """ The user id of the process at the other end of a unix socket
+    (None for another socket, or where the kernel does not tell it).
+    """
+    if not is_local(sock) or not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', credentials)[1]
 
-def recv_msg(sock, msg_length, max_chunk_length=2048):
-    """ Receive a message from a socket of a given length.
-    return: the message in a bytes string.
+def client_hello(max_version, slots=1, inputs=None, local=False):
+    """ The hello of a client: the highest version of the protocol it supports,
+    that it knows about heartbeats, the compression codecs it knows,
+    the number of tasks it executes at the same time,
+    if it has a cache of inputs, the hashes of the files in it,
+    and whether it is connected through a unix socket.
     """
-    chunks = []
-    bytes_recvd = 0
-    # Receive as many times as need to receive the complete message.
-    while bytes_recvd < msg_length:
-        chunk = sock.recv(min(msg_length-bytes_recvd, max_chunk_length))
-        if chunk == b'':
-            raise RuntimeError("socket connection broken")
-        chunks.append(chunk)
-        bytes_recvd = bytes_recvd + len(chunk)
-    assert bytes_recvd == msg_length
-    return b''.join(chunks)
-
-def recv_sized_msg(sock):
-    """ Receive first the size of the message (coded on 4 bytes little)
-    and then the message itself.
+    hello = {'version': max_version, 'heartbeat': True,
+        'compression': sorted(wire_compression.CODECS), 'slots': slots}
+    if inputs is not None:
+        hello['inputs'] = inputs
+    if local:
+        hello['local'] = True
+    return hello
+
+def answer_hello(hello, max_version, heartbeat, compression, staging=False, local=False):
+    """ Answer the hello of a client, with the version of the protocol,
+    the interval of heartbeats, the compression codec of the results
+    of each type of tasks (compression is a dict: task type -> codec asked for),
+    the number of tasks the client executes at the same time,
+    whether inputs are sent with tasks (if the server stages them
+    and the client has a cache of inputs), and whether results files
+    are handed over by path (if both ends are connected through a unix socket,
+    see distributed_computing.send_result).
     """
-    msg_bytes = None
-    msg_length = int.from_bytes(recv_msg(sock, 4), 'little')
-    if msg_length > 0:
-        msg_bytes = recv_msg(sock, msg_length)
-    return msg_bytes
-
-def recv_typed_msg(sock):
-    """ Receive a message with a type encoded over 1 bytes little.
+    version = min(hello['version'], max_version)
+    if version not in LENGTH_SIZES:
+        raise RuntimeError("unsupported protocol version {}".format(version))
+    reply = {'version': version, 'slots': max(1, int(hello.get('slots', 1)))}
+    if hello.get('heartbeat'):
+        reply['heartbeat'] = heartbeat
+    codecs = {}
+    # Codecs known by both ends.
+    available = set(hello.get('compression', [])) & set(wire_compression.CODECS)
+    for (task_type, codec) in (compression or {}).items():
+        codec = wire_compression.resolve(codec, available)
+        if codec is not None:
+            codecs[str(task_type)] = codec
+    if codecs:
+        reply['compression'] = codecs
+    if staging and 'inputs' in hello:
+        reply['staging'] = True
+    if local and hello.get('local'):
+        reply['local'] = True
+    return reply
+
+
+class Connection:
+    """ Frames messages over a connected socket.
+    A message is a type (1 byte), a size and the message itself.
+    The size is coded on 4 or 8 bytes little depending on the version
+    of the protocol negotiated with the other end (see send_hello).
+    heartbeat is the interval of the heartbeats negotiated (0 if none are expected),
+    or None if the other end does not know about heartbeats.
+    codecs are the compression codecs negotiated for the results
+    of each type of tasks (task type -> name).
+    slots is the number of tasks the client executes at the same time.
+    staging is True if inputs are sent with tasks, and client_inputs are the hashes
+    of the inputs the client had when it connected (only known to the server).
+    local is True if both ends are on the same machine and results files
+    are handed over by path, and peer_uid is then the user id of the client
+    (only known to the server).
+    Headers and messages are sent together without copying the messages,
+    and received directly in preallocated buffers.
     """
-    msg_type = int.from_bytes(recv_msg(sock, 1), 'little')
-    msg_bytes = recv_sized_msg(sock)
-    return (msg_type, msg_bytes)
+    def __init__(self, sock, buffer_size=RECV_BUFFER_SIZE, version=1):
+        self.sock = sock
+        self.version = version
+        self.length_size = LENGTH_SIZES[version]
+        # Reused to receive the chunks of streams.
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # Only send the header and the message in a single call where possible.
+        self.vectored = hasattr(sock, 'sendmsg')
+        self.heartbeat = None
+        self.codecs = {}
+        self.slots = 1
+        self.staging = False
+        self.client_inputs = []
+        self.local = False
+        self.peer_uid = None
+        self.compression_stats = wire_compression.CompressionStats()
+        # Receives the chunks of compressed streams, grown as needed.
+        self.chunk_buffer = bytearray()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        self.sock.close()
+
+    def set_version(self, version):
+        """ Use a given version of the protocol from now on.
+        """
+        self.version = version
+        self.length_size = LENGTH_SIZES[version]
+
+    def send_hello(self, max_version=PROTOCOL_VERSION, slots=1, inputs=None):
+        """ Negotiate the version of the protocol with a server
+        (the highest version supported by both ends).
+        The client also tells it knows about heartbeats (and cancellations),
+        and the server answers the interval at which it expects them.
+        It tells as well how many tasks it executes at the same time (slots),
+        the inputs in its cache if it has one (their hashes),
+        and whether it is connected through a unix socket.
+        return: the version chosen.
+        """
+        self.set_version(1)
+        self.send_typed_msg(HELLO, json.dumps(client_hello(max_version, slots, inputs, is_local(self.sock))).encode())
+        (msg_type, msg_bytes) = self.recv_typed_msg()
+        if msg_type != HELLO:
+            raise RuntimeError("protocol negotiation failed")
+        self.agree(json.loads(msg_bytes.decode()))
+        return self.version
+
+    def accept_hello(self, max_version=PROTOCOL_VERSION, heartbeat=0, compression=None, staging=False):
+        """ Negotiate the version of the protocol with a client
+        (the highest version supported by both ends),
+        the interval of its heartbeats (0 for none),
+        the compression of results and the staging of inputs (see answer_hello).
+        return: the version chosen.
+        """
+        self.set_version(1)
+        (msg_type, msg_bytes) = self.recv_typed_msg()
+        if msg_type != HELLO:
+            raise RuntimeError("protocol negotiation failed")
+        hello = json.loads(msg_bytes.decode())
+        self.peer_uid = peer_uid(self.sock)
+        reply = answer_hello(hello, max_version, heartbeat, compression, staging, self.peer_uid is not None)
+        self.send_typed_msg(HELLO, json.dumps(reply).encode())
+        self.agree(reply)
+        self.client_inputs = hello.get('inputs', [])
+        if self.heartbeat:
+            self.settimeout(HEARTBEAT_MISSES * self.heartbeat)
+        return self.version
+
+    def agree(self, reply):
+        """ Use what the server answered to a hello.
+        """
+        self.set_version(reply['version'])
+        self.heartbeat = reply.get('heartbeat')
+        self.codecs = {int(task_type): codec for (task_type, codec) in reply.get('compression', {}).items()}
+        self.slots = reply.get('slots', 1)
+        self.staging = reply.get('staging', False)
+        self.local = reply.get('local', False)
+
+    def encode_length(self, msg_length):
+        return msg_length.to_bytes(self.length_size, 'little')
+
+    def send_msg(self, *bytes_msgs):
+        """ Send some messages one after the other, in as few calls as possible.
+        return: the number of bytes sent.
+        """
+        views = [memoryview(bytes_msg).cast('B') for bytes_msg in bytes_msgs if bytes_msg]
+        msg_length = sum(len(view) for view in views)
+        if not self.vectored:
+            for view in views:
+                self.sock.sendall(view)
+            return msg_length
+        bytes_sent = 0
+        # Send as many times as need to send the complete messages,
+        # only moving views over the parts not sent yet.
+        while views:
+            sent = self.sock.sendmsg(views)
+            if sent == 0:
+                raise RuntimeError("socket connection broken")
+            bytes_sent += sent
+            while views and sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            if sent > 0:
+                views[0] = views[0][sent:]
+        assert bytes_sent == msg_length
+        return bytes_sent
+
+    def send_sized_msg(self, bytes_msg):
+        """ Send first the size of the message and then the message itself.
+        """
+        msg_length = len(bytes_msg) if bytes_msg is not None else 0
+        self.send_msg(self.encode_length(msg_length), bytes_msg)
+
+    def send_typed_msg(self, msg_type, bytes_msg):
+        """ Send a message with a type encoded over 1 bytes little.
+        """
+        msg_length = len(bytes_msg) if bytes_msg is not None else 0
+        self.send_msg(msg_type.to_bytes(1, 'little') + self.encode_length(msg_length), bytes_msg)
+
+    def send_stream(self, fileobj, chunk_size=CHUNK_SIZE, codec=None):
+        """ Send the content of a binary file (from its current position)
+        as a stream of sized chunks, terminated by an empty chunk.
+        The chunks are sent with sendfile, without copying them in memory,
+        unless they are compressed with a codec (see send_compressed_stream).
+        A None file is sent as an empty stream.
+        """
+        if fileobj is not None and codec is not None:
+            self.send_compressed_stream(fileobj, chunk_size, codec)
+        elif fileobj is not None:
+            offset = fileobj.tell()
+            file_size = os.fstat(fileobj.fileno()).st_size
+            while offset < file_size:
+                chunk_length = min(file_size - offset, chunk_size)
+                self.send_msg(self.encode_length(chunk_length))
+                if self.sock.sendfile(fileobj, offset, chunk_length) != chunk_length:
+                    raise RuntimeError("socket connection broken")
+                offset += chunk_length
+        self.send_msg(self.encode_length(0))
+
+    def send_compressed_stream(self, fileobj, chunk_size, codec):
+        """ Send the content of a binary file as chunks (of a stream) compressed
+        one by one, each starting with a flag saying if it is compressed.
+        Chunks which do not shrink are sent as they are, and once several
+        chunks in a row did not, the rest of the file is sent with sendfile.
+        """
+        compress = wire_compression.CODECS[codec][0]
+        offset = fileobj.tell()
+        file_size = os.fstat(fileobj.fileno()).st_size
+        raw_bytes = file_size - offset
+        wire_bytes = 0
+        cpu_time = 0.0
+        incompressible = 0
+        while offset < file_size:
+            chunk_length = min(file_size - offset, chunk_size)
+            if incompressible >= wire_compression.MAX_INCOMPRESSIBLE_CHUNKS:
+                self.send_msg(self.encode_length(chunk_length + 1), bytes([wire_compression.RAW]))
+                if self.sock.sendfile(fileobj, offset, chunk_length) != chunk_length:
+                    raise RuntimeError("socket connection broken")
+            else:
+                fileobj.seek(offset)
+                chunk = fileobj.read(chunk_length)
+                start = wire_compression.thread_time()
+                data = compress(chunk)
+                cpu_time += wire_compression.thread_time() - start
+                if len(data) < chunk_length:
+                    incompressible = 0
+                    flag = wire_compression.COMPRESSED
+                else:
+                    incompressible += 1
+                    (flag, data) = (wire_compression.RAW, chunk)
+                self.send_msg(self.encode_length(len(data) + 1), bytes([flag]), data)
+                chunk_length = len(data)
+            wire_bytes += chunk_length + 1
+            offset = min(file_size, offset + chunk_size)
+        self.compression_stats.add(raw_bytes, wire_bytes, cpu_time)
+
+    def recv_into(self, view):
+        """ Fill a writable memoryview with bytes from the socket.
+        """
+        bytes_recvd = 0
+        msg_length = len(view)
+        # Receive as many times as need to receive the complete message.
+        while bytes_recvd < msg_length:
+            recvd = self.sock.recv_into(view[bytes_recvd:])
+            if recvd == 0:
+                raise RuntimeError("socket connection broken")
+            bytes_recvd += recvd
+        return bytes_recvd
+
+    def recv_msg(self, msg_length):
+        """ Receive a message of a given length.
+        return: the message in a bytearray allocated once.
+        """
+        bytes_msg = bytearray(msg_length)
+        self.recv_into(memoryview(bytes_msg))
+        return bytes_msg
+
+    def recv_length(self):
+        return int.from_bytes(self.recv_msg(self.length_size), 'little')
+
+    def recv_sized_msg(self):
+        """ Receive first the size of the message and then the message itself.
+        """
+        msg_bytes = None
+        msg_length = self.recv_length()
+        if msg_length > 0:
+            msg_bytes = self.recv_msg(msg_length)
+        return msg_bytes
+
+    def recv_typed_msg(self):
+        """ Receive a message with a type encoded over 1 bytes little.
+        """
+        header = self.recv_msg(1 + self.length_size)
+        msg_type = header[0]
+        msg_length = int.from_bytes(header[1:], 'little')
+        msg_bytes = self.recv_msg(msg_length) if msg_length > 0 else None
+        return (msg_type, msg_bytes)
+
+    def recv_stream(self, fileobj, codec=None):
+        """ Receive a stream of sized chunks (terminated by an empty chunk)
+        and write it to a binary file, through the receive buffer.
+        If fileobj is None, the stream is received and discarded.
+        return: the number of bytes received.
+        """
+        if codec is not None:
+            return self.recv_compressed_stream(fileobj, codec)
+        total_length = 0
+        while True:
+            msg_length = self.recv_length()
+            if msg_length == 0:
+                break
+            total_length += msg_length
+            # Receive the chunk by pieces fitting in the buffer.
+            while msg_length > 0:
+                piece_length = self.sock.recv_into(self.view, min(msg_length, len(self.buffer)))
+                if piece_length == 0:
+                    raise RuntimeError("socket connection broken")
+                if fileobj is not None:
+                    fileobj.write(self.view[:piece_length])
+                msg_length -= piece_length
+        return total_length
+
+    def recv_compressed_stream(self, fileobj, codec):
+        """ Receive a stream sent by send_compressed_stream,
+        and write it decompressed to a binary file (unless it is None).
+        return: the number of bytes received.
+        """
+        decompress = wire_compression.CODECS[codec][1]
+        raw_bytes = 0
+        wire_bytes = 0
+        cpu_time = 0.0
+        while True:
+            msg_length = self.recv_length()
+            if msg_length == 0:
+                break
+            if len(self.chunk_buffer) < msg_length:
+                self.chunk_buffer = bytearray(msg_length)
+            chunk = memoryview(self.chunk_buffer)[:msg_length]
+            self.recv_into(chunk)
+            wire_bytes += msg_length
+            if fileobj is None:
+                continue
+            data = chunk[1:]
+            if chunk[0] == wire_compression.COMPRESSED:
+                start = wire_compression.thread_time()
+                data = decompress(data)
+                cpu_time += wire_compression.thread_time() - start
+            raw_bytes += len(data)
+            fileobj.write(data)
+        self.compression_stats.add(raw_bytes, wire_bytes, cpu_time)
+        return wire_bytes
@@ -19,6 +19,8 @@ if __name__ == '__main__':
             command = './run_evals.sh "../datasets/{0}" "{{{1}}}" && cd .. && tar -cf datasets/{0}/results/eval/{1}.tar'.format(dataset, scribble_set)
             result_file = '$(pwd)/datasets/{0}/results/eval/{1}.tar'.format(dataset, scribble_set)
             line = 'cd ' + root_dir + ' && ' + command + ' && echo ' + result_file
+            # Only started once the coseg tasks of the scribbles set are done (see create_tasks.py).
+            line += '  #dc: after=coseg_' + scribble_set
             f.write(line + '\n')
 
     with open("results_paths.txt", 'w') as f:
@@ -27,6 +27,8 @@ if __name__ == '__main__':
                 command = './run.sh "../datasets/{}" "{}" "{}" "true" && cd ..'.format(dataset, scribble_set, comb)
                 result_file = '$(pwd)/datasets/{}/results/coseg/{}/{}'.format(dataset, scribble_set, filename(comb))
                 line = 'cd ' + root_dir + ' && ' + command + ' && echo ' + result_file
+                # Labelled for the evaluation tasks to come after them (see create_eval_tasks.py).
+                line += '  #dc: id=coseg_' + scribble_set
                 f.write(line + '\n')
     
     with open("results_paths.txt", 'w') as f:
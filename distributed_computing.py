@@ -6,31 +6,171 @@
 # pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
 
 import client
+import wire_compression
+import collections
+import concurrent.futures
 import tempfile
 import threading
+import select
+import math
+import time
 import subprocess
+import statistics
 import socketserver
-import utils
-import os
+import signal
+import socket
+import errno
+import stat
+import progress
+import scheduling
+import result_writer
+import staging
 import shutil
+import heapq
+import queue
+import json
+import io
+import os
 
 # Define the different tasks types:
 NO_OUT = 0
 STD_OUT = 1
 FILE_OUT = 2
 
+# Permissions given to the results files, as if created with open().
+UMASK = os.umask(0)
+os.umask(UMASK)
+RESULT_FILE_MODE = 0o666 & ~UMASK
+
+# Define the messages types used in batched mode (on top of the tasks types):
+# A batch of tasks, sent by the server.
+TASKS_BATCH = 16
+# The header of the result of one task of a batch, sent by the client.
+TASK_RESULT = 17
+# Cancel a task of a batch (done meanwhile by another client), sent by the server.
+CANCEL = 18
+# Ask for input files missing from the cache of the client (a JSON list of their hashes),
+# sent by the client when inputs are staged.
+FETCH_INPUTS = 21
+# An input file asked for: its hash, followed by a stream of its content, sent by the server.
+INPUT_DATA = 22
+# An input file asked for which cannot be sent (its hash), sent by the server:
+# the tasks reading it fail.
+INPUT_MISSING = 23
+
+# Status of a task in the header of its result.
+RESULT_DONE = 0
+RESULT_CANCELLED = 1
+RESULT_FAILED = 2
+
+# Speculative execution of stragglers: number of tasks done before their
+# median duration is trusted, and how often idle clients look for stragglers (seconds).
+SPECULATION_MIN_SAMPLES = 5
+SPECULATION_INTERVAL = 0.5
+
+# How often a client checks whether its task has finished (seconds),
+# when it cannot wait for both the task and the server at the same time.
+EXIT_POLL_INTERVAL = 0.01
+
+# How often a client with tasks waiting for a slot checks whether the load
+# and the memory of its machine let it start them (seconds).
+SLOTS_CHECK_INTERVAL = 1.0
+
+# How often the tasks looked up in the cache are reported to the listeners
+# of a tasks manager while more are being looked up (seconds).
+LOOKUP_NOTIFY_INTERVAL = 0.1
+
+
+def remove_stale_socket(path):
+    """ Remove the unix socket left at path by a previous server, if any.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def describe_client(address, sock):
+    """ The name of a client in reports: its address,
+    or the number of its socket if it is connected through a unix socket.
+    """
+    if isinstance(address, tuple):
+        return '{}:{}'.format(*address[:2])
+    return 'local:{}'.format(sock.fileno())
+
 
 class TasksThreadingTCPServer(socketserver.ThreadingTCPServer):
     """ A threaded TCP server socket aware of a tasks manager.
+    If local_path is given, the clients on the same machine can connect
+    through a unix socket there as well (see TasksThreadingUnixServer).
     """
-    def __init__(self, server_address, tasks_manager):
+    def __init__(self, server_address, tasks_manager, prefetch=0, adaptive_prefetch=True,
+            buffer_size=None, heartbeat=0, compression=None, staging=None, local_path=None):
         # Tell the kernel to reuse a local socket still in TIME_WAIT mode.
         self.allow_reuse_address = True
         # Link to the tasks manager.
         self.tasks_manager = tasks_manager
+        # Maximum number of tasks in flight per client (0 for one task at a time
+        # without batches), and whether to tune it from the measured durations.
+        self.prefetch = prefetch
+        self.adaptive_prefetch = adaptive_prefetch
+        # Size of the receive buffers (default ones if None).
+        self.buffer_size = buffer_size
+        # Interval of the heartbeats expected from clients while they work (0 for none).
+        self.heartbeat = heartbeat
+        # Compression codecs asked for the results of each type of tasks (see client.answer_hello),
+        # and what they saved.
+        self.compression = compression
+        self.compression_stats = wire_compression.CompressionStats()
+        # Input files sent to clients with a cache of inputs (staging.ServerInputs), if staged.
+        self.staging = staging
         # Shutdown all child threads when main thread terminates.
         self.daemon_threads = True
+        # Accept bursts of clients connecting all at once.
+        self.request_queue_size = socket.SOMAXCONN
         super().__init__(server_address, TasksTCPHandler)
+        self.local_server = TasksThreadingUnixServer(local_path, self) if local_path is not None else None
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.local_server is not None:
+            threading.Thread(target=self.local_server.serve_forever, args=(poll_interval,), daemon=True).start()
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            if self.local_server is not None:
+                socketserver.BaseServer.shutdown(self.local_server)
+
+    def server_close(self):
+        super().server_close()
+        if self.local_server is not None:
+            self.local_server.server_close()
+
+
+class TasksThreadingUnixServer(socketserver.ThreadingUnixStreamServer):
+    """ Serves the clients on the same machine as a TasksThreadingTCPServer (main)
+    through a unix socket at path, with the same tasks and options,
+    so that results files are handed over by path (see send_result).
+    It is run and stopped with the main server.
+    """
+    def __init__(self, path, main):
+        self.main = main
+        for name in ('tasks_manager', 'prefetch', 'adaptive_prefetch', 'buffer_size',
+                'heartbeat', 'compression', 'compression_stats', 'staging'):
+            setattr(self, name, getattr(main, name))
+        self.daemon_threads = True
+        self.request_queue_size = socket.SOMAXCONN
+        remove_stale_socket(path)
+        super().__init__(path, TasksTCPHandler)
+
+    def shutdown(self):
+        """ Stop the main server (called by the handlers once all tasks are done).
+        """
+        self.main.shutdown()
+
+    def server_close(self):
+        super().server_close()
+        remove_stale_socket(self.server_address)
 
 
 class TasksTCPHandler(socketserver.BaseRequestHandler):
@@ -41,223 +181,1964 @@ class TasksTCPHandler(socketserver.BaseRequestHandler):
 
     def handle(self):
         tasks_manager = self.server.tasks_manager
-        # As long as there is work to do:
-        while not tasks_manager.all_tasks_done():
-            # Get a task from the tasks manager.
-            (task_id, task) = tasks_manager.get_next_task()
-            if task_id is not None:
-                tasks_manager.print_progress()
-                # Give work through the client socket.
-                (work_done, result) = give_work(self.request, task)
-                # Give back the results to the tasks manager.
-                tasks_manager.update(task_id, work_done, result)
-                if not work_done:
-                    raise RuntimeError("client work not done")
+        client_name = describe_client(self.client_address, self.request)
+        connection = connect_client(self.request, self.server.buffer_size,
+            self.server.heartbeat, self.server.compression, self.server.staging is not None)
+        connection.compression_stats = self.server.compression_stats
+        if self.server.prefetch > 0 or connection.slots > 1 or connection.staging:
+            # Keep several tasks in flight on the client, sent in batches
+            # (with their inputs if staged).
+            window = PrefetchWindow.for_client(self.server.prefetch, self.server.adaptive_prefetch, connection.slots)
+            inputs = None
+            if connection.staging:
+                inputs = staging.ClientInputs(self.server.staging, connection.client_inputs)
+            if not give_batched_work(connection, tasks_manager, window, client_name, inputs):
+                raise RuntimeError("client work not done")
+        else:
+            # The task given to the client, to cancel it from other threads.
+            given = {'task_id': None, 'lock': threading.Lock()}
+            def cancel(task_id, timed_out):
+                with given['lock']:
+                    if task_id == given['task_id']:
+                        cancel_work(connection, timed_out)
+            tasks_manager.add_cancel_listener(cancel)
+            try:
+                # As long as there is work to do:
+                while True:
+                    # Get a task from the tasks manager.
+                    # This blocks while every remaining task is being worked on.
+                    (task_id, task) = tasks_manager.get_next_task()
+                    if task_id is None:
+                        break
+                    # Give work through the client socket.
+                    timings = {} if tasks_manager.tracer is not None else None
+                    with given['lock']:
+                        given['task_id'] = task_id
+                        send_start = time.monotonic()
+                        task_sent = task.send_through(connection)
+                        if timings is not None:
+                            timings['send'] = (send_start, time.monotonic())
+                    (work_done, result, cancelled) = give_work(connection, task, task_sent, timings)
+                    with given['lock']:
+                        given['task_id'] = None
+                    # Give back the results to the tasks manager.
+                    tasks_manager.update(task_id, work_done, result, client_name, timings)
+                    if not work_done and not cancelled:
+                        raise RuntimeError("client work not done")
+            finally:
+                tasks_manager.remove_cancel_listener(cancel)
 
         # Shutdown all clients if all tasks are done.
         self.server.shutdown()
 
 
-def give_work(client_socket, task):
-    """ Send a task through a client socket and retrieve the results.
+def connect_client(client_socket, buffer_size=None, heartbeat=0, compression=None, staging=False):
+    """ Wrap the socket of a newly connected client in a connection
+    and negotiate the protocol version, the heartbeats, the compression
+    and the staging of inputs with it.
+    """
+    if buffer_size is not None:
+        client.set_socket_buffers(client_socket, buffer_size)
+    client.set_no_delay(client_socket)
+    connection = client.Connection(client_socket, buffer_size or client.RECV_BUFFER_SIZE)
+    connection.accept_hello(heartbeat=heartbeat, compression=compression, staging=staging)
+    return connection
+
+
+def cancel_work(connection, timed_out):
+    """ Stop the task given to a client one at a time.
+    Clients knowing about heartbeats also know about cancellations,
+    others are disconnected if the task timed out.
+    """
+    try:
+        if connection.heartbeat is not None:
+            connection.send_typed_msg(CANCEL, (0).to_bytes(4, 'little'))
+        elif timed_out:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+    except (RuntimeError, OSError):
+        # The thread of this client will notice.
+        pass
+
+
+def give_work(connection, task, task_sent=None, timings=None):
+    """ Send a task through a client socket (unless task_sent is given)
+    and retrieve the results.
+    Clients knowing about heartbeats send them until the header of the result,
+    which says whether the task was cancelled.
+    If timings is given, the times of the phases of the task are added to it
+    (see tracing.PHASES).
+    return: (work_done, result, cancelled)
     """
     work_done = False
     result = None
+    cancelled = False
     # Send task through the client socket.
-    task_sent = task.send_through(client_socket)
-    if task_sent:
+    if task_sent is None:
+        task_sent = task.send_through(connection)
+    sent_time = time.monotonic()
+    if task_sent and connection.heartbeat is not None:
+        try:
+            cancelled = wait_result_header(connection, timings)
+            if cancelled:
+                # Nothing is expected, just consume the (empty) stream.
+                connection.recv_stream(None)
+        except (RuntimeError, OSError) as err:
+            print("Runtime Error: {}".format(err))
+            task_sent = False
+            cancelled = False
+    if not task_sent:
+        connection.close()
+    elif not cancelled:
         # Wait for the answer.
-        (work_done, result) = task.retrieve_result(client_socket)
-    else:
-        client_socket.close()
-    return (work_done, result)
+        upload_start = time.monotonic()
+        (work_done, result) = task.retrieve_result(connection)
+        if timings is not None:
+            if 'execute' not in timings:
+                # The execution is only known from the header of the result.
+                timings['execute'] = (sent_time, upload_start)
+            timings['upload'] = (upload_start, time.monotonic())
+    return (work_done, result, cancelled)
+
+
+def wait_result_header(connection, timings=None):
+    """ Wait for the header of a result, skipping heartbeats.
+    If timings is given, the times of the task on the client are added to it.
+    return: True if the task was cancelled.
+    """
+    while True:
+        (msg_type, header) = connection.recv_typed_msg()
+        if msg_type != client.HEARTBEAT:
+            break
+    if msg_type != TASK_RESULT:
+        raise RuntimeError("unexpected message type {}".format(msg_type))
+    (_, wait, duration, status) = unpack_result_header(header)
+    if timings is not None:
+        add_client_timings(timings, time.monotonic(), wait, duration)
+    return not result_done(status)
+
+
+def add_client_timings(timings, header_time, wait, duration):
+    """ Add the times of a task on a client to its timings, from the times
+    in the header of its result received at header_time (right after its execution).
+    """
+    timings['wait'] = (header_time - duration - wait, header_time - duration)
+    timings['execute'] = (header_time - duration, header_time)
+
+
+def give_batched_work(connection, tasks_manager, window, client_name=None, inputs=None):
+    """ Keep up to window.size tasks in flight on a client (named client_name),
+    sending them in batches and retrieving results as they finish.
+    If inputs is given (a staging.ClientInputs), the inputs of tasks
+    are sent with them, and the files the client asks for are sent
+    from another thread, to keep receiving results meanwhile.
+    Return True once all tasks are done, False if the client failed.
+    """
+    all_done = False
+    # Cancellations are sent from the threads of other clients.
+    send_lock = threading.Lock()
+    def send_cancel(task_id):
+        try:
+            with send_lock:
+                connection.send_typed_msg(CANCEL, task_id.to_bytes(4, 'little'))
+        except (RuntimeError, OSError):
+            # The thread of this client will notice.
+            pass
+    session = ClientSession(tasks_manager, window, send_cancel, inputs)
+    try:
+        while True:
+            # Top up the tasks in flight to the window size.
+            # Only block for a task if the client has nothing left to do.
+            batch = session.next_batch(block=True)
+            if batch:
+                batch_msg = pack_tasks_batch(batch, inputs)
+                with send_lock:
+                    connection.send_typed_msg(TASKS_BATCH, batch_msg)
+                session.batch_sent(batch)
+            # Everything is done when there is nothing left to wait for.
+            if not session.in_flight:
+                all_done = True
+                break
+            # Wait for the next result, whichever task it is from.
+            (msg_type, header) = connection.recv_typed_msg()
+            if msg_type == client.HEARTBEAT:
+                continue
+            if msg_type == FETCH_INPUTS and inputs is not None:
+                threading.Thread(target=send_inputs, daemon=True,
+                    args=(connection, inputs, json.loads(header.decode()), send_lock)).start()
+                continue
+            (task_id, task, cancelled, timings) = session.result_received(msg_type, header)
+            if cancelled:
+                connection.recv_stream(None)
+                tasks_manager.update(task_id, False, None)
+                continue
+            upload_start = time.monotonic()
+            (work_done, result) = task.retrieve_result(connection)
+            if timings is not None:
+                timings['upload'] = (upload_start, time.monotonic())
+            tasks_manager.update(task_id, work_done, result, client_name, timings)
+            if not work_done:
+                break
+    except (RuntimeError, OSError) as err:
+        print("Runtime Error: {}".format(err))
+        connection.close()
+    session.give_back()
+    return all_done
 
 
+def send_inputs(connection, inputs, hashes, send_lock):
+    """ Send to a client the input files it asked for (by their hashes),
+    each one at once under send_lock. The ones which cannot be read
+    are answered with INPUT_MISSING, for the tasks reading them to fail.
+    """
+    try:
+        for file_hash in hashes:
+            try:
+                f = open(inputs.server_inputs.path(file_hash), 'rb')
+            except (OSError, KeyError) as err:
+                print("Cannot send input {}: {}".format(file_hash, err))
+                with send_lock:
+                    connection.send_typed_msg(INPUT_MISSING, file_hash.encode())
+                continue
+            with f, send_lock:
+                connection.send_typed_msg(INPUT_DATA, file_hash.encode())
+                connection.send_stream(f)
+            inputs.sent(file_hash)
+    except (RuntimeError, OSError) as err:
+        # The stream may be cut in the middle: make sure
+        # the thread of this client notices the connection is broken.
+        print("Runtime Error: {}".format(err))
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class ClientSession:
+    """ Keeps track of the tasks given to a client in batched mode,
+    whatever the way messages are actually sent and received.
+    If send_cancel is given, it is called (from any thread) with the id
+    of a task in flight done meanwhile by another client, or timed out.
+    If inputs is given (a staging.ClientInputs), tasks whose inputs
+    the client holds are given first.
+    """
+    def __init__(self, tasks_manager, window, send_cancel=None, inputs=None):
+        self.tasks_manager = tasks_manager
+        self.window = window
+        self.inputs = inputs
+        # Tasks given to the client and not yet done:
+        # task_id -> (task, time the batch was ready, time sent)
+        self.in_flight = {}
+        self.ready_time = None
+        self.send_cancel = send_cancel
+        if send_cancel is not None:
+            tasks_manager.add_cancel_listener(self.cancel)
+
+    def cancel(self, task_id, timed_out=False):
+        """ Tell the client to stop working on a task done by another client
+        (or for too long).
+        """
+        if task_id in self.in_flight:
+            self.send_cancel(task_id)
+
+    def next_batch(self, block):
+        """ Get the tasks to send to top up the tasks in flight to the window size.
+        If block is True, wait for a task when the client has nothing to do.
+        """
+        batch = []
+        while len(self.in_flight) < self.window.size:
+            prefer = self.inputs.preferred() if self.inputs is not None else None
+            (task_id, task) = self.tasks_manager.get_next_task(
+                block=block and not self.in_flight, exclude=self.in_flight, prefer=prefer)
+            if task_id is None:
+                break
+            batch.append((task_id, task))
+            self.in_flight[task_id] = (task, None, None)
+        self.ready_time = time.monotonic()
+        return batch
+
+    def batch_sent(self, batch):
+        """ Record the time a batch was sent at.
+        """
+        sent_time = time.monotonic()
+        for (task_id, task) in batch:
+            self.in_flight[task_id] = (task, self.ready_time, sent_time)
+
+    def result_received(self, msg_type, header):
+        """ Handle the header of a result,
+        and return the (task_id, task, cancelled, timings) it is the result of.
+        A task cancelled (or failed on the client) comes with an empty result.
+        timings are the times of the phases of the task so far
+        if the tasks manager traces them (None otherwise).
+        """
+        if msg_type != TASK_RESULT:
+            raise RuntimeError("unexpected message type {}".format(msg_type))
+        (task_id, wait, duration, status) = unpack_result_header(header)
+        if task_id not in self.in_flight:
+            raise RuntimeError("unexpected result of task {}".format(task_id))
+        (task, ready_time, sent_time) = self.in_flight.pop(task_id)
+        now = time.monotonic()
+        cancelled = not result_done(status)
+        if not cancelled:
+            self.window.record(now - sent_time, wait, duration)
+        timings = None
+        if self.tasks_manager.tracer is not None:
+            timings = {'send': (ready_time, sent_time)}
+            add_client_timings(timings, now, wait, duration)
+        return (task_id, task, cancelled, timings)
+
+    def give_back(self):
+        """ Give back to the tasks manager what this client will never do.
+        """
+        if self.send_cancel is not None:
+            self.tasks_manager.remove_cancel_listener(self.cancel)
+        for task_id in self.in_flight:
+            self.tasks_manager.update(task_id, False, None)
+        self.in_flight.clear()
+
+
+def pack_tasks_batch(batch, inputs=None):
+    """ Encode a list of (task_id, task) into a batch message.
+    Each task is its id (4 bytes little), its type (1 byte),
+    and its command (prefixed by its size on 4 bytes little).
+    If inputs is given (a staging.ClientInputs), each task is followed
+    by its inputs (see ClientInputs.describe) in JSON,
+    prefixed by their size on 4 bytes little.
+    """
+    parts = []
+    for (task_id, task) in batch:
+        cmd_msg = str.encode(task.command)
+        parts.append(task_id.to_bytes(4, 'little'))
+        parts.append(task.task_type.to_bytes(1, 'little'))
+        parts.append(len(cmd_msg).to_bytes(4, 'little'))
+        parts.append(cmd_msg)
+        if inputs is not None:
+            inputs_msg = json.dumps(inputs.describe(task)).encode()
+            parts.append(len(inputs_msg).to_bytes(4, 'little'))
+            parts.append(inputs_msg)
+    return b''.join(parts)
 
-def handle_work(client_socket):
+def unpack_tasks_batch(msg_bytes, with_inputs=False):
+    """ Decode a batch message into a list of (task_id, task),
+    whose inputs are (path, hash, size) if sent with them.
+    """
+    batch = []
+    offset = 0
+    while offset < len(msg_bytes):
+        task_id = int.from_bytes(msg_bytes[offset:offset+4], 'little')
+        task_type = msg_bytes[offset+4]
+        cmd_length = int.from_bytes(msg_bytes[offset+5:offset+9], 'little')
+        offset += 9
+        cmd_msg = bytes(msg_bytes[offset:offset+cmd_length])
+        offset += cmd_length
+        inputs = ()
+        if with_inputs:
+            inputs_length = int.from_bytes(msg_bytes[offset:offset+4], 'little')
+            offset += 4
+            inputs = [tuple(task_input) for task_input in json.loads(bytes(msg_bytes[offset:offset+inputs_length]).decode())]
+            offset += inputs_length
+        batch.append((task_id, Task(cmd_msg, None, task_type, inputs)))
+    return batch
+
+def pack_result_header(task_id, wait, duration, status=RESULT_DONE):
+    """ Encode the header sent before the result of a task of a batch:
+    the task id (4 bytes little), then the time it waited on the client
+    and the time it took to execute, in microseconds (8 bytes little each),
+    and the status of the task (1 byte).
+    """
+    return task_id.to_bytes(4, 'little') + \
+        int(wait * 1e6).to_bytes(8, 'little') + \
+        int(duration * 1e6).to_bytes(8, 'little') + \
+        status.to_bytes(1, 'little')
+
+def unpack_result_header(header):
+    """ Decode a result header into (task_id, wait, duration, status).
+    """
+    task_id = int.from_bytes(header[0:4], 'little')
+    wait = int.from_bytes(header[4:12], 'little') / 1e6
+    duration = int.from_bytes(header[12:20], 'little') / 1e6
+    # Clients older than the status always sent tasks done.
+    status = header[20] if len(header) > 20 else RESULT_DONE
+    return (task_id, wait, duration, status)
+
+def result_done(status):
+    """ Whether the status of a result header says the task is done (its result follows).
+    Any other status (cancelled, failed, or unknown) means it is to be given again.
+    """
+    return status == RESULT_DONE
+
+
+class PrefetchWindow:
+    """ Number of tasks to keep in flight on a client.
+    When adaptive, it is tuned so that the client always has a task
+    ready while the result of the previous one travels back to the server
+    and the next one travels to the client:
+    1 + round trip time / task duration, up to max_size.
+    For a client executing several tasks at the same time (slots),
+    everything is multiplied by its number of slots.
+    """
+    def __init__(self, max_size, adaptive=True, smoothing=0.2, slots=1):
+        self.max_size = max_size
+        self.adaptive = adaptive
+        self.slots = slots
+        self.size = slots if adaptive else max_size * slots
+        self.smoothing = smoothing
+        # Exponential moving averages of the round trip time and tasks durations.
+        self.rtt = None
+        self.duration = None
+
+    def record(self, latency, wait, duration):
+        """ Record the measures of a task: the time between sending it and
+        receiving its result, the time it waited on the client
+        and the time it took to execute.
+        """
+        rtt = max(latency - wait - duration, 0.0)
+        self.rtt = self.smooth(self.rtt, rtt)
+        self.duration = self.smooth(self.duration, duration)
+        if self.adaptive:
+            if self.duration > 0:
+                size = 1 + math.ceil(self.rtt / self.duration)
+            else:
+                size = self.max_size
+            self.size = max(1, min(size, self.max_size)) * self.slots
+
+    @classmethod
+    def for_client(cls, prefetch, adaptive, slots):
+        """ The window of a client, from the prefetch asked for the server:
+        clients executing several tasks at the same time are always sent batches,
+        and are kept busy on all their slots without prefetch.
+        """
+        if prefetch > 0:
+            return cls(prefetch, adaptive, slots=slots)
+        return cls(1, False, slots=slots)
+
+    def smooth(self, average, value):
+        """ Update an exponential moving average with a new value.
+        """
+        if average is None:
+            return value
+        return (1 - self.smoothing) * average + self.smoothing * value
+
+
+def handle_work(connection, slots=None, inputs_cache=None):
     """ Handle a task on a client machine.
     First wait for a task, then execute the task,
     finally return the results to the server.
+    If the server sends a batch of tasks, handle them all,
+    executing several at the same time if slots is given,
+    with their inputs staged from inputs_cache if the server sends them
+    (see handle_batch).
     Return True if everything went well.
+    KeyboardInterrupt is raised again once the connection is closed.
     """
     work_done = False
     try:
         # Wait for a task.
         print("waiting for work ...")
-        (task_type, cmd_msg) = client.recv_typed_msg(client_socket)
+        (task_type, cmd_msg) = connection.recv_typed_msg()
+        if task_type == TASKS_BATCH:
+            handle_batch(connection, unpack_tasks_batch(cmd_msg, connection.staging), slots, inputs_cache)
+            return True
+        if task_type == CANCEL:
+            # Too late, the task is already done.
+            return True
 
         # Now execute the task.
         print("working ...")
-        task = Task(cmd_msg, None, task_type)
-        result = task.execute()
+        task = Task(bytes(cmd_msg), None, task_type)
+        if connection.heartbeat is None:
+            # The server knows nothing about heartbeats nor cancellations.
+            result = task.execute()
+        else:
+            start = time.perf_counter()
+            (result, cancelled) = execute_cancellable(connection, {}, 0, task)
+            connection.send_typed_msg(TASK_RESULT, pack_result_header(0, 0,
+                time.perf_counter() - start, RESULT_CANCELLED if cancelled else RESULT_DONE))
 
         # Finally return the results.
         print("sending back result ...")
-        client.send_sized_msg(client_socket, result)
+        send_result(connection, result, task.task_type)
         print("done")
         work_done = True
 
-    except RuntimeError as err:
+    except (RuntimeError, OSError) as err:
         print("Runtime Error: {}".format(err))
-        client_socket.close()
+        connection.close()
 
     except KeyboardInterrupt:
         print("Client stopped by user.")
-        client_socket.close()
+        connection.close()
+        raise
 
     return work_done
 
 
+def handle_batch(connection, batch, slots=None, inputs_cache=None):
+    """ Execute a batch of tasks, up to slots.number at the same time
+    (one after the other if slots is None), sending each result back
+    as soon as it is ready, tagged with the id of its task
+    (or that it failed, if its result cannot be read).
+    Batches prefetched by the server meanwhile are queued
+    to keep the client busy, and tasks cancelled by the server
+    are dropped from the queue or killed if already running.
+    If the server sends the inputs of tasks, the ones missing from
+    inputs_cache (a staging.InputsCache) are asked for, and each task
+    starts once its inputs are there, in a directory they are staged in.
+    Heartbeats are sent while tasks execute if the server expects them.
+    """
+    if slots is None:
+        slots = Slots()
+    heartbeat = connection.heartbeat
+    next_heartbeat = time.monotonic() + heartbeat if heartbeat else None
+    # Tasks to execute in order: task_id -> (task, time received)
+    queue = collections.OrderedDict()
+    received_time = time.perf_counter()
+    for (task_id, task) in batch:
+        queue[task_id] = (task, received_time)
+    fetch_inputs(connection, inputs_cache, batch)
+    # Tasks executing: task_id -> Execution
+    running = {}
+    try:
+        while queue or running:
+            # Start as many tasks (whose inputs are there) as there are free slots.
+            while queue and slots.free(len(running)):
+                task_id = next((task_id for (task_id, (task, _)) in queue.items()
+                    if inputs_cache is None or inputs_cache.ready(task)), None)
+                if task_id is None:
+                    break
+                (task, received_time) = queue.pop(task_id)
+                print("working ...")
+                cwd = inputs_cache.stage(task) if inputs_cache is not None and task.inputs else None
+                running[task_id] = Execution(task, received_time, cwd)
+            # Wait for a task to finish, a message of the server, or the next heartbeat.
+            waited = [connection] + [execution for execution in running.values() if execution.exit_fd is not None]
+            timeout = None
+            if len(waited) <= len(running):
+                timeout = EXIT_POLL_INTERVAL
+            elif queue and slots.limited():
+                timeout = SLOTS_CHECK_INTERVAL
+            if next_heartbeat is not None:
+                until_heartbeat = max(0, next_heartbeat - time.monotonic())
+                timeout = until_heartbeat if timeout is None else min(timeout, until_heartbeat)
+            readable = select.select(waited, [], [], timeout)[0]
+            if connection in readable:
+                task_id = handle_message(connection, queue, inputs_cache)
+                if task_id in running:
+                    execution = running.pop(task_id)
+                    execution.kill()
+                    release_inputs(inputs_cache, execution)
+                    print("cancelled")
+                    connection.send_typed_msg(TASK_RESULT, pack_result_header(task_id, 0, 0, RESULT_CANCELLED))
+                    connection.send_stream(None)
+            for (task_id, execution) in list(running.items()):
+                if execution.finished():
+                    del running[task_id]
+                    status = RESULT_DONE
+                    try:
+                        (result, wait, duration) = execution.finish()
+                    except OSError as err:
+                        # E.g. a missing result file: only this task fails.
+                        print("Runtime Error: {}".format(err))
+                        (result, wait, duration, status) = (None, 0, 0, RESULT_FAILED)
+                    print("sending back result ...")
+                    connection.send_typed_msg(TASK_RESULT, pack_result_header(task_id, wait, duration, status))
+                    send_result(connection, result, execution.task.task_type, execution.cwd)
+                    release_inputs(inputs_cache, execution)
+                    print("done")
+            if next_heartbeat is not None and time.monotonic() >= next_heartbeat:
+                # Tasks only queued are waiting for their inputs.
+                if running or queue:
+                    connection.send_typed_msg(client.HEARTBEAT, None)
+                next_heartbeat = time.monotonic() + heartbeat
+    finally:
+        for execution in running.values():
+            execution.kill()
+            release_inputs(inputs_cache, execution)
+
+
+def handle_message(connection, queue, inputs_cache=None):
+    """ Handle a message of the server received while executing a batch:
+    queue the tasks of a new batch, receive an input file into inputs_cache
+    (or fail the tasks reading one the server cannot send), or cancel a task.
+    return: the id of a cancelled task which is not in the queue (None otherwise).
+    """
+    (msg_type, msg_bytes) = connection.recv_typed_msg()
+    if msg_type == TASKS_BATCH:
+        received_time = time.perf_counter()
+        batch = unpack_tasks_batch(msg_bytes, connection.staging)
+        for (task_id, task) in batch:
+            queue[task_id] = (task, received_time)
+        fetch_inputs(connection, inputs_cache, batch)
+        return None
+    if msg_type == INPUT_DATA and inputs_cache is not None:
+        inputs_cache.receive(connection, msg_bytes.decode())
+        return None
+    if msg_type == INPUT_MISSING and inputs_cache is not None:
+        file_hash = msg_bytes.decode()
+        inputs_cache.missing(file_hash)
+        # Tasks are only started once their inputs are there.
+        for (task_id, (task, _)) in list(queue.items()):
+            if any(input_hash == file_hash for (_, input_hash, _) in task.inputs):
+                del queue[task_id]
+                inputs_cache.unpin(task)
+                print("input missing")
+                connection.send_typed_msg(TASK_RESULT, pack_result_header(task_id, 0, 0, RESULT_FAILED))
+                connection.send_stream(None)
+        return None
+    if msg_type == CANCEL:
+        task_id = int.from_bytes(msg_bytes, 'little')
+        if task_id not in queue:
+            return task_id
+        # Not started yet, just tell the server it will not be done.
+        (task, _) = queue.pop(task_id)
+        if inputs_cache is not None:
+            inputs_cache.unpin(task)
+        connection.send_typed_msg(TASK_RESULT, pack_result_header(task_id, 0, 0, RESULT_CANCELLED))
+        connection.send_stream(None)
+        return None
+    raise RuntimeError("unexpected message type {}".format(msg_type))
+
+
+def fetch_inputs(connection, inputs_cache, batch):
+    """ Keep the inputs of the tasks of a batch in the cache of inputs (if any)
+    until they are done, and ask the server for the ones missing.
+    """
+    if inputs_cache is None or not connection.staging:
+        return
+    missing = []
+    for (_, task) in batch:
+        missing.extend(inputs_cache.pin(task))
+    if missing:
+        connection.send_typed_msg(FETCH_INPUTS, json.dumps(missing).encode())
+
+
+def release_inputs(inputs_cache, execution):
+    """ Remove the directory a task was executed in (if staged),
+    and let its inputs be evicted from the cache.
+    """
+    if inputs_cache is not None and execution.cwd is not None:
+        shutil.rmtree(execution.cwd, ignore_errors=True)
+    if inputs_cache is not None and execution.task.inputs:
+        inputs_cache.unpin(execution.task)
+
+
+def execute_cancellable(connection, queue, task_id, task):
+    """ Execute a task while handling the messages of the server,
+    killing the task if the server cancels it,
+    and sending heartbeats if the server expects them.
+    return: (result, cancelled) where result is as returned by Task.execute.
+    """
+    heartbeat = connection.heartbeat
+    next_heartbeat = time.monotonic() + heartbeat if heartbeat else None
+    execution = Execution(task)
+    try:
+        while not execution.finished():
+            if next_heartbeat is not None and time.monotonic() >= next_heartbeat:
+                connection.send_typed_msg(client.HEARTBEAT, None)
+                next_heartbeat += heartbeat
+            # Wait for the end of the task and the server at the same time when possible.
+            if execution.exit_fd is not None:
+                timeout = None if next_heartbeat is None else max(0, next_heartbeat - time.monotonic())
+                readable = select.select([connection, execution], [], [], timeout)[0]
+            else:
+                readable = select.select([connection], [], [], EXIT_POLL_INTERVAL)[0]
+            if connection in readable and handle_message(connection, queue) == task_id:
+                execution.kill()
+                return (None, True)
+    except BaseException:
+        execution.kill()
+        raise
+    return (execution.finish()[0], False)
+
+
+class Execution:
+    """ A task executing in its own process (see Task.start), in the directory cwd
+    (the current one if None), whose end can be waited for with select
+    through a pidfd where possible.
+    """
+    def __init__(self, task, received_time=None, cwd=None):
+        self.task = task
+        self.cwd = cwd
+        self.start_time = time.perf_counter()
+        self.received_time = received_time if received_time is not None else self.start_time
+        (self.process, self.stdout) = task.start(cwd)
+        self.exit_fd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                self.exit_fd = os.pidfd_open(self.process.pid)
+            except OSError:
+                pass
+
+    def fileno(self):
+        return self.exit_fd
+
+    def finished(self):
+        return self.process.poll() is not None
+
+    def close(self):
+        if self.exit_fd is not None:
+            os.close(self.exit_fd)
+            self.exit_fd = None
+
+    def kill(self):
+        """ Kill the task, with all the processes it started.
+        """
+        kill_process(self.process)
+        self.stdout.close()
+        self.close()
+
+    def finish(self):
+        """ Get the result of the finished task (see Task.finish).
+        return: (result, time it waited before executing, time it took to execute)
+        """
+        end_time = time.perf_counter()
+        self.close()
+        return (self.task.finish(self.stdout, self.cwd), self.start_time - self.received_time, end_time - self.start_time)
+
+
+class Slots:
+    """ The number of tasks a client executes at the same time:
+    up to number, but no more while the load average of the machine
+    would go above max_load, or while less than min_memory bytes
+    of memory are available (one task always executes).
+    """
+    def __init__(self, number=1, max_load=None, min_memory=None):
+        self.number = number
+        self.max_load = max_load
+        self.min_memory = min_memory
+
+    def limited(self):
+        """ Whether the number of free slots depends on the state of the machine.
+        """
+        return self.max_load is not None or self.min_memory is not None
+
+    def free(self, running):
+        """ Whether another task can start while running tasks execute.
+        """
+        if running >= self.number:
+            return False
+        if running == 0:
+            return True
+        # The load average only catches up with the tasks started slowly.
+        if self.max_load is not None and max(os.getloadavg()[0], running) + 1 > self.max_load:
+            return False
+        if self.min_memory is not None and available_memory() < self.min_memory:
+            return False
+        return True
+
+
+def available_memory():
+    """ Memory available for new processes, in bytes.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def kill_process(process):
+    """ Kill a task started by Task.start, with all the processes it started.
+    """
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+
+def send_result(connection, result, task_type, cwd=None):
+    """ Stream the result of a task (an open binary file or None)
+    to the server and close it, compressed if negotiated for its type of task.
+    Through a unix socket, the result file of a FILE_OUT task
+    (executed in the directory cwd) is handed over by path instead.
+    """
+    if result is None:
+        connection.send_stream(None)
+    elif connection.local and task_type == FILE_OUT:
+        with result:
+            send_result_path(connection, result.name, cwd)
+    else:
+        with result:
+            connection.send_stream(result, codec=connection.codecs.get(task_type))
+
+
+# Suffix of the files handed over to a server on the same machine.
+HANDOFF_SUFFIX = '.result'
+
+def send_result_path(connection, path, cwd=None):
+    """ Hand a result file over to a server on the same machine: the file is renamed
+    to a path of its own, sent (as the JSON {"path": path}) for the server to move it
+    into the results, so that a task writing the same path again cannot change them.
+    A result in the directory cwd, which is removed once the task is done,
+    is renamed next to it (to cwd.result), and any other one in its directory.
+    """
+    path = os.path.abspath(os.fsdecode(path))
+    if cwd is not None and os.path.commonpath([path, os.path.abspath(cwd)]) == os.path.abspath(cwd):
+        handoff = os.path.abspath(cwd) + HANDOFF_SUFFIX
+    else:
+        (directory, basename) = os.path.split(path)
+        (fd, handoff) = tempfile.mkstemp(prefix=basename+'.', suffix=HANDOFF_SUFFIX, dir=directory)
+        os.close(fd)
+    os.replace(path, handoff)
+    msg = json.dumps({'path': handoff}).encode()
+    connection.send_msg(connection.encode_length(len(msg)), msg, connection.encode_length(0))
+
+
+def adopt_result_file(temp_path, handoff, owner):
+    """ Move to temp_path the result file handed over by a client on the same machine
+    (see send_result_path), running as the user owner. Only a regular file of this user,
+    named as handed over, is accepted: it is checked again once moved, since the client
+    may replace it meanwhile (e.g. by a symbolic link). It is copied instead
+    if it cannot be moved (e.g. from another filesystem), then removed if possible.
+    """
+    try:
+        path = json.loads(handoff.decode())['path']
+    except (ValueError, KeyError, TypeError) as err:
+        raise RuntimeError("invalid result handoff: {}".format(err))
+    if not isinstance(path, str) or not os.path.isabs(path) or not path.endswith(HANDOFF_SUFFIX):
+        raise RuntimeError("invalid result handoff path: {!r}".format(path))
+    def check(info):
+        if not stat.S_ISREG(info.st_mode) or owner is None or info.st_uid != owner:
+            raise RuntimeError("result handoff rejected, not a file of the client: {}".format(path))
+    check(os.lstat(path))
+    try:
+        os.replace(path, temp_path)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EACCES, errno.EPERM):
+            raise
+    else:
+        try:
+            check(os.lstat(temp_path))
+        except RuntimeError:
+            os.remove(temp_path)
+            raise
+        return
+    # Neither following a symbolic link nor blocking on a fifo.
+    with open(os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK), 'rb') as source:
+        check(os.fstat(source.fileno()))
+        with open(temp_path, 'wb') as destination:
+            shutil.copyfileobj(source, destination, client.CHUNK_SIZE)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def parse_task_line(line):
+    """ Split a line of a tasks file into its command and its annotations.
+    Annotations are written at the end of the line, in a bash comment
+    starting with "#dc:", as key=value pairs separated by spaces:
+        command  #dc: inputs=data/a.png,data/b.png timeout=60 cost=12.5 id=coseg after=prepare
+    return: (command, annotations dict)
+    """
+    annotations = {}
+    line = line.strip()
+    marker = line.rfind('#dc:')
+    if marker == 0 or (marker > 0 and line[marker-1].isspace()):
+        for pair in line[marker+4:].split():
+            (key, _, value) = pair.partition('=')
+            annotations[key] = value
+        line = line[:marker].rstrip()
+    return (line, annotations)
+
+
+# Directories of results already created.
+CREATED_DIRECTORIES = set()
+
+def make_directories(directory):
+    """ Create a directory hierarchy if needed,
+    only looking for it on disk the first time.
+    """
+    if directory not in CREATED_DIRECTORIES:
+        os.makedirs(os.path.abspath(directory), exist_ok=True)
+        CREATED_DIRECTORIES.add(directory)
+
+
 class Task:
     """ A Task is composed of a command (one line of bash) and a type.
     The type describes the type of results expected.
     Results can be nothing, stdout or a file.
+    A task may also declare the files it reads (inputs),
+    the time after which it is cancelled (timeout, in seconds),
+    the time it is expected to take (cost, in seconds),
+    a name shared with other tasks (label), and the labels of the tasks
+    to be done before it is started (after).
     """
-    def __init__(self, command, result_filepath=None, task_type=STD_OUT):
+    __slots__ = ('command', 'result_filepath', 'task_type', 'inputs', 'timeout', 'cost', 'label', 'after')
+
+    def __init__(self, command, result_filepath=None, task_type=STD_OUT, inputs=(), timeout=None, cost=None,
+            label=None, after=()):
         self.command = command
         self.result_filepath = result_filepath
         self.task_type = task_type
+        self.inputs = inputs
+        self.timeout = timeout
+        self.cost = cost
+        self.label = label
+        self.after = after
         # Create the directory hierarchy
         if result_filepath is not None:
-            basedir = os.path.abspath(os.path.dirname(result_filepath))
-            if not os.path.exists(basedir):
-                os.makedirs(basedir)
+            make_directories(os.path.dirname(result_filepath))
 
-    def send_through(self, client_socket):
+    def send_through(self, connection):
         """ Send a task through a client socket to give work to a client computer.
         """
         task_sent = False
         try:
             cmd_msg = str.encode(self.command)
-            client.send_typed_msg(client_socket, self.task_type, cmd_msg)
+            connection.send_typed_msg(self.task_type, cmd_msg)
             task_sent = True
-        except RuntimeError as err:
+        except (RuntimeError, OSError) as err:
             print("Runtime Error: {}".format(err))
-            client_socket.close()
+            connection.close()
         except KeyboardInterrupt:
             print("Client stopped by user.")
-            client_socket.close()
+            connection.close()
         return task_sent
 
-    def retrieve_result(self, client_socket):
+    def retrieve_result(self, connection):
         """ Retrieve the results sent back by a client
         and process it depending on the task type.
+        The result is streamed into a temporary file next to the result file,
+        whose path is returned (None for a NO_OUT task, see received_result).
         """
         msg_retrieved = False
-        msg = None
+        temp_file = None
         try:
-            # First receive the results message.
-            msg_bytes = client.recv_sized_msg(client_socket)
-            if msg_bytes is None:
-                if self.task_type == NO_OUT:
-                    msg_retrieved = True
+            temp_file = self.open_result_file()
+            if temp_file is None:
+                # Nothing is expected, just consume the (empty) stream.
+                connection.recv_stream(None)
+            elif connection.local and self.task_type == FILE_OUT:
+                # Only the path of the result file is sent.
+                handoff = io.BytesIO()
+                with temp_file:
+                    connection.recv_stream(handoff)
+                adopt_result_file(temp_file.name, handoff.getvalue(), connection.peer_uid)
             else:
-                # Then process it depending on the task type.
-                # For a STD_OUT task, just transform the bytes to string.
-                if self.task_type == STD_OUT:
-                    msg = msg_bytes.decode()
-                # For a FILE_OUT task, write the bytes to a temporary file,
-                # and return its filepath.
-                elif self.task_type == FILE_OUT:
-                    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                        temp_path = temp_file.name
-                        temp_file.write(msg_bytes)
-                    msg = temp_path
-                msg_retrieved = True
-        except RuntimeError as err:
+                with temp_file:
+                    connection.recv_stream(temp_file, connection.codecs.get(self.task_type))
+            msg_retrieved = True
+        except (RuntimeError, OSError) as err:
             print("Runtime Error: {}".format(err))
-            client_socket.close()
+            connection.close()
         except KeyboardInterrupt:
             print("Client stopped by user.")
-            client_socket.close()
+            connection.close()
+        msg = self.received_result(temp_file) if temp_file is not None else None
+        if not msg_retrieved and msg is not None:
+            self.discard_result(msg)
+            msg = None
         # Finally return the results.
         return (msg_retrieved, msg)
 
+    def open_result_file(self):
+        """ Open the temporary binary file receiving the result (None for a NO_OUT task).
+        It is next to the result file, so that it is saved by a simple rename.
+        """
+        if self.task_type == NO_OUT:
+            return None
+        (basedir, basename) = os.path.split(os.path.abspath(self.result_filepath))
+        return tempfile.NamedTemporaryFile(dir=basedir, prefix='.' + basename + '.',
+            suffix='.part', delete=False)
+
+    def received_result(self, temp_file):
+        """ The result received into the file opened by open_result_file, once closed:
+        the path of the temporary file, to be given to save_result or discard_result.
+        """
+        return temp_file.name
+
+    def discard_result(self, result):
+        """ Drop a result not to be saved (received again, or partially).
+        """
+        os.remove(result)
+
     def save_result(self, result):
         """ Save the result into the appropriate file.
+        The result is the path of the temporary file it was received in,
+        atomically renamed into the result file.
         """
-        # If the task type is STD_OUT the result is a string.
-        if self.task_type == STD_OUT:
-            with open(self.result_filepath, 'w') as f:
-                f.write(result)
-        # If the task type is FILE_OUT the result is temporary filepath.
-        elif self.task_type == FILE_OUT:
-            shutil.copy(result, self.result_filepath)
+        if result is not None:
+            # Not following a symbolic link which would have replaced it.
+            fd = os.open(result, os.O_RDONLY | os.O_NOFOLLOW)
+            try:
+                os.fchmod(fd, RESULT_FILE_MODE)
+            finally:
+                os.close(fd)
+            os.replace(result, self.result_filepath)
 
-    def execute(self):
-        """ Execute a task and get the results in a form of bytes.
+    def start(self, cwd=None):
+        """ Start executing a task in its own process group (to be killed as a whole),
+        in the directory cwd (the current one if None),
+        with its standard output written to a temporary file
+        so that it does not have to fit in memory.
+        return: (process, stdout) to be given to finish once the process is over.
+        """
+        stdout = tempfile.TemporaryFile()
+        process = subprocess.Popen(self.command, shell=True, stdout=stdout, start_new_session=True, cwd=cwd)
+        return (process, stdout)
+
+    def finish(self, stdout, cwd=None):
+        """ Get the results of a task executed by start in a form of an open binary file
+        (None if the task type is NO_OUT). The caller has to close it.
+        The path of a result file is relative to cwd, if the task was executed there.
         """
         result = None
-        # Execute the task.
-        p = subprocess.Popen(self.command, shell=True, stdout=subprocess.PIPE)
-        # Get the standard output.
-        stdout = p.stdout.read()
+        stdout.seek(0)
         # If the task type is STD_OUT, stdout actually is the result.
         if self.task_type == STD_OUT:
             result = stdout
         # If the task type is FILE_OUT,
         # we consider the stdout to be the filepath of the result file.
         elif self.task_type == FILE_OUT:
-            with open(stdout.strip(), 'rb') as f:
-                result = f.read()
+            with stdout:
+                result_path = stdout.read().strip()
+            if cwd is not None:
+                result_path = os.path.join(os.fsencode(cwd), result_path)
+            result = open(result_path, 'rb')
+        else:
+            stdout.close()
         return result
 
+    def execute(self):
+        """ Execute a task and get the results in a form of an open binary file
+        (None if the task type is NO_OUT). The caller has to close it.
+        """
+        (process, stdout) = self.start()
+        try:
+            process.wait()
+        except BaseException:
+            kill_process(process)
+            stdout.close()
+            raise
+        return self.finish(stdout)
+
 
 class TasksManager:
     """ Manages a list of tasks and their states (done, working, ...).
+    Pending tasks are kept in a queue and the number of tasks in each state
+    is counted as they change, so that every operation is O(1)
+    whatever the number of tasks.
+    Once no task is pending, up to max_duplicates tasks running for more than
+    straggler_factor times the median duration of tasks are given again
+    to idle clients (speculative execution): the first result wins
+    and the other client is told to cancel it.
+    Clients working on a task for more than its timeout (or task_timeout
+    if it has none) are told to cancel it. A task not done is given again,
+    unless it already failed max_retries times: it is then given up.
+    If complete is False, tasks are appended to tasks_list while they are
+    given (see add_tasks) until end_tasks is called.
+    The tasks of tasks_list in invalid (a dict task_id -> reason) are given up at once.
+    If a tracer is given, the times spent by tasks in each phase are recorded.
+    Tasks are given in order, or from the most to the least expensive if by_cost
+    is True (see scheduling.expected_cost), from their cost annotations or the
+    durations of the same kind of tasks in the history (if given), which
+    records the durations of the tasks done.
+    If by_inputs is True, clients may ask for tasks reading input files
+    they already hold first (see get_next_task).
+    If dependencies is True, a task coming after labels (see Task) waits until
+    all the tasks with these labels above it in the list are done, and is given
+    up if one of them is: tasks are given as soon as their prerequisites are done,
+    before the tasks not given yet.
+    If writers > 0, the results (files) are saved by that many threads
+    (see result_writer.ResultWriter) while the clients go on with their next
+    task, and tasks are only done once their result is on disk.
+    With a cache, the results of the tasks are looked up in it by a thread
+    as tasks are added (or their prerequisites done), in order: the ones found
+    are done without any client, and the others are given once looked up.
     """
-    def __init__(self, tasks_list):
+    def __init__(self, tasks_list, show_progress=True, journal=None, cache=None,
+            max_duplicates=0, straggler_factor=2.0, task_timeout=None, max_retries=3,
+            complete=True, tracer=None, history=None, by_cost=False, by_inputs=False,
+            dependencies=False, writers=0, invalid=None):
         self.tasks_list = tasks_list
+        self.tracer = tracer
+        self.history = history
+        # Results of tasks done in previous runs are taken from the cache (if any)
+        # instead of giving the tasks to clients.
+        self.cache = cache
         # A task status can be:
         # 0: Nothing done with it.
         # 1: Some thread working on it.
         # 2: Done.
-        self.tasks_status = [0] * len(tasks_list)
-        self.tasks_results = [None] * len(tasks_list)
+        # 3: Given up, after failing too many times.
+        # 4: Waiting for the tasks it comes after.
+        # 5: Being looked up in the cache.
+        # When a journal of a previous run is given, the tasks it recorded
+        # done are not done again.
+        self.journal = journal
+        self.tasks_status = bytearray()
+        # Statuses recorded by the journal, taken as tasks are added.
+        self.replayed = journal.replay() if journal is not None else bytearray()
+        # Tasks with status 0 are given in order, looking for them from next_fresh on,
+        # or from the most expensive one in the ranked heap of (-cost, task_id) if by_cost,
+        # except tasks given back, queued to be given again first.
+        self.next_fresh = 0
+        self.ranked = [] if by_cost else None
+        # Tasks with status 0 reading each input file, if by_inputs: path -> deque of task ids.
+        # Tasks taken from there out of order are skipped when found again.
+        self.inputs_index = {} if by_inputs else None
+        self.pending = collections.deque()
+        # Tasks whose prerequisites are all done, if dependencies (unless by_cost).
+        self.released = collections.deque()
+        # Ids of the tasks with each label, if dependencies: label -> list of task ids
+        # (the ones done are dropped as the list is looked at).
+        self.labels = {} if dependencies else None
+        # Labels some tasks come after without any task above them (taken as done).
+        self.unknown_labels = set()
+        # Tasks waiting for each task: task_id -> list of task ids,
+        # and number of tasks each task with status 4 waits for.
+        self.dependents = {}
+        self.waiting = {}
+        # Tasks with status 5, to be looked up in the cache in order: (task_id, cost if by_cost).
+        self.lookups = collections.deque()
+        self.pending_count = 0
+        self.done_count = 0
+        self.working_count = 0
+        self.failed_count = 0
+        # Number of times tasks failed: task_id -> count (only for tasks which failed).
+        self.failures = {}
+        self.max_retries = max_retries
         self.lock = threading.Lock()
+        # Notified whenever a task goes back to pending or everything is done.
+        self.task_available = threading.Condition(self.lock)
+        # Notified once every task is done or given up (for the ones waiting
+        # for the end of the run not to take the wake ups of task_available).
+        self.all_done = threading.Condition(self.lock)
+        # Notified whenever tasks are to be looked up in the cache.
+        self.lookup_ready = threading.Condition(self.lock)
+        # Whether all tasks are known.
+        self.complete = False
+        self.tasks_listeners = set()
+        # Tasks being worked on:
+        # task_id -> [time given, number of clients on it, timed out]
+        self.running = {}
+        # Tasks whose result arrived while other clients still work on them:
+        # task_id -> number of these clients, whose results are ignored.
+        self.settled = {}
+        # Durations of the last tasks done, from the time they were given.
+        self.durations = collections.deque(maxlen=1000)
+        self.max_duplicates = max_duplicates
+        self.straggler_factor = straggler_factor
+        self.duplicates_count = 0
+        # Called with the id of a task done while other clients still work on it,
+        # or timed out, and whether it timed out.
+        self.cancel_listeners = set()
+        # Tasks running for too long are looked for regularly by a thread.
+        self.task_timeout = task_timeout
+        self.closed = threading.Event()
+        self.watchdog = None
+        if task_timeout is not None or not complete \
+                or any(task.timeout is not None for task in tasks_list):
+            self.watchdog = threading.Thread(target=self.watch_timeouts, daemon=True)
+            self.watchdog.start()
 
-        # Used to avoid printing several times the last \n when everything is finished
-        self.print_control = {'lock': threading.Lock(), 'finished': False}
-        self.print_progress()
+        # Number of tasks done by each client (named by its address).
+        self.clients_done = collections.Counter()
+        # Tasks whose result is being saved by the writer (still working on them).
+        self.saving = set()
+        self.writer = result_writer.ResultWriter(self, writers) if writers > 0 else None
+        self.resolver = None
+        if cache is not None:
+            self.resolver = threading.Thread(target=self.resolve_cached, daemon=True)
+            self.resolver.start()
+        self.add_tasks(len(tasks_list), invalid)
+        if complete:
+            self.end_tasks()
+        # The progress is reported from its own thread.
+        self.progress = progress.ProgressReporter(self) if show_progress else None
+        if self.progress is not None:
+            self.progress.start()
+
+    def add_tasks(self, number, invalid=None):
+        """ Take into account a number of tasks just appended to the tasks list.
+        The ones in invalid (a dict task_id -> reason) are given up at once
+        (unless already done).
+        """
+        if self.ranked is not None:
+            # Tasks are only added by one thread at a time.
+            start = len(self.tasks_status)
+            costs = [scheduling.expected_cost(self.tasks_list[task_id], self.history)
+                for task_id in range(start, start + number)]
+        if self.labels is not None:
+            start = len(self.tasks_status)
+            declared = [(task.label, task.after) for task in
+                (self.tasks_list[task_id] for task_id in range(start, start + number))]
+        with self.lock:
+            start = len(self.tasks_status)
+            statuses = self.replayed[start:start+number]
+            statuses.extend(bytes(number - len(statuses)))
+            given_up = []
+            unknown = []
+            for (task_id, reason) in (invalid or {}).items():
+                if statuses[task_id - start] != 2:
+                    statuses[task_id - start] = 3
+                    self.failures[task_id] = 0
+                    given_up.append((task_id, reason))
+            if self.labels is not None:
+                unknown = self.link_prerequisites(start, statuses, declared, given_up)
+            if self.cache is not None:
+                for (i, status) in enumerate(statuses):
+                    if status == 0 and self.cache.cacheable(self.tasks_list[start + i]):
+                        statuses[i] = 5
+                        self.lookups.append((start + i, costs[i] if self.ranked is not None else None))
+                self.lookup_ready.notify()
+            self.tasks_status.extend(statuses)
+            self.done_count += statuses.count(2)
+            self.pending_count += statuses.count(0)
+            self.failed_count += statuses.count(3)
+            if self.ranked is not None:
+                for (i, cost) in enumerate(costs):
+                    if statuses[i] == 0:
+                        heapq.heappush(self.ranked, (-cost, start + i))
+                    elif statuses[i] == 4:
+                        self.waiting[start + i][1] = cost
+            if self.inputs_index is not None:
+                for task_id in range(start, start + number):
+                    if statuses[task_id - start] == 0:
+                        for path in self.tasks_list[task_id].inputs:
+                            self.inputs_index.setdefault(path, collections.deque()).append(task_id)
+            if self.tracer is not None:
+                self.tracer.tasks_added(start, time.monotonic())
+            self.task_available.notify_all()
+            listeners = list(self.tasks_listeners)
+        for listener in listeners:
+            listener()
+        for (task_id, label) in unknown:
+            print("\nNo task labelled {} above task {}, taken as done: {}".format(label, task_id, self.tasks_list[task_id].command))
+        for (task_id, reason) in given_up:
+            print("\nGiving up task {}, {}: {}".format(task_id, reason, self.tasks_list[task_id].command))
+
+    def link_prerequisites(self, start, statuses, declared, given_up):
+        """ Find the tasks each task added (from start on) comes after, from their
+        declared (label, after), for the ones not done to wait for their prerequisites:
+        their status is set to 4 in statuses, or to 3 if a prerequisite is given up
+        (appending (task_id, reason) to given_up).
+        A label without any task above is taken as done (e.g. for the tasks
+        of the last phase of a pipeline run on their own).
+        Must be called with the lock held.
+        return: the list of (task_id, label) of the labels first found unknown.
+        """
+        unknown = []
+        def status(task_id):
+            return statuses[task_id - start] if task_id >= start else self.tasks_status[task_id]
+        for (i, (label, after)) in enumerate(declared):
+            task_id = start + i
+            if statuses[i] == 0 and after:
+                prerequisites = set()
+                for name in after:
+                    if name not in self.labels:
+                        if name not in self.unknown_labels:
+                            self.unknown_labels.add(name)
+                            unknown.append((task_id, name))
+                        continue
+                    labelled = [other for other in self.labels[name] if status(other) != 2]
+                    self.labels[name] = labelled
+                    if any(status(other) == 3 for other in labelled):
+                        given_up.append((task_id, "a task labelled {} was given up".format(name)))
+                        break
+                    prerequisites.update(labelled)
+                else:
+                    for other in prerequisites:
+                        self.dependents.setdefault(other, []).append(task_id)
+                    if prerequisites:
+                        statuses[i] = 4
+                        # With the expected cost of the task, if by_cost.
+                        self.waiting[task_id] = [len(prerequisites), None]
+                if given_up and given_up[-1][0] == task_id:
+                    statuses[i] = 3
+                    self.failures[task_id] = 0
+            if label is not None:
+                self.labels.setdefault(label, []).append(task_id)
+        return unknown
+
+    def release_dependents(self, task_id):
+        """ Take into account that a task is done, for the tasks waiting for it.
+        Must be called with the lock held.
+        """
+        for dependent in self.dependents.pop(task_id, ()):
+            if self.tasks_status[dependent] != 4:
+                continue
+            waiting = self.waiting[dependent]
+            waiting[0] -= 1
+            if waiting[0] > 0:
+                continue
+            del self.waiting[dependent]
+            if self.cache is not None and self.cache.cacheable(self.tasks_list[dependent]):
+                self.tasks_status[dependent] = 5
+                self.lookups.append((dependent, waiting[1]))
+                self.lookup_ready.notify()
+            else:
+                self.make_pending(dependent, waiting[1])
+
+    def make_pending(self, task_id, cost=None):
+        """ Give a task from now on, before the tasks not given yet
+        (or by its cost if by_cost).
+        Must be called with the lock held.
+        """
+        self.tasks_status[task_id] = 0
+        self.pending_count += 1
+        if self.ranked is not None:
+            heapq.heappush(self.ranked, (-cost, task_id))
+        else:
+            self.released.append(task_id)
+        if self.inputs_index is not None:
+            for path in self.tasks_list[task_id].inputs:
+                self.inputs_index.setdefault(path, collections.deque()).append(task_id)
+        if self.tracer is not None:
+            self.tracer.requeued(task_id, time.monotonic())
+        self.task_available.notify()
+
+    def resolve_cached(self):
+        """ Look up the tasks with status 5 in the cache, in order, from a thread
+        (the disk is not accessed while giving tasks): the ones found are done
+        without any client, the others are given. The listeners are notified
+        once no task is left to look up, or every LOOKUP_NOTIFY_INTERVAL.
+        """
+        notified = time.monotonic()
+        while True:
+            with self.lookup_ready:
+                while not self.lookups and not self.closed.is_set():
+                    self.lookup_ready.wait()
+                if self.closed.is_set():
+                    return
+                (task_id, cost) = self.lookups.popleft()
+                remaining = len(self.lookups)
+            try:
+                result = self.cache.fetch(self.tasks_list[task_id])
+            except OSError:
+                # E.g. an input file missing, for the task to fail on a client.
+                result = None
+            with self.lock:
+                if result is None:
+                    self.make_pending(task_id, cost)
+                else:
+                    # Done like a task given, not counted in the durations of tasks.
+                    self.tasks_status[task_id] = 1
+                    self.working_count += 1
+                    self.running[task_id] = [None, 1, False]
+            if result is not None:
+                self.update(task_id, True, result)
+            if remaining == 0 or time.monotonic() - notified > LOOKUP_NOTIFY_INTERVAL:
+                notified = time.monotonic()
+                self.notify_saved()
+
+    def give_up_dependents(self, task_id):
+        """ Give up the tasks waiting for a task given up, and the ones waiting for them.
+        Must be called with the lock held.
+        return: the number of tasks given up.
+        """
+        count = 0
+        given_up = [task_id]
+        while given_up:
+            for dependent in self.dependents.pop(given_up.pop(), ()):
+                if self.tasks_status[dependent] == 4:
+                    del self.waiting[dependent]
+                    self.tasks_status[dependent] = 3
+                    self.failures[dependent] = 0
+                    self.failed_count += 1
+                    given_up.append(dependent)
+                    count += 1
+        return count
+
+    def end_tasks(self):
+        """ Take into account that no task will be appended anymore.
+        """
+        with self.lock:
+            self.complete = True
+            self.task_available.notify_all()
+            self.all_done.notify_all()
+            listeners = list(self.tasks_listeners)
+        for listener in listeners:
+            listener()
+
+    def add_tasks_listener(self, listener):
+        """ Call listener (from any thread) whenever tasks are added, all are known,
+        or results are saved by the writer.
+        """
+        with self.lock:
+            self.tasks_listeners.add(listener)
+
+    def remove_tasks_listener(self, listener):
+        with self.lock:
+            self.tasks_listeners.discard(listener)
+
+    def pop_pending(self):
+        """ Take the next task with status 0.
+        Must be called with the lock held, if pending_count > 0.
+        """
+        self.pending_count -= 1
+        while self.pending:
+            task_id = self.pending.popleft()
+            if self.tasks_status[task_id] == 0:
+                return task_id
+        while self.released:
+            task_id = self.released.popleft()
+            if self.tasks_status[task_id] == 0:
+                return task_id
+        if self.ranked is not None:
+            while True:
+                task_id = heapq.heappop(self.ranked)[1]
+                if self.tasks_status[task_id] == 0:
+                    return task_id
+        while self.tasks_status[self.next_fresh] != 0:
+            self.next_fresh += 1
+        self.next_fresh += 1
+        return self.next_fresh - 1
+
+    def pop_preferred(self, prefer):
+        """ Take a task with status 0 reading one of the input files in prefer
+        (looked for in order), if any and if no task given back comes first.
+        Must be called with the lock held, if pending_count > 0.
+        return: its id, or None.
+        """
+        if self.inputs_index is None or self.pending:
+            return None
+        for path in prefer:
+            tasks = self.inputs_index.get(path)
+            while tasks:
+                task_id = tasks.popleft()
+                if self.tasks_status[task_id] == 0:
+                    self.pending_count -= 1
+                    return task_id
+            if tasks is not None:
+                del self.inputs_index[path]
+        return None
+
+    def close(self):
+        """ Close the journal and the cache (if any), keeping track of the tasks done.
+        """
+        self.closed.set()
+        if self.watchdog is not None:
+            self.watchdog.join()
+        if self.resolver is not None:
+            with self.lookup_ready:
+                self.lookup_ready.notify()
+            # It may close the tasks manager itself, through a listener.
+            if self.resolver is not threading.current_thread():
+                self.resolver.join()
+        if self.writer is not None:
+            self.writer.close()
+        if self.progress is not None:
+            self.progress.stop()
+        if self.tracer is not None:
+            self.tracer.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.history is not None:
+            self.history.close()
+        if self.journal is not None:
+            with self.lock:
+                # Keep the statuses of the tasks not added yet as well.
+                statuses = self.tasks_status + self.replayed[len(self.tasks_status):]
+            self.journal.close(statuses)
+
+    def finished(self):
+        """ Return True if every task is done or given up.
+        Must be called with the lock held.
+        """
+        return self.complete and self.done_count + self.failed_count == len(self.tasks_status)
 
     def all_tasks_done(self):
-        """ Return True if every task has the state done.
+        """ Return True if every task has the state done (or given up).
+        """
+        with self.lock:
+            return self.finished()
+
+    def wait_all_tasks_done(self, timeout=None):
+        """ Wait until every task has the state done (or given up).
+        Return False if timeout expired before.
+        """
+        with self.all_done:
+            return self.all_done.wait_for(self.finished, timeout)
+
+    def failed_tasks(self):
+        """ Ids of the tasks given up.
         """
         with self.lock:
-            return all(status==2 for status in self.tasks_status)
+            return [task_id for (task_id, count) in self.failures.items() if self.tasks_status[task_id] == 3]
 
-    def get_next_task(self):
+    def add_cancel_listener(self, listener):
+        with self.lock:
+            self.cancel_listeners.add(listener)
+
+    def remove_cancel_listener(self, listener):
+        with self.lock:
+            self.cancel_listeners.discard(listener)
+
+    def speculating(self):
+        """ Return True if stragglers may still be given to idle clients.
+        """
+        return self.duplicates_count < self.max_duplicates
+
+    def find_straggler(self, exclude=()):
+        """ Find the task worth giving to another client: the one running
+        for the longest time, if it is longer than straggler_factor times
+        the median duration (and it is not already duplicated).
+        Must be called with the lock held.
+        return: its id, or None.
+        """
+        if not self.speculating() or len(self.durations) < SPECULATION_MIN_SAMPLES:
+            return None
+        longest = self.straggler_factor * statistics.median(self.durations)
+        now = time.monotonic()
+        straggler = None
+        for (task_id, (given_time, copies, _)) in self.running.items():
+            if copies > 1 or given_time is None or task_id in exclude \
+                    or self.tasks_status[task_id] != 1 or task_id in self.saving:
+                continue
+            if now - given_time > longest:
+                straggler = task_id
+                longest = now - given_time
+        return straggler
+
+    def get_next_task(self, block=True, timeout=None, exclude=(), prefer=None):
         """ Get the next task to be done.
-        It cannot return a task already in state working.
+        It cannot return a task already in state working,
+        unless it is a straggler given again (see find_straggler)
+        which is not in exclude (the tasks the caller is working on).
+        If prefer is given (paths of input files) and by_inputs is True,
+        a task reading one of them is given first.
+        If every remaining task is in state working, wait until one
+        of them goes back to pending, becomes a straggler, or until all tasks
+        are done (unless block is False or timeout expires).
+        Return (None, None) when there is no task to give.
         """
+        deadline = None if timeout is None else time.monotonic() + timeout
         task_id = None
         task = None
-        with self.lock:
-            # Search for the first not done task.
-            for (i,status) in enumerate(self.tasks_status):
-                if status == 0:
-                    task_id = i
-                    task = self.tasks_list[task_id]
+        with self.task_available:
+            while True:
+                if self.pending_count > 0:
+                    # Update status of the task (to working on it).
+                    if prefer:
+                        task_id = self.pop_preferred(prefer)
+                    if task_id is None:
+                        task_id = self.pop_pending()
+                    self.tasks_status[task_id] = 1
+                    self.working_count += 1
+                    self.running[task_id] = [time.monotonic(), 1, False]
                     break
-            # Update status of the task (to working on it).
+                if self.finished():
+                    break
+                task_id = self.find_straggler(exclude)
+                if task_id is not None:
+                    self.running[task_id][1] += 1
+                    self.duplicates_count += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    break
+                # Wake up from time to time to look for stragglers.
+                if self.speculating():
+                    remaining = SPECULATION_INTERVAL if remaining is None else min(remaining, SPECULATION_INTERVAL)
+                self.task_available.wait(remaining)
             if task_id is not None:
-                self.tasks_status[task_id] = 1
+                task = self.tasks_list[task_id]
         return (task_id, task)
 
-    def update(self, task_id, done, result):
-        """ Update the tasks manager with a task that just changed of state.
+    def update(self, task_id, done, result, client_name=None, timings=None):
+        """ Update the tasks manager with a task that just changed of state
+        (on the client named client_name, if known).
+        timings are the times of the phases of the task measured by the caller,
+        to be traced (see tracing.PHASES).
+        When several clients work on the same task, the first result is kept
+        (the task is no longer running, the results of the others are ignored),
+        and the task only goes back to pending if all of them failed.
+        With a result writer, a result is queued to be saved (waiting while
+        the queue is full), and the task is only done once it is saved (see saved).
         """
+        discarded = False
+        cancelled = False
+        given_up = False
+        dependents_given_up = 0
+        deferred = False
+        duration = None
+        tracing = timings is not None and self.tracer is not None
         with self.lock:
-            self.tasks_status[task_id] = 2 if done else 0
-            self.tasks_results[task_id] = result
+            if task_id in self.settled:
+                # Another client sent its result first.
+                self.settled[task_id] -= 1
+                if self.settled[task_id] == 0:
+                    del self.settled[task_id]
+                (given_time, copies) = (None, 0)
+            else:
+                (given_time, copies, _) = self.running.get(task_id, (None, 1, False))
+                if done or copies == 1:
+                    self.running.pop(task_id, None)
+                else:
+                    self.running[task_id][1] -= 1
+            if tracing and given_time is not None:
+                timings['queue'] = (self.tracer.pending_since(task_id), given_time)
+            if copies == 0 or self.tasks_status[task_id] == 2 or task_id in self.saving:
+                # Already done by another client.
+                discarded = True
+            elif done:
+                if copies > 1:
+                    self.settled[task_id] = copies - 1
+                if self.writer is not None and result is not None:
+                    # Still working on it until it is saved.
+                    self.saving.add(task_id)
+                    deferred = True
+                else:
+                    duration = self.mark_done(task_id, given_time, client_name)
+                # Other clients are still working on it.
+                cancelled = copies > 1
+                listeners = list(self.cancel_listeners) if cancelled else []
+            elif copies == 1:
+                (given_up, dependents_given_up) = self.mark_failed(task_id)
+        if given_up:
+            self.report_given_up(task_id, dependents_given_up)
+        if discarded:
+            if result is not None:
+                self.tasks_list[task_id].discard_result(result)
+            return
+        if cancelled:
+            for listener in listeners:
+                listener(task_id, False)
+        if deferred:
+            self.writer.put(task_id, result, given_time, client_name, timings if tracing else None, time.monotonic())
+            return
+        save_start = time.monotonic() if tracing else None
         if done:
             self.tasks_list[task_id].save_result(result)
-        self.print_progress()
+            self.record_done(task_id, duration)
+        if tracing and given_time is not None:
+            if done:
+                timings['save'] = (save_start, time.monotonic())
+            self.tracer.record(task_id, client_name, 'done' if done else 'failed', timings)
+
+    def mark_done(self, task_id, given_time, client_name):
+        """ Change the status of a task to done.
+        Must be called with the lock held.
+        return: the time since it was given (None if unknown).
+        """
+        duration = None
+        self.tasks_status[task_id] = 2
+        self.working_count -= 1
+        self.done_count += 1
+        if given_time is not None:
+            duration = time.monotonic() - given_time
+            self.durations.append(duration)
+        if client_name is not None:
+            self.clients_done[client_name] += 1
+        if self.labels is not None:
+            self.release_dependents(task_id)
+        if self.finished():
+            self.task_available.notify_all()
+            self.all_done.notify_all()
+        return duration
+
+    def mark_failed(self, task_id):
+        """ Give a task which failed back, or give it up after max_retries failures.
+        Must be called with the lock held.
+        return: (whether it is given up, the number of tasks given up with it).
+        """
+        self.working_count -= 1
+        self.failures[task_id] = self.failures.get(task_id, 0) + 1
+        if self.failures[task_id] > self.max_retries:
+            self.tasks_status[task_id] = 3
+            self.failed_count += 1
+            dependents_given_up = self.give_up_dependents(task_id) if self.labels is not None else 0
+            if self.finished():
+                self.task_available.notify_all()
+                self.all_done.notify_all()
+            return (True, dependents_given_up)
+        self.tasks_status[task_id] = 0
+        # Give it again first, to whoever asks for a task.
+        self.pending.appendleft(task_id)
+        self.pending_count += 1
+        self.task_available.notify()
+        if self.tracer is not None:
+            self.tracer.requeued(task_id, time.monotonic())
+        return (False, 0)
+
+    def report_given_up(self, task_id, dependents_given_up):
+        print("\nGiving up task {} after {} failures: {}".format(
+            task_id, self.max_retries + 1, self.tasks_list[task_id].command))
+        if dependents_given_up:
+            print("\nGiving up {} tasks coming after task {}".format(dependents_given_up, task_id))
 
-    def print_progress(self):
-        """ Print a progress bar representing the current state of the tasks.
+    def record_done(self, task_id, duration):
+        """ Record a task done (and saved) into the cache, the journal and the history.
         """
-        tasks_number = len(self.tasks_status)
-        done = sum(map(lambda x: x == 2, self.tasks_status))
-        working = sum(map(lambda x: x == 1, self.tasks_status))
-        utils.print_progress(self.print_control, tasks_number, done, working)
+        if self.cache is not None:
+            self.cache.store(self.tasks_list[task_id])
+        if self.journal is not None:
+            self.journal.record(task_id, 2)
+        if self.history is not None and duration is not None:
+            self.history.record(self.tasks_list[task_id].command, duration)
+
+    def saved(self, task_id, given_time, client_name, timings, save_start, error=None):
+        """ Take into account a result saved by the result writer (or which
+        could not be saved, if error is given): the task is done (or failed).
+        """
+        duration = None
+        given_up = False
+        dependents_given_up = 0
+        with self.lock:
+            self.saving.discard(task_id)
+            if error is None:
+                duration = self.mark_done(task_id, given_time, client_name)
+            else:
+                (given_up, dependents_given_up) = self.mark_failed(task_id)
+        if error is not None:
+            print("\nError saving the result of task {}: {}".format(task_id, error))
+        if given_up:
+            self.report_given_up(task_id, dependents_given_up)
+        if error is None:
+            self.record_done(task_id, duration)
+        if timings is not None and given_time is not None:
+            if error is None:
+                timings['save'] = (save_start, time.monotonic())
+            self.tracer.record(task_id, client_name, 'done' if error is None else 'failed', timings)
+
+    def notify_saved(self):
+        """ Wake up the listeners once results are saved (or looked up in the cache),
+        as tasks may be done, or given since the tasks they came after are.
+        """
+        with self.lock:
+            listeners = list(self.tasks_listeners)
+        for listener in listeners:
+            listener()
+
+    def watch_timeouts(self):
+        """ Look for tasks running for too long every second,
+        and tell the clients working on them to cancel them.
+        """
+        while not self.closed.wait(1):
+            timed_out = []
+            with self.lock:
+                now = time.monotonic()
+                for (task_id, running) in self.running.items():
+                    (given_time, _, already_timed_out) = running
+                    if self.tasks_status[task_id] != 1 or task_id in self.saving:
+                        continue
+                    timeout = self.tasks_list[task_id].timeout
+                    if timeout is None:
+                        timeout = self.task_timeout
+                    if given_time is not None and timeout is not None \
+                            and not already_timed_out and now - given_time > timeout:
+                        running[2] = True
+                        timed_out.append(task_id)
+                listeners = list(self.cancel_listeners) if timed_out else []
+            for task_id in timed_out:
+                print("\nTask {} timed out: {}".format(task_id, self.tasks_list[task_id].command))
+                for listener in listeners:
+                    listener(task_id, True)
+
+    def progress_state(self):
+        """ A snapshot of the progress of the tasks, to be reported.
+        """
+        with self.lock:
+            return {
+                'total': len(self.tasks_status),
+                'done': self.done_count,
+                'working': self.working_count,
+                'failed': self.failed_count,
+                'complete': self.complete,
+                'finished': self.finished(),
+                'clients': dict(self.clients_done)}
+
+
+class MemoryResult(io.BytesIO):
+    """ A result received in memory, whose content is kept once closed.
+    """
+    def close(self):
+        if not self.closed:
+            self.value = self.getvalue()
+        super().close()
+
+
+class ExecutorTask(Task):
+    """ A task submitted to a ClusterExecutor: its result (the standard output)
+    is received in memory and set on its future, instead of being saved.
+    """
+    __slots__ = ('future',)
+
+    def __init__(self, command, future, inputs=(), timeout=None, cost=None):
+        super().__init__(command, None, STD_OUT, inputs, timeout, cost)
+        self.future = future
+
+    def open_result_file(self):
+        return MemoryResult()
+
+    def received_result(self, temp_file):
+        return temp_file.value
+
+    def discard_result(self, result):
+        pass
+
+    def save_result(self, result):
+        (future, self.future) = (self.future, None)
+        if future is not None and not future.cancelled():
+            future.set_result(result)
+
+    def give_up(self, reason):
+        """ Fail the future of the task (or cancel it if not given yet), unless it is done.
+        """
+        (future, self.future) = (self.future, None)
+        if future is not None and not future.cancel():
+            future.set_exception(RuntimeError("Task {}: {}".format(reason, self.command)))
+
+
+class ExecutorTasksManager(TasksManager):
+    """ The tasks of a ClusterExecutor: the ones whose future is cancelled
+    before they are given are skipped, and the futures of the ones given up fail.
+    """
+    def get_next_task(self, block=True, timeout=None, exclude=(), prefer=None):
+        while True:
+            (task_id, task) = super().get_next_task(block, timeout, exclude, prefer)
+            future = task.future if task is not None else None
+            if future is None or future.running() or future.set_running_or_notify_cancel():
+                return (task_id, task)
+            # Cancelled: done without any client.
+            with self.lock:
+                self.running[task_id][0] = None
+            self.update(task_id, True, None)
+
+    def update(self, task_id, done, result, client_name=None, timings=None):
+        super().update(task_id, done, result, client_name, timings)
+        if not done and self.tasks_status[task_id] == 3:
+            self.tasks_list[task_id].give_up("given up after {} failures".format(self.max_retries + 1))
+
+
+class ClusterExecutor:
+    """ Runs commands on the clients connecting to a server started in a thread
+    on address, with the interface of a concurrent.futures executor:
+    the future of a task gets its standard output (bytes, kept in memory),
+    or fails once the task is given up.
+    Up to max_pending tasks are submitted and not done at a time: submit waits
+    beyond, so that commands can be generated as tasks are done (see map and as_completed).
+    The server is run with engine ('threads' or 'asyncio') and the other options
+    of the servers (see TasksThreadingTCPServer) and tasks managers (see TasksManager).
+    """
+    def __init__(self, address=('', 8080), max_pending=1000, engine='threads',
+            prefetch=0, adaptive_prefetch=True, buffer_size=None, heartbeat=5, compression=None,
+            max_duplicates=0, straggler_factor=2.0, task_timeout=None, max_retries=3):
+        self.max_pending = max_pending
+        self.pending = threading.BoundedSemaphore(max_pending)
+        # Tasks are appended by one thread at a time.
+        self.lock = threading.Lock()
+        self.closed = False
+        self.tasks_list = []
+        self.tasks_manager = ExecutorTasksManager(self.tasks_list, show_progress=False,
+            max_duplicates=max_duplicates, straggler_factor=straggler_factor,
+            task_timeout=task_timeout, max_retries=max_retries, complete=False)
+        if engine == 'asyncio':
+            # Only imported when used.
+            import async_server
+            server_class = async_server.AsyncTasksServer
+        else:
+            server_class = TasksThreadingTCPServer
+        self.server = server_class(address, self.tasks_manager, prefetch, adaptive_prefetch,
+            buffer_size, heartbeat=heartbeat, compression=compression)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        if engine == 'asyncio':
+            # Listening on the address, with its actual port.
+            self.server.ready.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        return False
+
+    def submit(self, command, inputs=(), timeout=None, cost=None):
+        """ Submit a command to be run on a client (with the annotations of Task),
+        waiting while max_pending tasks are not done.
+        return: its future (a concurrent.futures.Future), with the command as attribute.
+        """
+        self.pending.acquire()
+        return self.submit_acquired(command, inputs, timeout, cost)
+
+    def submit_acquired(self, command, inputs=(), timeout=None, cost=None):
+        """ Submit a command once the pending semaphore is acquired (see submit).
+        """
+        future = concurrent.futures.Future()
+        future.command = command
+        future.add_done_callback(lambda _: self.pending.release())
+        with self.lock:
+            if self.closed:
+                self.pending.release()
+                raise RuntimeError("cannot submit tasks after shutdown")
+            self.tasks_list.append(ExecutorTask(command, future, inputs, timeout, cost))
+            self.tasks_manager.add_tasks(1)
+        return future
+
+    def submit_lazily(self, commands, outstanding):
+        """ Submit the next commands of an iterator while it does not have to wait
+        and fewer than max_pending are outstanding (submitted and not consumed
+        by the caller), or wait to submit one if none is outstanding.
+        return: their futures.
+        """
+        futures = []
+        while outstanding + len(futures) < self.max_pending:
+            if not self.pending.acquire(blocking=outstanding + len(futures) == 0):
+                break
+            try:
+                command = next(commands)
+            except StopIteration:
+                self.pending.release()
+                break
+            except BaseException:
+                self.pending.release()
+                raise
+            futures.append(self.submit_acquired(command))
+        return futures
+
+    def map(self, commands, timeout=None):
+        """ Run commands (any iterable, consumed as tasks are done)
+        and yield their standard outputs in order, waiting up to timeout
+        seconds for each one (raising concurrent.futures.TimeoutError).
+        The exception of a task given up is raised when it is reached.
+        """
+        commands = iter(commands)
+        futures = collections.deque()
+        while True:
+            futures.extend(self.submit_lazily(commands, len(futures)))
+            if not futures:
+                return
+            yield futures.popleft().result(timeout)
+
+    def as_completed(self, commands):
+        """ Run commands (any iterable, consumed as tasks are done)
+        and yield their futures as they complete, in any order.
+        """
+        commands = iter(commands)
+        completed = queue.Queue()
+        outstanding = 0
+        while True:
+            futures = self.submit_lazily(commands, outstanding)
+            for future in futures:
+                future.add_done_callback(completed.put)
+            outstanding += len(futures)
+            if outstanding == 0:
+                return
+            yield completed.get()
+            outstanding -= 1
+
+    def shutdown(self, wait=True):
+        """ Stop the server once all the tasks submitted are done if wait is True,
+        otherwise right away: the futures of the tasks not done are cancelled
+        (or fail if they were given).
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.tasks_manager.end_tasks()
+        if wait:
+            self.tasks_manager.wait_all_tasks_done()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.tasks_manager.close()
+        for task in self.tasks_list:
+            task.give_up("executor shut down")
@@ -0,0 +1,339 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import client
+import distributed_computing as dis_comp
+import socketserver
+import threading
+import socket
+import utils
+import json
+import time
+
+# A request sent to the control channel of a daemon server (JSON),
+# and the reply to it, with the same type.
+JOB_REQUEST = 20
+
+# Task ids given to clients are 4 bytes.
+TASK_IDS = 1 << 32
+
+
+class Job:
+    """ A list of tasks submitted to a daemon server, with its own tasks manager.
+    """
+    def __init__(self, job_id, name, tasks_manager):
+        self.job_id = job_id
+        self.name = name
+        self.tasks_manager = tasks_manager
+        self.submit_time = time.monotonic()
+        self.end_time = None
+
+    def status(self):
+        """ The progress of the job, to be reported to the control channel.
+        """
+        state = self.tasks_manager.progress_state()
+        end_time = self.end_time if self.end_time is not None else time.monotonic()
+        return {'job': self.job_id, 'name': self.name, 'total': state['total'],
+            'done': state['done'], 'working': state['working'], 'failed': state['failed'],
+            'finished': self.end_time is not None, 'duration': round(end_time - self.submit_time, 3)}
+
+
+class JobsManager:
+    """ Gives the tasks of several jobs to the clients of a daemon server,
+    with the same interface as a TasksManager, so that the servers
+    hand it to their clients the same way.
+    Workers are shared fairly: a client asking for a task gets one
+    of the job with the fewest tasks being worked on.
+    The tasks given are known by ids of their own (the same for copies
+    of a straggler), only kept while they are worked on.
+    Jobs are closed once all their tasks are done, and the manager never
+    runs out of tasks until close is called.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Notified whenever tasks may be available, with the number of times it was.
+        self.changed = threading.Condition(self.lock)
+        self.version = 0
+        self.jobs = []
+        self.finished_jobs = []
+        self.next_job_id = 1
+        # Tasks given: task id -> (job, task id in the job), and back.
+        self.given = {}
+        self.ids = {}
+        self.next_id = 0
+        self.closed = False
+        self.tasks_listeners = set()
+        self.cancel_listeners = set()
+        # Jobs may share a cache and a history, written when each job is closed.
+        self.closing = threading.Lock()
+        # Jobs are not traced.
+        self.tracer = None
+
+    def submit(self, name, tasks_manager):
+        """ Start giving the tasks of a new job.
+        return: the job.
+        """
+        job = Job(None, name, tasks_manager)
+        def cancel(task_id, timed_out):
+            self.cancel(job, task_id, timed_out)
+        def changed():
+            # The last results may be saved once no client is left.
+            if job.job_id is not None and tasks_manager.all_tasks_done():
+                self.finish(job)
+            self.notify()
+        tasks_manager.add_cancel_listener(cancel)
+        tasks_manager.add_tasks_listener(changed)
+        with self.lock:
+            job.job_id = self.next_job_id
+            self.next_job_id += 1
+            self.jobs.append(job)
+        print("Job {} submitted: {}, {} tasks".format(job.job_id, name, len(tasks_manager.tasks_status)))
+        if tasks_manager.all_tasks_done():
+            self.finish(job)
+        self.notify()
+        return job
+
+    def finish(self, job):
+        """ Close a job whose tasks are all done (only once).
+        """
+        with self.lock:
+            if job not in self.jobs:
+                return
+            self.jobs.remove(job)
+            self.finished_jobs.append(job)
+        with self.closing:
+            job.tasks_manager.close()
+        with self.lock:
+            job.end_time = time.monotonic()
+            self.changed.notify_all()
+        print("Job {} done: {} tasks, {} given up, in {}".format(job.job_id, job.tasks_manager.done_count,
+            job.tasks_manager.failed_count, utils.format_duration(job.end_time - job.submit_time)))
+
+    def job(self, job_id):
+        with self.lock:
+            for job in self.jobs + self.finished_jobs:
+                if job.job_id == job_id:
+                    return job
+        return None
+
+    def status(self):
+        with self.lock:
+            jobs = self.finished_jobs + self.jobs
+        return [job.status() for job in sorted(jobs, key=lambda job: job.job_id)]
+
+    def wait_job_done(self, job, timeout=None):
+        """ Wait until a job is closed.
+        Return False if timeout expired before.
+        """
+        with self.changed:
+            return self.changed.wait_for(lambda: job.end_time is not None or self.closed, timeout)
+
+    def notify(self):
+        """ Wake up the clients waiting for tasks, and the listeners.
+        """
+        with self.lock:
+            self.version += 1
+            self.changed.notify_all()
+            listeners = list(self.tasks_listeners)
+        for listener in listeners:
+            listener()
+
+    def close(self):
+        """ Stop giving tasks: clients waiting for some are told there is none left.
+        The jobs not done yet are closed as they are.
+        """
+        with self.lock:
+            self.closed = True
+            jobs = list(self.jobs)
+            self.jobs.clear()
+        with self.closing:
+            for job in jobs:
+                job.tasks_manager.close()
+        self.notify()
+
+    def finished(self):
+        """ Must be called with the lock held.
+        """
+        return self.closed
+
+    def all_tasks_done(self):
+        with self.lock:
+            return self.closed
+
+    def wait_all_tasks_done(self, timeout=None):
+        with self.changed:
+            return self.changed.wait_for(self.finished, timeout)
+
+    def add_tasks_listener(self, listener):
+        with self.lock:
+            self.tasks_listeners.add(listener)
+
+    def remove_tasks_listener(self, listener):
+        with self.lock:
+            self.tasks_listeners.discard(listener)
+
+    def add_cancel_listener(self, listener):
+        with self.lock:
+            self.cancel_listeners.add(listener)
+
+    def remove_cancel_listener(self, listener):
+        with self.lock:
+            self.cancel_listeners.discard(listener)
+
+    def cancel(self, job, task_id, timed_out):
+        """ Tell the clients to cancel a task of a job.
+        """
+        with self.lock:
+            given_id = self.ids.get((job, task_id))
+            listeners = list(self.cancel_listeners)
+        if given_id is not None:
+            for listener in listeners:
+                listener(given_id, timed_out)
+
+    def speculating(self):
+        with self.lock:
+            jobs = list(self.jobs)
+        return any(job.tasks_manager.speculating() for job in jobs)
+
+    def get_next_task(self, block=True, timeout=None, exclude=(), prefer=None):
+        """ Get the next task to be done, from the job with the fewest tasks
+        being worked on which has one to give (see TasksManager.get_next_task).
+        If none has, wait until one has (unless block is False or timeout expires).
+        Return (None, None) when there is no task to give.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                if self.closed:
+                    return (None, None)
+                version = self.version
+                jobs = sorted(self.jobs, key=lambda job: job.tasks_manager.working_count)
+                excluded = [self.given[given_id] for given_id in exclude if given_id in self.given]
+            for job in jobs:
+                (task_id, task) = job.tasks_manager.get_next_task(block=False,
+                    exclude={task_id for (other, task_id) in excluded if other is job}, prefer=prefer)
+                if task_id is not None:
+                    return (self.give(job, task_id), task)
+                if job.tasks_manager.all_tasks_done():
+                    self.finish(job)
+            with self.lock:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if self.closed or not block or (remaining is not None and remaining <= 0):
+                    return (None, None)
+                if self.version == version:
+                    # Wake up from time to time to look for stragglers.
+                    if any(job.tasks_manager.speculating() for job in jobs):
+                        remaining = dis_comp.SPECULATION_INTERVAL if remaining is None else min(remaining, dis_comp.SPECULATION_INTERVAL)
+                    self.changed.wait(remaining)
+
+    def give(self, job, task_id):
+        """ The id a task of a job is given with.
+        """
+        with self.lock:
+            given_id = self.ids.get((job, task_id))
+            if given_id is None:
+                while self.next_id in self.given:
+                    self.next_id = (self.next_id + 1) % TASK_IDS
+                given_id = self.next_id
+                self.next_id = (self.next_id + 1) % TASK_IDS
+                self.given[given_id] = (job, task_id)
+                self.ids[(job, task_id)] = given_id
+            return given_id
+
+    def update(self, given_id, done, result, client_name=None, timings=None):
+        """ Update the job of a task given (see TasksManager.update).
+        """
+        with self.lock:
+            (job, task_id) = self.given[given_id]
+        job.tasks_manager.update(task_id, done, result, client_name, timings)
+        with self.lock:
+            # Forget the task once nobody works on it anymore.
+            if task_id not in job.tasks_manager.running:
+                del self.given[given_id]
+                del self.ids[(job, task_id)]
+        if job.tasks_manager.all_tasks_done():
+            self.finish(job)
+        # The task may have been given back.
+        self.notify()
+
+
+class ControlServer(socketserver.ThreadingTCPServer):
+    """ The control channel of a daemon server, to submit jobs to it
+    and follow them. Each connection sends one JOB_REQUEST, answered
+    by a JOB_REQUEST (JSON objects):
+        {"command": "submit", "tasks": path, "results": path, "resultsAreFiles": bool}
+            -> {"job": id}, the job being made by make_job(request) (a TasksManager)
+        {"command": "status"} -> {"jobs": [status of each job]}
+        {"command": "wait", "job": id} -> {"jobs": [status of the job]}, once it is done
+        {"command": "shutdown"} -> {}, then on_shutdown is called.
+    Errors are answered as {"error": message}.
+    """
+    def __init__(self, server_address, jobs_manager, make_job, on_shutdown):
+        self.allow_reuse_address = True
+        self.daemon_threads = True
+        self.jobs_manager = jobs_manager
+        self.make_job = make_job
+        self.on_shutdown = on_shutdown
+        super().__init__(server_address, ControlHandler)
+
+
+class ControlHandler(socketserver.BaseRequestHandler):
+    """ Handles a request sent to the control channel (see ControlServer).
+    """
+    def handle(self):
+        connection = client.Connection(self.request)
+        shutdown = False
+        try:
+            (msg_type, msg_bytes) = connection.recv_typed_msg()
+            if msg_type != JOB_REQUEST:
+                raise RuntimeError("unexpected message type {}".format(msg_type))
+            request = json.loads(msg_bytes.decode())
+            try:
+                (reply, shutdown) = self.answer(request)
+            except (KeyError, ValueError, OSError, AssertionError) as err:
+                reply = {'error': "{}: {}".format(type(err).__name__, err)}
+            connection.send_typed_msg(JOB_REQUEST, json.dumps(reply).encode())
+        except (RuntimeError, OSError) as err:
+            print("Runtime Error: {}".format(err))
+        connection.close()
+        if shutdown:
+            self.server.on_shutdown()
+
+    def answer(self, request):
+        """ return: (reply, whether to shut down the daemon)
+        """
+        jobs_manager = self.server.jobs_manager
+        command = request.get('command')
+        if command == 'submit':
+            job = jobs_manager.submit(request['tasks'], self.server.make_job(request))
+            return ({'job': job.job_id}, False)
+        if command == 'status':
+            return ({'jobs': jobs_manager.status()}, False)
+        if command == 'wait':
+            job = jobs_manager.job(request['job'])
+            if job is None:
+                raise KeyError("no job {}".format(request['job']))
+            jobs_manager.wait_job_done(job)
+            return ({'jobs': [job.status()]}, False)
+        if command == 'shutdown':
+            return ({}, True)
+        raise ValueError("unknown command {}".format(command))
+
+
+def send_request(address, request):
+    """ Send a request to the control channel of a daemon server at address.
+    return: the reply.
+    """
+    connection = client.Connection(socket.create_connection(address))
+    try:
+        connection.send_typed_msg(JOB_REQUEST, json.dumps(request).encode())
+        (msg_type, msg_bytes) = connection.recv_typed_msg()
+        if msg_type != JOB_REQUEST:
+            raise RuntimeError("unexpected message type {}".format(msg_type))
+        return json.loads(msg_bytes.decode())
+    finally:
+        connection.close()
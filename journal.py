@@ -0,0 +1,159 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import hashlib
+import threading
+import struct
+import os
+
+# Both the journal and its index start with a header identifying the run:
+# a magic string, the number of tasks (8 bytes little) and a fingerprint
+# of the tasks (20 bytes).
+MAGIC = b'DCJ1'
+HEADER_SIZE = 4 + 8 + 20
+
+# A record of the journal: the new status of a task (1 byte),
+# and the id of the task (8 bytes little).
+RECORD = struct.Struct('<BQ')
+
+# Statuses which are not worth keeping from a run to the next
+# (working, given up, waiting for other tasks).
+VOLATILE_STATUSES = bytes.maketrans(b'\x01\x03\x04\x05', b'\x00\x00\x00\x00')
+
+
+def tasks_fingerprint(tasks_list):
+    """ Fingerprint of a list of tasks (their commands, results paths and types),
+    used to check that a journal belongs to the same run.
+    """
+    digest = hashlib.sha1()
+    for task in tasks_list:
+        digest.update(task.command.encode() if isinstance(task.command, str) else task.command)
+        digest.update(b'\0' + str(task.result_filepath).encode() + b'\0' + bytes([task.task_type]))
+    return digest.digest()
+
+
+def files_fingerprint(*paths):
+    """ Fingerprint of the files of a run (their paths, sizes and modification times),
+    used instead of tasks_fingerprint when the tasks are read lazily.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        if path is not None:
+            stat = os.stat(path)
+            digest.update('{}\0{}\0{}\0'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode())
+    return digest.digest()
+
+
+class Journal:
+    """ An append-only journal of the state changes of tasks,
+    to resume a run where it stopped.
+    Records are appended as they come, and synced to disk in batches
+    by a thread every sync_interval seconds.
+    The statuses of all tasks are compacted into an index (one byte per task)
+    when the journal is opened and closed, so that recovering only reads
+    the index and the records appended since.
+    tasks_number is 0 if it is not known in advance.
+    """
+    def __init__(self, path, tasks_number, fingerprint, sync_interval=1.0):
+        self.path = path
+        self.index_path = path + '.index'
+        self.header = MAGIC + tasks_number.to_bytes(8, 'little') + fingerprint
+        self.tasks_number = tasks_number
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.fd = None
+        self.dirty = False
+        self.closed = threading.Event()
+        self.sync_thread = None
+
+    def read(self, path):
+        """ Read a file of this run, without its header.
+        return: its content, or None if it does not exist or belongs to another run.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            content = f.read()
+        if content[:HEADER_SIZE] != self.header:
+            print("Ignoring {}, it belongs to another run".format(path))
+            return None
+        return content[HEADER_SIZE:]
+
+    def replay(self):
+        """ Recover the statuses of the tasks from the index and the journal,
+        then start a new journal from them.
+        return: the statuses in a bytearray (one byte per task).
+        """
+        statuses = bytearray(self.tasks_number)
+        index = self.read(self.index_path)
+        if index is not None and (self.tasks_number == 0 or len(index) == self.tasks_number):
+            statuses[:] = index
+        records = self.read(self.path)
+        if records is not None:
+            # Ignore a record partially written when the previous run stopped.
+            complete_length = len(records) - len(records) % RECORD.size
+            for (status, task_id) in RECORD.iter_unpack(records[:complete_length]):
+                if task_id >= len(statuses):
+                    statuses.extend(bytes(task_id + 1 - len(statuses)))
+                statuses[task_id] = status
+        statuses = statuses.translate(VOLATILE_STATUSES)
+        self.compact(statuses)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.sync_thread = threading.Thread(target=self.sync_periodically, daemon=True)
+        self.sync_thread.start()
+        return statuses
+
+    def compact(self, statuses):
+        """ Write the statuses to the index (atomically),
+        then truncate the journal to its header.
+        """
+        temp_path = self.index_path + '.part'
+        with open(temp_path, 'wb') as f:
+            f.write(self.header)
+            f.write(statuses.translate(VOLATILE_STATUSES))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.index_path)
+        with open(self.path, 'wb') as f:
+            f.write(self.header)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record(self, task_id, status):
+        """ Append a state change of a task to the journal.
+        """
+        with self.lock:
+            if self.fd is not None:
+                os.write(self.fd, RECORD.pack(status, task_id))
+                self.dirty = True
+
+    def sync(self):
+        """ Make sure all records appended so far are on disk.
+        """
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = False
+        if dirty:
+            os.fsync(self.fd)
+
+    def sync_periodically(self):
+        while not self.closed.wait(self.sync_interval):
+            self.sync()
+
+    def close(self, statuses=None):
+        """ Stop the journal, compacting the given statuses into the index.
+        """
+        self.closed.set()
+        if self.sync_thread is not None:
+            self.sync_thread.join()
+        if self.fd is not None:
+            self.sync()
+            with self.lock:
+                os.close(self.fd)
+                self.fd = None
+        if statuses is not None:
+            self.compact(statuses)
@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import collections
+import threading
+import signal
+import time
+import sys
+import os
+import utils
+
+# How often the progress bar is drawn (seconds).
+REFRESH_INTERVAL = 0.2
+# How often a progress line is logged when the output is not a terminal (seconds).
+LOG_INTERVAL = 10.0
+# Throughputs are measured over this last period (seconds).
+RATE_WINDOW = 10.0
+# Number of clients listed in a progress line logged.
+LOGGED_CLIENTS = 5
+
+
+class ProgressReporter:
+    """ Reports the progress of the tasks of a tasks manager from its own thread,
+    so that giving tasks never waits for the terminal:
+    a progress bar redrawn every refresh_interval seconds with the number
+    of tasks done per second, the estimated time left and the throughput
+    of each client (as long as it fits in the terminal),
+    or a plain line logged every log_interval seconds when the output
+    is not a terminal.
+    """
+    def __init__(self, tasks_manager, stream=None, refresh_interval=REFRESH_INTERVAL, log_interval=LOG_INTERVAL):
+        self.tasks_manager = tasks_manager
+        self.stream = stream if stream is not None else sys.stderr
+        self.is_tty = self.stream.isatty()
+        self.refresh_interval = refresh_interval if self.is_tty else log_interval
+        # Size of the terminal, only read again when it is resized.
+        self.columns = self.terminal_columns()
+        self.resized = False
+        # (time, tasks done, tasks done by client) over the last RATE_WINDOW seconds.
+        self.samples = collections.deque()
+        self.start_time = time.monotonic()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def terminal_columns(self):
+        try:
+            return os.get_terminal_size(self.stream.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            return 80
+
+    def on_resize(self, signum, frame):
+        self.resized = True
+
+    def start(self):
+        if self.is_tty and hasattr(signal, 'SIGWINCH'):
+            try:
+                signal.signal(signal.SIGWINCH, self.on_resize)
+            except ValueError:
+                # Not in the main thread: the size is never read again.
+                pass
+        # Tasks already done (from the journal or the cache) do not count in throughputs.
+        self.samples.append((time.monotonic(), self.tasks_manager.progress_state()['done'], {}))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop reporting, after a last report of the progress.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        last = False
+        while not last:
+            last = self.stopped.wait(self.refresh_interval)
+            state = self.tasks_manager.progress_state()
+            last = last or state['finished']
+            self.report(state, last)
+
+    def rates(self, state):
+        """ Measure the tasks done per second, overall and by client,
+        over the last RATE_WINDOW seconds.
+        """
+        now = time.monotonic()
+        self.samples.append((now, state['done'], state['clients']))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= RATE_WINDOW:
+            self.samples.popleft()
+        (then, done, clients) = self.samples[0]
+        if now - then <= 0:
+            return (0.0, {})
+        clients_rates = {name: (count - clients.get(name, 0)) / (now - then)
+            for (name, count) in state['clients'].items()}
+        return ((state['done'] - done) / (now - then), clients_rates)
+
+    def report(self, state, last):
+        if state['total'] == 0:
+            return
+        (rate, clients_rates) = self.rates(state)
+        left = state['total'] - state['done'] - state['failed']
+        infos = ['{}/{}{} tasks'.format(state['done'], state['total'], '' if state['complete'] else '+')]
+        infos.append('{:.1f} tasks/s'.format(rate))
+        if state['finished']:
+            infos.append('in {}'.format(utils.format_duration(time.monotonic() - self.start_time)))
+        elif rate > 0 and state['complete']:
+            infos.append('ETA {}'.format(utils.format_duration(left / rate)))
+        else:
+            infos.append('ETA -:--:--')
+        clients = ['{} {:.1f}/s'.format(name, client_rate) for (name, client_rate)
+            in sorted(clients_rates.items(), key=lambda item: item[1], reverse=True)]
+        if self.is_tty:
+            self.draw(state, infos, clients, last)
+        else:
+            self.log(state, infos, clients)
+
+    def draw(self, state, infos, clients, last):
+        """ Redraw the progress bar in place, followed by as many clients as fit.
+        """
+        if self.resized:
+            self.resized = False
+            self.columns = self.terminal_columns()
+        bar_length = max(10, self.columns // 3)
+        line = '  '.join(infos)
+        # The bar takes its length, its brackets and the percentage.
+        room = self.columns - bar_length - 11 - 2 - len(line) - 1
+        for (i, client) in enumerate(clients):
+            if len(client) + 3 > room:
+                break
+            line += (' | ' if i == 0 else ', ') + client
+            room -= len(client) + 2
+        total = state['total']
+        self.stream.write('\r{}  {}\033[K'.format(utils.progress_bar(bar_length, total,
+            min(state['done'], total), min(state['working'], total - state['done'])), line))
+        if last:
+            self.stream.write('\n')
+        self.stream.flush()
+
+    def log(self, state, infos, clients):
+        line = 'Progress: {:.2f} %, {}, {} working'.format(
+            100 * state['done'] / state['total'], ', '.join(infos), state['working'])
+        if clients:
+            line += ' | ' + ', '.join(clients[:LOGGED_CLIENTS])
+            if len(clients) > LOGGED_CLIENTS:
+                line += ', +{} clients'.format(len(clients) - LOGGED_CLIENTS)
+        self.stream.write(line + '\n')
+        self.stream.flush()
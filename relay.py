@@ -0,0 +1,225 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import client
+import distributed_computing as dis_comp
+import collections
+import threading
+import tempfile
+import time
+import os
+
+# Results up to this size are read into memory and sent upstream together
+# with the other results ready, in a single call (bytes).
+BATCH_SIZE = 1 << 20
+
+
+class RelayedTask(dis_comp.Task):
+    """ A task received from the upstream server (where it has the id upstream_id),
+    whose result is received into the spool directory of the relay
+    and forwarded upstream instead of being saved.
+    """
+    __slots__ = ('upstream_id', 'relay', 'received_time')
+
+    def __init__(self, task, upstream_id, relay):
+        super().__init__(task.command.decode(), None, task.task_type, task.inputs)
+        self.upstream_id = upstream_id
+        self.relay = relay
+        self.received_time = time.monotonic()
+
+    def open_result_file(self):
+        if self.task_type == dis_comp.NO_OUT:
+            return None
+        return tempfile.NamedTemporaryFile(dir=self.relay.spool, suffix='.part', delete=False)
+
+    def save_result(self, result):
+        self.relay.forward(self, result)
+
+
+class RelayTasksManager(dis_comp.TasksManager):
+    """ The tasks of a relay, given to its clients as a server would,
+    but forwarded upstream once done (see RelayedTask), or once given up.
+    Tasks cancelled by the upstream server are dropped.
+    """
+    def __init__(self, relay, max_retries=3, task_timeout=None):
+        self.relay = relay
+        # Tasks cancelled upstream while clients work on them.
+        self.dropped = set()
+        super().__init__(relay.tasks_list, show_progress=False, complete=False,
+            max_retries=max_retries, task_timeout=task_timeout)
+
+    def drop(self, task_id):
+        """ Stop giving a task, and tell the clients working on it to cancel it.
+        """
+        with self.lock:
+            if self.tasks_status[task_id] == 0:
+                # Skipped once found in the pending tasks.
+                self.tasks_status[task_id] = 3
+                self.pending_count -= 1
+                self.failed_count += 1
+                return
+            if self.tasks_status[task_id] != 1:
+                return
+            self.dropped.add(task_id)
+            listeners = list(self.cancel_listeners)
+        for listener in listeners:
+            listener(task_id, False)
+
+    def update(self, task_id, done, result, client_name=None, timings=None):
+        with self.lock:
+            dropped = not done and task_id in self.dropped and self.running.get(task_id, [None, 1])[1] == 1
+            if dropped:
+                # Not to be given again.
+                self.dropped.discard(task_id)
+                self.running.pop(task_id, None)
+                self.tasks_status[task_id] = 3
+                self.working_count -= 1
+                self.failed_count += 1
+        if dropped:
+            return
+        if done:
+            self.dropped.discard(task_id)
+        super().update(task_id, done, result, client_name, timings)
+        if not done and self.tasks_status[task_id] == 3:
+            # Let the upstream server give it to another client.
+            self.relay.forward(self.tasks_list[task_id], None, dis_comp.RESULT_CANCELLED)
+
+
+class Relay:
+    """ Connects upstream to a server like a client executing up to block tasks
+    at the same time, and gives them to its own clients like a server
+    (through tasks_manager). The server keeps up to block tasks in flight
+    on the relay (or more with prefetch), so that its clients are never short
+    of tasks, and the results of its clients are forwarded upstream
+    by a thread, all the ones ready at once.
+    Tasks cancelled upstream are cancelled on the clients.
+    """
+    def __init__(self, connection, block, max_retries=3, task_timeout=None):
+        self.connection = connection
+        self.block = block
+        self.spool = tempfile.mkdtemp(prefix='relay')
+        self.tasks_list = []
+        # Ids of the tasks not forwarded yet: upstream id -> id in tasks_list.
+        self.local_ids = {}
+        self.lock = threading.Lock()
+        # Results to forward: (upstream id, task type, result, duration, status)
+        self.outbox = collections.deque()
+        self.results_ready = threading.Condition(self.lock)
+        self.closed = False
+        self.forwarded = 0
+        self.tasks_manager = RelayTasksManager(self, max_retries, task_timeout)
+        self.sender = threading.Thread(target=self.send_results, daemon=True)
+
+    def run(self):
+        """ Receive tasks from the upstream server until the connection is closed.
+        """
+        self.sender.start()
+        try:
+            while True:
+                (msg_type, msg_bytes) = self.connection.recv_typed_msg()
+                if msg_type == dis_comp.TASKS_BATCH:
+                    batch = dis_comp.unpack_tasks_batch(msg_bytes, self.connection.staging)
+                    with self.lock:
+                        for (upstream_id, task) in batch:
+                            self.local_ids[upstream_id] = len(self.tasks_list)
+                            self.tasks_list.append(RelayedTask(task, upstream_id, self))
+                    self.tasks_manager.add_tasks(len(batch))
+                elif msg_type == dis_comp.CANCEL:
+                    upstream_id = int.from_bytes(msg_bytes, 'little')
+                    with self.lock:
+                        task_id = self.local_ids.get(upstream_id)
+                    if task_id is not None:
+                        self.forward(self.tasks_list[task_id], None, dis_comp.RESULT_CANCELLED)
+                        self.tasks_manager.drop(task_id)
+                else:
+                    raise RuntimeError("unexpected message type {}".format(msg_type))
+        except (RuntimeError, OSError) as err:
+            print("Upstream connection closed: {}".format(err))
+
+    def forward(self, task, result, status=dis_comp.RESULT_DONE):
+        """ Queue the result of a task (the path of the file it was received in)
+        to be sent upstream, only once per task: later results are discarded.
+        """
+        with self.lock:
+            if self.local_ids.pop(task.upstream_id, None) is None:
+                if result is not None:
+                    os.remove(result)
+                return
+            self.outbox.append((task.upstream_id, task.task_type, result,
+                time.monotonic() - task.received_time, status))
+            self.results_ready.notify()
+
+    def send_results(self):
+        """ Send the results queued upstream, all the ones ready in as few calls as possible,
+        and heartbeats while tasks are in flight and nothing else is sent.
+        """
+        connection = self.connection
+        heartbeat = connection.heartbeat or None
+        try:
+            while True:
+                with self.results_ready:
+                    if not self.outbox and not self.closed:
+                        self.results_ready.wait(heartbeat)
+                    if self.closed:
+                        return
+                    results = list(self.outbox)
+                    self.outbox.clear()
+                    in_flight = bool(self.local_ids)
+                if not results:
+                    if in_flight:
+                        connection.send_typed_msg(client.HEARTBEAT, None)
+                    continue
+                self.send_batch(results)
+        except (RuntimeError, OSError) as err:
+            print("Upstream connection closed: {}".format(err))
+            self.connection.close()
+
+    def send_batch(self, results):
+        """ Send results upstream, small ones gathered in a single call.
+        """
+        connection = self.connection
+        buffers = []
+        size = 0
+        for (upstream_id, task_type, result, duration, status) in results:
+            header = dis_comp.pack_result_header(upstream_id, 0, duration, status)
+            buffers.append(dis_comp.TASK_RESULT.to_bytes(1, 'little') + connection.encode_length(len(header)) + header)
+            codec = connection.codecs.get(task_type)
+            if result is None:
+                buffers.append(connection.encode_length(0))
+            elif codec is not None or os.path.getsize(result) > BATCH_SIZE:
+                # Streamed with sendfile (or compressed), after the results gathered so far.
+                connection.send_msg(*buffers)
+                (buffers, size) = ([], 0)
+                with open(result, 'rb') as f:
+                    connection.send_stream(f, codec=codec)
+            else:
+                with open(result, 'rb') as f:
+                    content = f.read()
+                if content:
+                    buffers.extend((connection.encode_length(len(content)), content))
+                    size += len(content)
+                buffers.append(connection.encode_length(0))
+            if result is not None:
+                os.remove(result)
+            if size > BATCH_SIZE:
+                connection.send_msg(*buffers)
+                (buffers, size) = ([], 0)
+            self.forwarded += 1
+        connection.send_msg(*buffers)
+
+    def close(self):
+        """ Stop forwarding results, and remove the spool directory.
+        """
+        with self.results_ready:
+            self.closed = True
+            self.results_ready.notify()
+        if self.sender.is_alive():
+            self.sender.join()
+        self.tasks_manager.close()
+        for name in os.listdir(self.spool):
+            os.remove(os.path.join(self.spool, name))
+        os.rmdir(self.spool)
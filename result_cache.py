@@ -0,0 +1,166 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import distributed_computing as dis_comp
+import staging
+import collections
+import threading
+import tempfile
+import hashlib
+import shutil
+import json
+import os
+
+# File listing the entries of a cache, from the least to the most recently used.
+INDEX_FILENAME = 'index.json'
+
+
+def link_or_copy(source, destination_dir, prefix):
+    """ Make a new file in destination_dir with the content of source,
+    as a hard link if possible (no data copied), otherwise as a copy.
+    return: the path of the new file.
+    """
+    (fd, path) = tempfile.mkstemp(dir=destination_dir, prefix=prefix, suffix='.part')
+    os.close(fd)
+    os.remove(path)
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+    return path
+
+
+class ResultCache:
+    """ A content-addressed cache of the results of tasks, so that a task
+    already done in a previous run is not executed again.
+    Results are keyed by a hash of the task command, its type
+    and the content of its declared input files.
+    The cache is bounded to max_size bytes, evicting the least recently
+    used results first.
+    Results are hard linked between the cache and the results files
+    when they are on the same file system, so results files
+    must not be modified in place.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # Sizes of the results by key, from the least to the most recently used.
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+        # Hashes of the content of input files.
+        self.inputs_hashes = staging.FileHashes()
+        self.load_index()
+
+    def load_index(self):
+        """ Recover the entries of the cache from its index,
+        or from the files of the cache if there is no index.
+        """
+        index_path = os.path.join(self.directory, INDEX_FILENAME)
+        keys = []
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                keys = json.load(f)
+        else:
+            keys = [name for name in os.listdir(self.directory) if len(name) == 64]
+        for key in keys:
+            path = os.path.join(self.directory, key)
+            if os.path.exists(path):
+                self.entries[key] = os.path.getsize(path)
+                self.size += self.entries[key]
+
+    def close(self):
+        """ Write the index of the cache.
+        """
+        index_path = os.path.join(self.directory, INDEX_FILENAME)
+        with self.lock:
+            keys = list(self.entries)
+        with open(index_path + '.part', 'w') as f:
+            json.dump(keys, f)
+        os.replace(index_path + '.part', index_path)
+
+    def key(self, task):
+        """ Key of the result of a task in the cache.
+        """
+        digest = hashlib.sha256()
+        digest.update(bytes([task.task_type]))
+        digest.update(task.command.encode() if isinstance(task.command, str) else task.command)
+        for path in task.inputs:
+            digest.update(b'\0' + path.encode() + b'\0' + self.inputs_hashes.digest(path))
+        return digest.hexdigest()
+
+    def cacheable(self, task):
+        """ Only results are cached, tasks without results may have side effects.
+        """
+        return task.task_type != dis_comp.NO_OUT
+
+    def fetch(self, task):
+        """ Look for the result of a task in the cache.
+        return: the path of a temporary file with the result next to the result file
+        of the task (to be saved with task.save_result), or None if it is not cached.
+        """
+        if not self.cacheable(task):
+            return None
+        key = self.key(task)
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            size = self.entries[key]
+        (basedir, basename) = os.path.split(os.path.abspath(task.result_filepath))
+        try:
+            result = link_or_copy(os.path.join(self.directory, key), basedir, '.' + basename + '.')
+        except FileNotFoundError:
+            # Evicted meanwhile.
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.bytes_hit += size
+        return result
+
+    def store(self, task):
+        """ Add the result of a task just saved to the cache,
+        evicting the least recently used results if it gets too big.
+        The result is not cached if it cannot be (e.g. an input file removed meanwhile).
+        """
+        if not self.cacheable(task):
+            return
+        try:
+            key = self.key(task)
+            with self.lock:
+                if key in self.entries:
+                    return
+            temp_path = link_or_copy(task.result_filepath, self.directory, key)
+        except OSError as err:
+            print("\nNot caching the result of {}: {}".format(task.command, err))
+            return
+        size = os.path.getsize(temp_path)
+        evicted = []
+        with self.lock:
+            os.replace(temp_path, os.path.join(self.directory, key))
+            if key not in self.entries:
+                self.entries[key] = size
+                self.size += size
+            while self.size > self.max_size and self.entries:
+                (old_key, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            os.remove(os.path.join(self.directory, old_key))
+
+    def report(self):
+        """ A summary of the use of the cache during this run.
+        """
+        return "Cache: {} hits, {} misses, {:.1f} MB not computed again, {:.1f} / {:.1f} MB used".format(
+            self.hits, self.misses, self.bytes_hit / 1e6, self.size / 1e6, self.max_size / 1e6)
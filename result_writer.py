@@ -0,0 +1,111 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import collections
+import threading
+import queue
+import os
+
+# Number of results waiting to be saved beyond which clients wait
+# before being given their next task.
+QUEUE_SIZE = 256
+
+# Maximum number of results saved together by a thread,
+# with a single sync of each of their directories.
+BATCH_SIZE = 64
+
+
+def sync_directory(directory):
+    """ Make sure the entries of a directory (e.g. files renamed into it) are on disk.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ResultWriter:
+    """ Saves the results of the tasks of a tasks manager from a pool of threads,
+    so that clients are given their next task without waiting for the storage
+    of the results (e.g. on NFS), unless more than QUEUE_SIZE results wait.
+    Results are received into temporary files next to their result files:
+    each thread takes the results waiting (up to BATCH_SIZE), syncs their
+    content to disk, renames them into their result files, then syncs
+    each of their directories once, before the tasks are counted done.
+    """
+    def __init__(self, tasks_manager, threads=4):
+        self.tasks_manager = tasks_manager
+        # Results to save: (task_id, result, given_time, client_name, timings, save_start)
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.threads = [threading.Thread(target=self.write_results, daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, task_id, result, given_time, client_name=None, timings=None, save_start=None):
+        """ Queue a result to be saved, waiting while the queue is full.
+        """
+        self.queue.put((task_id, result, given_time, client_name, timings, save_start))
+
+    def write_results(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < BATCH_SIZE:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self.write(batch)
+            if stop:
+                return
+
+    def write(self, batch):
+        """ Save a batch of results, then mark their tasks done (or failed).
+        """
+        tasks_list = self.tasks_manager.tasks_list
+        errors = {}
+        # Results renamed into each directory.
+        directories = collections.defaultdict(list)
+        for (task_id, result, *_) in batch:
+            task = tasks_list[task_id]
+            try:
+                with open(result, 'rb') as f:
+                    os.fsync(f.fileno())
+                task.save_result(result)
+                directories[os.path.dirname(os.path.abspath(task.result_filepath))].append(task_id)
+            except OSError as err:
+                errors[task_id] = err
+                try:
+                    task.discard_result(result)
+                except OSError:
+                    pass
+        for (directory, task_ids) in directories.items():
+            try:
+                sync_directory(directory)
+            except OSError as err:
+                errors.update((task_id, err) for task_id in task_ids)
+        for (task_id, _, given_time, client_name, timings, save_start) in batch:
+            self.tasks_manager.saved(task_id, given_time, client_name, timings, save_start, errors.get(task_id))
+        self.tasks_manager.notify_saved()
+
+    def close(self):
+        """ Save the results still queued, then stop the threads
+        (it may be called from one of them, once its results are saved).
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import threading
+import json
+import math
+import re
+import os
+
+# Runs of digits, which usually only change the data a command works on.
+DIGITS = re.compile(r'\d+')
+
+
+def command_pattern(command):
+    """ The pattern of a command: the command with its runs of digits replaced by #,
+    so that the commands of a same kind of tasks share the same pattern.
+    """
+    if not isinstance(command, str):
+        command = command.decode(errors='replace')
+    return DIGITS.sub('#', command)
+
+
+class RuntimeHistory:
+    """ The mean duration of the tasks done (in seconds) by command pattern,
+    kept from a run to the next in a JSON file at path, to estimate
+    how long tasks will take.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # pattern -> [number of tasks done, mean duration]
+        self.runtimes = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.runtimes = json.load(f)
+
+    def record(self, command, duration):
+        """ Take into account the duration of a task just done.
+        """
+        pattern = command_pattern(command)
+        with self.lock:
+            runtime = self.runtimes.setdefault(pattern, [0, 0.0])
+            runtime[0] += 1
+            runtime[1] += (duration - runtime[1]) / runtime[0]
+
+    def expected(self, command):
+        """ The expected duration of a command, None if none of its pattern was done.
+        """
+        runtime = self.runtimes.get(command_pattern(command))
+        return runtime[1] if runtime is not None else None
+
+    def close(self):
+        """ Write the history (atomically).
+        """
+        with self.lock:
+            content = json.dumps(self.runtimes)
+        with open(self.path + '.part', 'w') as f:
+            f.write(content)
+        os.replace(self.path + '.part', self.path)
+
+
+def expected_cost(task, history=None):
+    """ The expected cost of a task, to give the most expensive tasks first:
+    its cost annotation if any, otherwise the mean duration of the tasks
+    of the same pattern in the history.
+    Tasks whose cost is unknown come first, not to find out at the end
+    of the run that they take long.
+    """
+    if task.cost is not None:
+        return task.cost
+    expected = history.expected(task.command) if history is not None else None
+    return expected if expected is not None else math.inf
@@ -0,0 +1,244 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import collections
+import threading
+import tempfile
+import hashlib
+import shutil
+import os
+
+# Number of the inputs a client holds (the most recently used) looked at
+# to find it a task whose inputs it already holds.
+PREFERRED_INPUTS = 32
+
+
+class FileHashes:
+    """ SHA-256 digests of the content of files,
+    only read once per version of a file (path, size, modification time).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.digests = {}
+
+    def digest(self, path):
+        stat = os.stat(path)
+        version = (path, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            digest = self.digests.get(version)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    hasher.update(chunk)
+            digest = hasher.digest()
+            with self.lock:
+                self.digests[version] = digest
+        return digest
+
+
+class ServerInputs:
+    """ The input files of tasks a server ships to clients,
+    identified by the hash of their content.
+    """
+    def __init__(self):
+        self.hashes = FileHashes()
+        self.lock = threading.Lock()
+        # Path of the files by hash, to send them when clients ask for them.
+        self.paths = {}
+
+    def describe(self, path):
+        """ return: (hash, size) of an input file.
+        """
+        file_hash = self.hashes.digest(path).hex()
+        with self.lock:
+            self.paths[file_hash] = path
+        return (file_hash, os.path.getsize(path))
+
+    def path(self, file_hash):
+        with self.lock:
+            return self.paths[file_hash]
+
+
+class ClientInputs:
+    """ The input files a client holds in its cache, as far as the server knows:
+    the ones it had when it connected, and the ones sent to it since.
+    """
+    def __init__(self, server_inputs, held_hashes=()):
+        self.server_inputs = server_inputs
+        # Files are sent from another thread than the one giving tasks.
+        self.lock = threading.Lock()
+        self.held_hashes = set(held_hashes)
+        # Paths of the inputs held, from the least to the most recently used.
+        self.held_paths = collections.OrderedDict()
+
+    def describe(self, task):
+        """ The inputs of a task, as sent with it: a list of [path, hash, size].
+        Missing files are left out, for the task to fail on the client.
+        """
+        inputs = []
+        for path in task.inputs:
+            try:
+                (file_hash, size) = self.server_inputs.describe(path)
+            except OSError:
+                continue
+            if file_hash in self.held_hashes:
+                self.held(path)
+            inputs.append([path, file_hash, size])
+        return inputs
+
+    def held(self, path):
+        with self.lock:
+            self.held_paths[path] = True
+            self.held_paths.move_to_end(path)
+            if len(self.held_paths) > PREFERRED_INPUTS:
+                self.held_paths.popitem(last=False)
+
+    def sent(self, file_hash):
+        """ Take into account an input file sent to the client.
+        """
+        self.held_hashes.add(file_hash)
+        self.held(self.server_inputs.path(file_hash))
+
+    def preferred(self):
+        """ Paths of the inputs held, from the most recently used.
+        """
+        with self.lock:
+            return list(reversed(self.held_paths))
+
+
+def staged_path(directory, path):
+    """ Where an input file declared with path is staged in directory:
+    at the same path relative to it, never outside of it.
+    """
+    parts = [part for part in os.path.normpath(path).split(os.sep) if part not in ('', '.', '..')]
+    return os.path.join(directory, *parts)
+
+
+class InputsCache:
+    """ A content-addressed cache of the input files of tasks on a client,
+    so that each input crosses the network once per machine.
+    Files are named by the hash of their content, and the cache is bounded
+    to max_size bytes, evicting the least recently used files first,
+    except the ones needed by tasks not done yet (pinned).
+    Inputs are hard linked into the directory a task is executed in
+    (if possible), so tasks must not modify them in place.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.work_directory = os.path.join(directory, 'work')
+        os.makedirs(self.work_directory, exist_ok=True)
+        # Sizes of the files by hash, from the least to the most recently used.
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        files = [name for name in os.listdir(directory) if len(name) == 64]
+        for name in sorted(files, key=lambda name: os.path.getatime(os.path.join(directory, name))):
+            self.entries[name] = os.path.getsize(os.path.join(directory, name))
+            self.size += self.entries[name]
+        # Number of tasks not done yet needing each file.
+        self.pins = collections.Counter()
+        # Files asked for to the server, not received yet.
+        self.requested = set()
+        self.bytes_received = 0
+        self.bytes_hit = 0
+
+    def hashes(self):
+        return list(self.entries)
+
+    def has(self, file_hash):
+        return file_hash in self.entries
+
+    def ready(self, task):
+        """ Whether all the inputs of a task are in the cache.
+        """
+        return all(file_hash in self.entries for (_, file_hash, _) in task.inputs)
+
+    def pin(self, task):
+        """ Keep the inputs of a task in the cache until unpin is called.
+        return: the hashes of the files to ask for to the server
+        (missing and not asked for yet).
+        """
+        missing = []
+        for (_, file_hash, size) in task.inputs:
+            self.pins[file_hash] += 1
+            if file_hash in self.entries:
+                self.entries.move_to_end(file_hash)
+                self.bytes_hit += size
+            elif file_hash not in self.requested:
+                self.requested.add(file_hash)
+                missing.append(file_hash)
+        return missing
+
+    def unpin(self, task):
+        for (_, file_hash, _) in task.inputs:
+            self.pins[file_hash] -= 1
+            if self.pins[file_hash] <= 0:
+                del self.pins[file_hash]
+        self.evict()
+
+    def receive(self, connection, file_hash):
+        """ Receive a file sent by the server into the cache, checking its content.
+        """
+        (fd, temp_path) = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                size = connection.recv_stream(f)
+            with open(temp_path, 'rb') as f:
+                hasher = hashlib.sha256()
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    hasher.update(chunk)
+            if hasher.hexdigest() != file_hash:
+                raise RuntimeError("corrupted input {}".format(file_hash))
+            os.replace(temp_path, os.path.join(self.directory, file_hash))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.requested.discard(file_hash)
+        if file_hash not in self.entries:
+            # Otherwise received again (asked for twice), with the same content.
+            self.entries[file_hash] = size
+            self.size += size
+        self.bytes_received += size
+        self.evict()
+
+    def missing(self, file_hash):
+        """ Forget a file asked for which the server cannot send
+        (to be asked for again by the next tasks reading it).
+        """
+        self.requested.discard(file_hash)
+
+    def evict(self):
+        """ Remove the least recently used files not pinned while the cache is too big.
+        """
+        for file_hash in list(self.entries):
+            if self.size <= self.max_size:
+                break
+            if file_hash not in self.pins:
+                self.size -= self.entries.pop(file_hash)
+                os.remove(os.path.join(self.directory, file_hash))
+
+    def stage(self, task):
+        """ Make a directory to execute a task in, with its inputs at their paths.
+        return: its path.
+        """
+        directory = tempfile.mkdtemp(dir=self.work_directory)
+        for (path, file_hash, _) in task.inputs:
+            destination = staged_path(directory, path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            source = os.path.join(self.directory, file_hash)
+            try:
+                os.link(source, destination)
+            except OSError:
+                shutil.copyfile(source, destination)
+        return directory
+
+    def report(self):
+        """ A summary of the use of the cache during this run.
+        """
+        return "Inputs cache: {:.1f} MB received, {:.1f} MB found in the cache, {:.1f} / {:.1f} MB used".format(
+            self.bytes_received / 1e6, self.bytes_hit / 1e6, self.size / 1e6, self.max_size / 1e6)
@@ -8,28 +8,83 @@
 # pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
 
 import socket
+import client
 import distributed_computing
+import staging
 import traceback
 import argparse
+import random
+import time
+import os
+
+# Time waited before connecting again to the server (seconds),
+# doubled after each failed attempt.
+RECONNECT_DELAY = 1.0
 
 
 def main(args):
     """ Create a client socket and wait for instructions from the server
     at the address (args.address, args.port). Then return the results to the server.
+    With args.reconnect, connect again whenever the connection is lost,
+    waiting longer after each failed attempt (up to args.maxDelay seconds).
+    """
+    # Execute up to args.slots tasks at the same time.
+    min_memory = args.memoryPerTask * 1e6 if args.memoryPerTask is not None else None
+    slots = distributed_computing.Slots(args.slots, args.maxLoad, min_memory)
+    # Keep the inputs of tasks sent by the server (if it stages them).
+    inputs_cache = None
+    if args.inputsCache is not None:
+        inputs_cache = staging.InputsCache(args.inputsCache, int(args.inputsCacheSize * 1e6))
+    delay = RECONNECT_DELAY
+    try:
+        while True:
+            if work(args, slots, inputs_cache):
+                delay = RECONNECT_DELAY
+            if not args.reconnect:
+                break
+            # Spread the clients connecting again all at once.
+            wait = random.uniform(0.5, 1) * delay
+            print("Connecting again in {:.1f} s".format(wait))
+            time.sleep(wait)
+            delay = min(2 * delay, args.maxDelay)
+    except KeyboardInterrupt:
+        pass
+    if inputs_cache is not None:
+        print(inputs_cache.report())
+
+
+def work(args, slots, inputs_cache):
+    """ Connect to the server and handle the work it gives
+    until the connection is closed.
+    return: True if the client was connected.
     """
+    connected = False
     try:
         # Create client socket and connect to server.
-        client_socket = socket.socket()
-        client_socket.connect((args.address, args.port))
+        client_socket = socket.socket(socket.AF_UNIX) if args.unixSocket is not None else socket.socket()
+        if args.bufferSize is not None:
+            client.set_socket_buffers(client_socket, args.bufferSize)
+        client.set_no_delay(client_socket)
+        client_socket.connect(args.unixSocket if args.unixSocket is not None else (args.address, args.port))
+        connection = client.Connection(client_socket, args.bufferSize or client.RECV_BUFFER_SIZE)
+        connection.send_hello(args.protocol, args.slots,
+            inputs_cache.hashes() if inputs_cache is not None else None)
+        connected = True
         # As long as no error is detected, handle work given by the server.
-        while distributed_computing.handle_work(client_socket):
+        while distributed_computing.handle_work(connection, slots, inputs_cache):
             pass
+        if connection.compression_stats.raw_bytes > 0:
+            print(connection.compression_stats.report("compressing"))
     except ConnectionError as err:
         print("Connection error: {}".format(err))
+    except KeyboardInterrupt:
+        client_socket.close()
+        raise
     except BaseException as err:
         traceback.print_exc()
     # Always close the socket.
     client_socket.close()
+    return connected
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -39,5 +94,29 @@ if __name__ == '__main__':
                         help='address of the server to connect to (eg. localhost or 0.0.0.0)')
     parser.add_argument('-p', '--port', metavar='port', type=int, default=8080,
                         help='port to use to reach the server.')
+    parser.add_argument('--unixSocket', metavar='path', default=None,
+                        help='connect to a server on the same machine through its unix socket \
+                        (see --unixSocket of the server), instead of the address and port.')
+    parser.add_argument('--bufferSize', metavar='bytes', type=int, default=None,
+                        help='size of the socket buffers (default: {} for the receive buffer).'.format(client.RECV_BUFFER_SIZE))
+    parser.add_argument('--protocol', metavar='version', type=int, default=client.PROTOCOL_VERSION,
+                        help='highest version of the protocol to use (default: {}).'.format(client.PROTOCOL_VERSION))
+    parser.add_argument('--slots', metavar='N', type=int, default=os.cpu_count() or 1,
+                        help='number of tasks to execute at the same time (default: number of cores, {}).'.format(os.cpu_count()))
+    parser.add_argument('--maxLoad', metavar='load', type=float, default=None,
+                        help='do not start more tasks while the load average of the machine would go above this.')
+    parser.add_argument('--memoryPerTask', metavar='MB', type=float, default=None,
+                        help='do not start more tasks while less than this memory is available.')
+    parser.add_argument('--inputsCache', metavar='directory', default=None,
+                        help='cache of the input files of tasks, received from a server staging them \
+                        (see --stageInputs of the server), kept from a run to the next \
+                        (not to be shared by clients running at the same time).')
+    parser.add_argument('--inputsCacheSize', metavar='MB', type=float, default=10000,
+                        help='maximum size of the cache of inputs (default: 10000 MB).')
+    parser.add_argument('--reconnect', action='store_true',
+                        help='connect again whenever the connection to the server is lost \
+                        or cannot be made, to keep working for a daemon server.')
+    parser.add_argument('--maxDelay', metavar='seconds', type=float, default=60,
+                        help='longest time waited before connecting again (default: 60).')
     args = parser.parse_args()
     args.func(args)
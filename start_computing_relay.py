@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import socket
+import client
+import distributed_computing as dis_comp
+import relay
+import threading
+import traceback
+import argparse
+
+
+def main(args):
+    """ Connect to the server at (args.upstream, args.upstreamPort) like a client,
+    and give the tasks it sends to the clients connecting to (args.address, args.port),
+    forwarding their results upstream, until the upstream server closes the connection.
+    """
+    upstream_socket = socket.socket()
+    server_socket = None
+    tasks_relay = None
+    try:
+        if args.bufferSize is not None:
+            client.set_socket_buffers(upstream_socket, args.bufferSize)
+        client.set_no_delay(upstream_socket)
+        upstream_socket.connect((args.upstream, args.upstreamPort))
+        connection = client.Connection(upstream_socket, args.bufferSize or client.RECV_BUFFER_SIZE)
+        connection.send_hello(args.protocol, args.block)
+        tasks_relay = relay.Relay(connection, args.block, args.maxRetries, args.taskTimeout)
+        # Serve the clients of the relay like a server.
+        if args.engine == 'asyncio':
+            # Only imported when used.
+            import async_server
+            server_class = async_server.AsyncTasksServer
+        else:
+            server_class = dis_comp.TasksThreadingTCPServer
+        server_socket = server_class(
+            (args.address, args.port), tasks_relay.tasks_manager,
+            args.prefetch, not args.fixedPrefetch, args.bufferSize, heartbeat=args.heartbeat)
+        threading.Thread(target=server_socket.serve_forever, daemon=True).start()
+        tasks_relay.run()
+    except ConnectionError as err:
+        print("Connection error: {}".format(err))
+    except KeyboardInterrupt:
+        pass
+    except BaseException as err:
+        traceback.print_exc()
+    print("Closing relay")
+    if server_socket is not None:
+        server_socket.shutdown()
+        server_socket.server_close()
+    if tasks_relay is not None:
+        tasks_relay.close()
+        print("Forwarded {} results".format(tasks_relay.forwarded))
+    upstream_socket.close()
+    print("Relay closed")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.set_defaults(func=main)
+    parser.add_argument('-v', '--version', action='version', version='0.1')
+    parser.add_argument('-u', '--upstream', metavar='address', default='localhost',
+                        help='address of the server to relay (eg. the head node).')
+    parser.add_argument('--upstreamPort', metavar='port', type=int, default=8080,
+                        help='port of the server to relay (default: 8080).')
+    parser.add_argument('-a', '--address', metavar='address', default='',
+                        help='address for the socket of the relay (eg. localhost or 0.0.0.0)')
+    parser.add_argument('-p', '--port', metavar='port', type=int, default=8090,
+                        help='port on which the clients of the relay connect (default: 8090).')
+    parser.add_argument('--block', metavar='N', type=int, default=64,
+                        help='number of tasks the relay takes from the server at a time, \
+                        to give to its clients (default: 64, about the number of slots of its clients).')
+    parser.add_argument('--prefetch', metavar='K', type=int, default=0,
+                        help='send tasks to the clients of the relay in batches (see the server).')
+    parser.add_argument('--fixedPrefetch', action='store_true',
+                        help='always keep exactly K tasks in flight per client.')
+    parser.add_argument('--bufferSize', metavar='bytes', type=int, default=None,
+                        help='size of the socket buffers (default: {} for the receive buffers).'.format(client.RECV_BUFFER_SIZE))
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='serve each client in its own thread (default), \
+                        or all clients from a single asyncio event loop.')
+    parser.add_argument('--protocol', metavar='version', type=int, default=client.PROTOCOL_VERSION,
+                        help='highest version of the protocol to use upstream (default: {}).'.format(client.PROTOCOL_VERSION))
+    parser.add_argument('--heartbeat', metavar='seconds', type=float, default=5,
+                        help='interval of the heartbeats sent by the clients of the relay while they work (default: 5).')
+    parser.add_argument('--taskTimeout', metavar='seconds', type=float, default=None,
+                        help='cancel tasks given to a client for longer than this (default: no timeout).')
+    parser.add_argument('--maxRetries', metavar='N', type=int, default=3,
+                        help='give tasks back to the server after they failed N+1 times on the clients of the relay (default: 3).')
+    args = parser.parse_args()
+    args.func(args)
@@ -8,7 +8,16 @@
 # pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
 
 import distributed_computing as dis_comp
+import jobs
+import journal
+import result_cache
+import scheduling
+import staging
+import tasks_file
+import tracing
+import wire_compression
 import argparse
+import threading
 import sys
 import os
 from functools import partial
@@ -20,6 +29,8 @@ def load_tasks(tasks_filepath=None,
     """ Load the tasks written in the file.
     If no file is given, get the tasks from stdin.
     Each line of the file will be considered as a different task.
+    return: (the tasks, a dict task_id -> reason of the ones whose annotations
+    cannot be parsed, to be given up).
     """
     # First load the commands.
     commands_list = []
@@ -40,11 +51,16 @@ def load_tasks(tasks_filepath=None,
             results_paths_list = [path.strip() for path in f.readlines()]
         assert(len(results_paths_list) == nb_tasks)
 
-    # Finally create the tasks.
-    tasks_list = [dis_comp.Task(command, result_path,  types)\
-        for (command, result_path) in \
-        zip_longest(commands_list, results_paths_list)]
-    return tasks_list
+    # Finally create the tasks, with their annotations.
+    tasks_list = []
+    invalid = {}
+    for (task_id, (line, result_path)) in enumerate(zip_longest(commands_list, results_paths_list)):
+        try:
+            tasks_list.append(tasks_file.make_task(line, result_path, types))
+        except ValueError as err:
+            invalid[task_id] = "invalid annotations ({})".format(err)
+            tasks_list.append(tasks_file.make_invalid_task(line, result_path, types))
+    return (tasks_list, invalid)
 
 def main(args):
     """ Setup a server socket that will handle connections from clients and give them work.
@@ -53,24 +69,173 @@ def main(args):
     """
     try:
         # Initiate the tasks manager
-        tasks_manager = dis_comp.TasksManager(
-            load_tasks(args.tasks, args.results,
-                dis_comp.FILE_OUT if args.resultsAreFiles else dis_comp.STD_OUT))
-        # Create the master server socket.
-        # This socket is a TCP threaded socket.
-        server_socket = dis_comp.TasksThreadingTCPServer(
-            (args.address, args.port), tasks_manager)
+        task_type = dis_comp.FILE_OUT if args.resultsAreFiles else dis_comp.STD_OUT
+        invalid = None
+        if args.stream:
+            # Tasks are read while they are given.
+            tasks_list = tasks_file.TasksFile(args.tasks, args.results, task_type)
+        else:
+            (tasks_list, invalid) = load_tasks(args.tasks, args.results, task_type)
+        # Resume from the journal of a previous run of the same tasks.
+        tasks_journal = None
+        if args.journal is not None and args.stream:
+            tasks_journal = journal.Journal(args.journal, 0,
+                journal.files_fingerprint(args.tasks, args.results))
+        elif args.journal is not None:
+            tasks_journal = journal.Journal(args.journal, len(tasks_list),
+                journal.tasks_fingerprint(tasks_list))
+        # Take the results of tasks already done from the cache.
+        cache = None
+        if args.cache is not None:
+            cache = result_cache.ResultCache(args.cache, int(args.cacheSize * 1e6))
+        # Trace the phases of tasks.
+        tracer = tracing.Tracer(args.trace) if args.trace is not None else None
+        # Estimate the cost of tasks from previous runs.
+        history = scheduling.RuntimeHistory(args.history) if args.history is not None else None
+        tasks_manager = dis_comp.TasksManager(tasks_list, journal=tasks_journal, cache=cache,
+            max_duplicates=args.speculate, straggler_factor=args.stragglerFactor,
+            task_timeout=args.taskTimeout, max_retries=args.maxRetries,
+            complete=not args.stream, tracer=tracer, history=history,
+            by_cost=args.longestFirst, by_inputs=args.stageInputs, dependencies=True, writers=args.writers,
+            invalid=invalid)
+        if args.stream:
+            threading.Thread(target=tasks_list.read, args=(tasks_manager,), daemon=True).start()
+        elif tasks_manager.all_tasks_done():
+            print("All tasks are already done")
+            tasks_manager.close()
+            return
+        server_socket = make_server(args, tasks_manager)
+        # Clients may not be there to stop the server once all tasks are read,
+        # or found in the cache.
+        if args.stream or tasks_manager.cache is not None:
+            threading.Thread(target=stop_when_done, args=(tasks_manager, server_socket), daemon=True).start()
+        # Stop the run after a while, whatever is left to do.
+        if args.timeout is not None:
+            timer = threading.Timer(args.timeout, server_socket.shutdown)
+            timer.daemon = True
+            timer.start()
         # Listen for client connections and distribute the work load.
         server_socket.serve_forever()
     except KeyboardInterrupt:
         pass
+    # Report the last progress before anything else.
+    if tasks_manager.progress is not None:
+        tasks_manager.progress.stop()
     # If the serve_forever() loop ends, close the server socket and returns.
     print("Closing server")
     server_socket.shutdown()
     server_socket.server_close()
+    tasks_manager.close()
+    if tasks_manager.cache is not None:
+        print(tasks_manager.cache.report())
+    if args.compression:
+        print(server_socket.compression_stats.report("decompressing"))
+    if not tasks_manager.all_tasks_done():
+        print("Run stopped with {} tasks not done".format(
+            len(tasks_manager.tasks_status) - tasks_manager.done_count - tasks_manager.failed_count))
+    failed_tasks = tasks_manager.failed_tasks()
+    if failed_tasks:
+        print("Gave up {} tasks (lines {})".format(
+            len(failed_tasks), ', '.join(str(task_id + 1) for task_id in sorted(failed_tasks))))
+    if args.speculate > 0:
+        print("Speculation: {} straggler tasks given again".format(tasks_manager.duplicates_count))
+    if tasks_manager.tracer is not None:
+        print(tasks_manager.tracer.summary(tasks_manager.tasks_list))
     print("Server closed")
 
 
+def make_server(args, tasks_manager):
+    """ Create the master server socket, giving the tasks of tasks_manager.
+    This socket is a TCP threaded socket, or a single event loop
+    driving all the connections with the asyncio engine.
+    """
+    if args.engine == 'asyncio':
+        # Only imported when used.
+        import async_server
+        server_class = async_server.AsyncTasksServer
+    else:
+        server_class = dis_comp.TasksThreadingTCPServer
+    return server_class(
+        (args.address, args.port), tasks_manager,
+        args.prefetch, not args.fixedPrefetch, args.bufferSize,
+        heartbeat=args.heartbeat, compression=args.compression,
+        staging=staging.ServerInputs() if args.stageInputs else None,
+        local_path=args.unixSocket)
+
+
+def run_daemon(args):
+    """ Serve the jobs submitted to the control channel, listening on
+    (localhost, args.controlPort), until it is told to shut down.
+    Clients stay connected between jobs.
+    """
+    # Jobs share the cache and the history.
+    cache = None
+    if args.cache is not None:
+        cache = result_cache.ResultCache(args.cache, int(args.cacheSize * 1e6))
+    history = scheduling.RuntimeHistory(args.history) if args.history is not None else None
+    jobs_manager = jobs.JobsManager()
+    server_socket = make_server(args, jobs_manager)
+    control_server = jobs.ControlServer(('localhost', args.controlPort), jobs_manager,
+        partial(make_job, args, cache, history), server_socket.shutdown)
+    threading.Thread(target=control_server.serve_forever, daemon=True).start()
+    print("Waiting for jobs on port {}".format(args.controlPort))
+    try:
+        server_socket.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("Closing server")
+    control_server.shutdown()
+    control_server.server_close()
+    jobs_manager.close()
+    server_socket.shutdown()
+    server_socket.server_close()
+    if cache is not None:
+        print(cache.report())
+    print("Server closed")
+
+
+def make_job(args, cache, history, request):
+    """ Make the tasks manager of a job submitted to a daemon server
+    (see jobs.ControlServer), with the options of the server.
+    """
+    task_type = dis_comp.FILE_OUT if request.get('resultsAreFiles') else dis_comp.STD_OUT
+    (tasks_list, invalid) = load_tasks(request['tasks'], request.get('results'), task_type)
+    tasks_journal = None
+    if request.get('journal') is not None:
+        tasks_journal = journal.Journal(request['journal'], len(tasks_list),
+            journal.tasks_fingerprint(tasks_list))
+    return dis_comp.TasksManager(tasks_list, show_progress=False, journal=tasks_journal, cache=cache,
+        max_duplicates=args.speculate, straggler_factor=args.stragglerFactor,
+        task_timeout=args.taskTimeout, max_retries=args.maxRetries,
+        history=history, by_cost=args.longestFirst, by_inputs=args.stageInputs,
+        dependencies=True, writers=args.writers, invalid=invalid)
+
+
+def stop_when_done(tasks_manager, server_socket):
+    tasks_manager.wait_all_tasks_done()
+    server_socket.shutdown()
+
+
+def parse_compression(spec):
+    """ Parse the compression codecs asked for the results of each type of tasks:
+    a codec for all types, or TYPE=codec pairs separated by commas
+    (eg. STD_OUT=zlib,FILE_OUT=zstd).
+    return: a dict task type -> codec.
+    """
+    types = {'STD_OUT': dis_comp.STD_OUT, 'FILE_OUT': dis_comp.FILE_OUT}
+    codecs = sorted(wire_compression.CODECS) + ['auto', 'none']
+    compression = {}
+    for part in spec.split(','):
+        (type_name, _, codec) = part.rpartition('=')
+        if codec not in codecs:
+            raise argparse.ArgumentTypeError("unknown codec {} (available: {})".format(codec, ', '.join(codecs)))
+        if type_name and type_name not in types:
+            raise argparse.ArgumentTypeError("unknown type of tasks {} (eg. {})".format(type_name, ', '.join(types)))
+        for task_type in ([types[type_name]] if type_name else types.values()):
+            compression[task_type] = codec
+    return compression
+
+
 def check_path(path, should_exist):
     """ Check that a path (file or folder) exists or not and return it.
     """
@@ -95,7 +260,90 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--results', metavar='filepath',
                         type=partial(check_path, should_exist=True), default=None,
                         help='expect the results of tasks as files.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, giving the tasks of the jobs submitted \
+                        with submit_job.py (sharing clients fairly between jobs at the same time), \
+                        until it is told to shut down. Clients stay connected between jobs.')
+    parser.add_argument('--controlPort', metavar='port', type=int, default=None,
+                        help='port (on localhost) on which a daemon receives jobs (default: port + 1).')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the tasks file (and results file) while giving tasks, \
+                        for very large files. Requires --tasks.')
     parser.add_argument('--resultsAreFiles', action='store_true',
                         help='expect the results of tasks as files.')
+    parser.add_argument('--prefetch', metavar='K', type=int, default=0,
+                        help='send tasks in batches, keeping up to K tasks in flight per client \
+                        (tuned from the tasks durations and the round trip time). \
+                        By default, tasks are sent one at a time.')
+    parser.add_argument('--fixedPrefetch', action='store_true',
+                        help='always keep exactly K tasks in flight per client.')
+    parser.add_argument('--bufferSize', metavar='bytes', type=int, default=None,
+                        help='size of the socket buffers (default: {} for the receive buffers).'.format(dis_comp.client.RECV_BUFFER_SIZE))
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='serve each client in its own thread (default), \
+                        or all clients from a single asyncio event loop.')
+    parser.add_argument('-j', '--journal', metavar='filepath', default=None,
+                        help='journal of the tasks done, to resume the run from \
+                        where it stopped if the server is restarted.')
+    parser.add_argument('--cache', metavar='directory', default=None,
+                        help='cache of the results, to skip tasks whose command \
+                        (and declared inputs) did not change since a previous run.')
+    parser.add_argument('--cacheSize', metavar='MB', type=float, default=10000,
+                        help='maximum size of the cache (default: 10000 MB).')
+    parser.add_argument('--longestFirst', action='store_true',
+                        help='give the most expensive tasks first, from their cost annotation \
+                        or from the durations of the same kind of tasks in previous runs (see --history), \
+                        so that the run does not end with a few long tasks.')
+    parser.add_argument('--history', metavar='filepath', default=None,
+                        help='file of the mean durations of tasks by command (with numbers ignored), \
+                        updated at the end of each run, to estimate their cost with --longestFirst.')
+    parser.add_argument('--stageInputs', action='store_true',
+                        help='send the declared inputs of tasks to clients with a cache of inputs \
+                        (see --inputsCache of the client), once per client machine, \
+                        giving first to each client the tasks reading the files it already holds.')
+    parser.add_argument('--unixSocket', metavar='path', default=None,
+                        help='also accept the clients running on this machine on a unix socket \
+                        (see --unixSocket of the client): their result files are handed over \
+                        by path and moved into place instead of copied through the socket.')
+    parser.add_argument('--speculate', metavar='N', type=int, default=0,
+                        help='once no task is pending, give again to idle clients up to N \
+                        tasks running much longer than the others (first result wins).')
+    parser.add_argument('--stragglerFactor', metavar='F', type=float, default=2.0,
+                        help='only give again tasks running for more than F times \
+                        the median duration of tasks (default: 2).')
+    parser.add_argument('--compression', metavar='codec', type=parse_compression, default=None,
+                        help='compress results on the wire with zlib, lzma, zstd (if available) \
+                        or auto (the fastest available), for all types of tasks or per type, \
+                        eg. STD_OUT=zlib,FILE_OUT=none. Results which do not shrink are sent as they are.')
+    parser.add_argument('--heartbeat', metavar='seconds', type=float, default=5,
+                        help='interval of the heartbeats sent by clients while they work: \
+                        a client missing {} of them is considered dead and its tasks are \
+                        given to others (default: 5, 0 to disable).'.format(dis_comp.client.HEARTBEAT_MISSES))
+    parser.add_argument('--taskTimeout', metavar='seconds', type=float, default=None,
+                        help='cancel tasks given to a client for longer than this, \
+                        unless annotated with their own timeout (default: no timeout).')
+    parser.add_argument('--maxRetries', metavar='N', type=int, default=3,
+                        help='give up tasks after they failed (or timed out) N+1 times (default: 3).')
+    parser.add_argument('--writers', metavar='N', type=int, default=4,
+                        help='save results from N threads, while clients go on with their next task, \
+                        a task being done once its result is synced to disk \
+                        (default: 4, 0 to save each result before giving the next task).')
+    parser.add_argument('--timeout', metavar='seconds', type=float, default=None,
+                        help='stop the run after this time, whatever is left to do \
+                        (to be resumed with --journal).')
+    parser.add_argument('--trace', metavar='trace_file', default=None,
+                        help='record the time spent by each task in each phase \
+                        (queued, sent, waiting and executing on the client, uploaded, saved) \
+                        into a trace file: JSON lines if it ends with .jsonl, a Chrome trace otherwise \
+                        (see chrome://tracing or ui.perfetto.dev). A summary is printed at the end.')
     args = parser.parse_args()
+    if args.stream and args.tasks is None:
+        parser.error('--stream requires --tasks')
+    if args.daemon:
+        if args.tasks is not None or args.results is not None or args.stream \
+                or args.journal is not None or args.trace is not None:
+            parser.error('--daemon takes its tasks (and journals) from submitted jobs')
+        if args.controlPort is None:
+            args.controlPort = args.port + 1
+        args.func = run_daemon
     args.func(args)
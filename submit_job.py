@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import jobs
+import argparse
+import sys
+import os
+
+
+def print_jobs(reply):
+    """ Print the status of the jobs in a reply of the daemon.
+    """
+    for job in reply['jobs']:
+        print("Job {job}: {done}/{total} tasks done, {working} working, {failed} given up, {state} ({duration:.1f} s): {name}".format(
+            state='finished' if job['finished'] else 'running', **job))
+
+
+def main(args):
+    """ Send a request to the control channel of a daemon server
+    at (args.address, args.controlPort), and print the reply.
+    """
+    if args.command == 'submit':
+        request = {'command': 'submit', 'tasks': os.path.abspath(args.tasks),
+            'results': os.path.abspath(args.results) if args.results is not None else None,
+            'resultsAreFiles': args.resultsAreFiles,
+            'journal': os.path.abspath(args.journal) if args.journal is not None else None}
+    elif args.command == 'wait':
+        request = {'command': 'wait', 'job': args.job}
+    else:
+        request = {'command': args.command}
+    try:
+        reply = jobs.send_request((args.address, args.controlPort), request)
+        if 'error' in reply:
+            sys.exit("Error: {}".format(reply['error']))
+        if args.command == 'submit':
+            print("Job {} submitted".format(reply['job']))
+            if args.wait:
+                print_jobs(jobs.send_request((args.address, args.controlPort), {'command': 'wait', 'job': reply['job']}))
+        elif 'jobs' in reply:
+            print_jobs(reply)
+    except (RuntimeError, OSError) as err:
+        sys.exit("Connection error: {}".format(err))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.set_defaults(func=main)
+    parser.add_argument('-v', '--version', action='version', version='0.1')
+    parser.add_argument('-a', '--address', metavar='address', default='localhost',
+                        help='address of the daemon server (its control channel only listens on localhost).')
+    parser.add_argument('-c', '--controlPort', metavar='port', type=int, default=8081,
+                        help='port on which the daemon receives jobs (default: 8081).')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    submit = subparsers.add_parser('submit', help='submit a job to the daemon.')
+    submit.add_argument('-t', '--tasks', metavar='filepath', required=True,
+                        help='file containing the commands to run.')
+    submit.add_argument('-r', '--results', metavar='filepath', default=None,
+                        help='file containing the paths of the results of the commands.')
+    submit.add_argument('--resultsAreFiles', action='store_true',
+                        help='expect the results of tasks as files.')
+    submit.add_argument('-j', '--journal', metavar='filepath', default=None,
+                        help='journal of the tasks done, to resume the job if submitted again.')
+    submit.add_argument('-w', '--wait', action='store_true',
+                        help='wait until the job is done.')
+    wait = subparsers.add_parser('wait', help='wait until a job is done.')
+    wait.add_argument('job', type=int, help='id of the job.')
+    subparsers.add_parser('status', help='print the progress of all jobs.')
+    subparsers.add_parser('shutdown', help='stop the daemon, whatever is left to do.')
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,147 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import distributed_computing as dis_comp
+import array
+import mmap
+import os
+
+
+def make_task(line, result_path, task_type):
+    """ Create the task of a line of a tasks file, with its annotations.
+    """
+    (command, annotations) = dis_comp.parse_task_line(line)
+    inputs = tuple(annotations['inputs'].split(',')) if 'inputs' in annotations else ()
+    timeout = float(annotations['timeout']) if 'timeout' in annotations else None
+    cost = float(annotations['cost']) if 'cost' in annotations else None
+    after = tuple(annotations['after'].split(',')) if 'after' in annotations else ()
+    return dis_comp.Task(command, result_path, task_type, inputs, timeout, cost, annotations.get('id'), after)
+
+
+def make_invalid_task(line, result_path, task_type):
+    """ Create the task of a line whose annotations cannot be parsed, to be given up:
+    only known by its command and its label (for the tasks coming after it to be given up too).
+    """
+    (command, annotations) = dis_comp.parse_task_line(line)
+    return dis_comp.Task(command, result_path, task_type, label=annotations.get('id'))
+
+
+class LinesIndex:
+    """ The lines of a memory-mapped file,
+    indexed by their offsets (8 bytes per line) as they are needed.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # Empty files cannot be mapped.
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b''
+        # Offset of each line indexed, then of the next line to index.
+        self.starts = array.array('Q', [0])
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def index_lines(self, number):
+        """ Index up to number more lines.
+        return: False once the end of the file is reached.
+        """
+        find = self.data.find
+        append = self.starts.append
+        position = self.starts[-1]
+        for _ in range(number):
+            if position >= self.size:
+                return False
+            end = find(b'\n', position)
+            position = self.size if end < 0 else end + 1
+            append(position)
+        return position < self.size
+
+    def line(self, i):
+        return self.data[self.starts[i]:self.starts[i+1]].decode().strip()
+
+    def close(self):
+        if self.size > 0:
+            self.data.close()
+        self.file.close()
+
+
+class TasksFile:
+    """ The tasks of a tasks file (and of its results file), read lazily
+    so that tasks are given to clients as soon as the first lines are read,
+    whatever the size of the files.
+    It is used as the tasks list of a tasks manager, a task being created
+    from its line each time it is needed: only the offsets of the lines
+    are kept in memory.
+    """
+    def __init__(self, tasks_filepath, results_filepath=None, task_type=dis_comp.STD_OUT, block_size=10000):
+        self.commands = LinesIndex(tasks_filepath)
+        self.results = LinesIndex(results_filepath) if results_filepath is not None else None
+        self.task_type = task_type if results_filepath is not None else dis_comp.NO_OUT
+        self.block_size = block_size
+        # Number of tasks read so far.
+        self.length = 0
+        # Tasks whose annotations cannot be parsed: task_id -> reason (given up).
+        self.invalid = {}
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, task_id):
+        if not 0 <= task_id < self.length:
+            raise IndexError("task {} not read".format(task_id))
+        result_path = self.results.line(task_id) if self.results is not None else None
+        line = self.commands.line(task_id)
+        if task_id in self.invalid:
+            return make_invalid_task(line, result_path, self.task_type)
+        return make_task(line, result_path, self.task_type)
+
+    def read(self, tasks_manager):
+        """ Read the files block by block, adding their tasks to the tasks manager
+        as they come (to be run in a thread). The tasks whose annotations
+        cannot be parsed are given up. Whatever happens, the tasks manager
+        is told once no more task is added.
+        """
+        try:
+            more = True
+            while more:
+                more = self.commands.index_lines(self.block_size)
+                tasks_number = len(self.commands)
+                if self.results is not None:
+                    more = self.results.index_lines(self.block_size) or more
+                    tasks_number = min(tasks_number, len(self.results))
+                if tasks_number > self.length:
+                    added = tasks_number - self.length
+                    invalid = self.check_annotations(self.length, tasks_number)
+                    self.length = tasks_number
+                    tasks_manager.add_tasks(added, invalid)
+            if self.results is not None and len(self.results) != len(self.commands):
+                print("\nIgnoring the last lines of the longest file: {} tasks for {} results".format(
+                    len(self.commands), len(self.results)))
+        except Exception as err:
+            print("\nStopped reading the tasks after {} tasks: {}".format(self.length, err))
+        finally:
+            tasks_manager.end_tasks()
+
+    def check_annotations(self, start, end):
+        """ Find the tasks from start to end whose annotations cannot be parsed.
+        return: a dict task_id -> reason, also recorded into invalid.
+        """
+        invalid = {}
+        for task_id in range(start, end):
+            line = self.commands.line(task_id)
+            if '#dc:' in line:
+                try:
+                    make_task(line, None, self.task_type)
+                except ValueError as err:
+                    invalid[task_id] = "invalid annotations ({})".format(err)
+        self.invalid.update(invalid)
+        return invalid
+
+    def close(self):
+        self.commands.close()
+        if self.results is not None:
+            self.results.close()
@@ -0,0 +1,169 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import threading
+import bisect
+import heapq
+import array
+import json
+import time
+
+# Phases of a task, in order:
+# queue: waiting on the server to be given to a client,
+# send: sending it to the client (with the rest of its batch),
+# wait: waiting on the client for the previous tasks of the client,
+# execute: executing on the client (and sending the result,
+#   for clients not sending the header of results),
+# upload: receiving the result,
+# save: saving the result on the server (with the cache and the journal).
+PHASES = ('queue', 'send', 'wait', 'execute', 'upload', 'save')
+
+# Number of tasks and clients listed in the summary.
+SLOWEST_NUMBER = 10
+
+
+def percentile(sorted_values, q):
+    """ The value below which a fraction q of sorted values are (nearest rank).
+    """
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class Tracer:
+    """ Collects the times spent by tasks in each phase (see PHASES),
+    on each client, to summarize them at the end of a run
+    and export them to a trace file (if path is given):
+    JSON lines (one task per line) if path ends with .jsonl,
+    a Chrome trace otherwise (to open in chrome://tracing or Perfetto).
+    Only the durations of phases are kept in memory (8 bytes each),
+    besides the slowest tasks, traces are streamed to the file.
+    Times are given by time.monotonic().
+    """
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        # Time from which tasks were pending: by blocks of tasks added at once,
+        # and for tasks given back to be given again.
+        self.blocks_ids = array.array('Q')
+        self.blocks_times = array.array('d')
+        self.requeued_times = {}
+        self.durations = {phase: array.array('d') for phase in PHASES}
+        # The slowest tasks, in a heap: (duration, task_id, client, phases)
+        self.slowest = []
+        # Tasks done by client: name -> [number of tasks, total time executing, total time given]
+        self.clients = {}
+        self.file = None
+        self.chrome = False
+        if path is not None:
+            self.file = open(path, 'w')
+            self.chrome = not path.endswith('.jsonl')
+            if self.chrome:
+                # Chrome traces may be written as an array of events, one per line.
+                self.file.write('[{"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "server"}}')
+        # Thread of each client in a Chrome trace.
+        self.clients_threads = {}
+
+    def tasks_added(self, first_task_id, now):
+        """ Tasks from first_task_id on are pending from now.
+        Must be called in the order of the tasks.
+        """
+        self.blocks_ids.append(first_task_id)
+        self.blocks_times.append(now)
+
+    def requeued(self, task_id, now):
+        """ A task is pending again from now.
+        """
+        self.requeued_times[task_id] = now
+
+    def pending_since(self, task_id):
+        """ The time from which a task given was pending.
+        """
+        if task_id in self.requeued_times:
+            return self.requeued_times.pop(task_id)
+        return self.blocks_times[bisect.bisect_right(self.blocks_ids, task_id) - 1]
+
+    def record(self, task_id, client, status, phases):
+        """ Record the phases of a task given to a client
+        (phase -> (start, end)), which ended with a status (done or failed).
+        """
+        with self.lock:
+            if status == 'done':
+                for (phase, (start, end)) in phases.items():
+                    self.durations[phase].append(end - start)
+                given = phases['send'][0] if 'send' in phases else phases['queue'][1]
+                total = phases['save'][1] - given
+                execute = phases['execute'][1] - phases['execute'][0] if 'execute' in phases else 0.0
+                if len(self.slowest) < SLOWEST_NUMBER:
+                    heapq.heappush(self.slowest, (total, task_id, client, phases))
+                elif total > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, (total, task_id, client, phases))
+                if client is not None:
+                    stats = self.clients.setdefault(client, [0, 0.0, 0.0])
+                    stats[0] += 1
+                    stats[1] += execute
+                    stats[2] += total
+            if self.file is not None:
+                self.write(task_id, client, status, phases)
+
+    def write(self, task_id, client, status, phases):
+        """ Write the trace of a task to the trace file.
+        Must be called with the lock held.
+        """
+        if not self.chrome:
+            trace = {'task': task_id, 'client': client, 'status': status}
+            for phase in PHASES:
+                if phase in phases:
+                    (start, end) = phases[phase]
+                    trace[phase] = [round(start - self.start_time, 6), round(end - start, 6)]
+            self.file.write(json.dumps(trace) + '\n')
+            return
+        if client not in self.clients_threads:
+            self.clients_threads[client] = len(self.clients_threads) + 1
+            self.file.write(',\n' + json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                'tid': self.clients_threads[client], 'args': {'name': str(client)}}))
+        tid = self.clients_threads[client]
+        for phase in PHASES:
+            if phase in phases:
+                (start, end) = phases[phase]
+                self.file.write(',\n' + json.dumps({'name': phase, 'cat': status, 'ph': 'X', 'pid': 1, 'tid': tid,
+                    'ts': round((start - self.start_time) * 1e6), 'dur': round((end - start) * 1e6),
+                    'args': {'task': task_id}}))
+
+    def close(self):
+        if self.file is not None:
+            with self.lock:
+                if self.chrome:
+                    self.file.write('\n]\n')
+                self.file.close()
+                self.file = None
+
+    def summary(self, tasks_list=None):
+        """ A summary of the times spent by tasks: percentiles of each phase,
+        the slowest tasks (with their command if tasks_list is given)
+        and the slowest clients (by mean execution time).
+        """
+        with self.lock:
+            lines = ["Times of tasks (s):  {:>9} {:>9} {:>9} {:>9} {:>9}".format('p50', 'p90', 'p99', 'max', 'total')]
+            for phase in PHASES:
+                durations = sorted(self.durations[phase])
+                if durations:
+                    lines.append("  {:18} {:9.4f} {:9.4f} {:9.4f} {:9.4f} {:9.1f}".format(phase,
+                        percentile(durations, 0.5), percentile(durations, 0.9),
+                        percentile(durations, 0.99), durations[-1], sum(durations)))
+            if self.slowest:
+                lines.append("Slowest tasks (s):")
+                for (total, task_id, client, phases) in sorted(self.slowest, reverse=True):
+                    times = ', '.join('{} {:.3f}'.format(phase, phases[phase][1] - phases[phase][0])
+                        for phase in PHASES if phase in phases and phase != 'queue')
+                    command = ' ' + str(tasks_list[task_id].command) if tasks_list is not None else ''
+                    lines.append("  {:9.3f}  task {} on {} ({}){}".format(total, task_id, client, times, command))
+            if self.clients:
+                lines.append("Slowest clients (mean time executing a task, s):")
+                clients = sorted(self.clients.items(), key=lambda item: item[1][1] / item[1][0], reverse=True)
+                for (client, (tasks, execute, total)) in clients[:SLOWEST_NUMBER]:
+                    lines.append("  {:9.4f}  {} ({} tasks, {:.4f} s given per task)".format(
+                        execute / tasks, client, tasks, total / tasks))
+            return '\n'.join(lines)
@@ -5,9 +5,7 @@
 # pylint configuration
 # pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
 
-import sys
 import math
-import os
 
 # Some useful constants
 STYLE_GREEN   = '\033[32m'
@@ -16,35 +14,26 @@ STYLE_BOLD    = '\033[1m'
 STYLE_DEFAULT = '\033[0m'
 
 
-def get_terminal_size():
-    """ Returns (rows, columns)
-    where rows is the number of rows of the terminal window ...
+def progress_bar(length, total, done, working):
+    """ Returns a stylish colored progress bar of length characters
+    (plus the brackets) with the percentage of the process done.
     """
-    return tuple(map(int, os.popen('stty size', 'r').read().split()))
+    done_ratio         = done / total
+    working_ratio      = working / total
+    done_bar_number    = int(done_ratio * length)
+    working_bar_number = min(math.ceil(working_ratio * length), length - done_bar_number)
 
+    return '{bold}[{done_bars}{working_bars}{spaces}{bold}]{percentage} %'.format(**{
+        'bold':         STYLE_BOLD,
+        'done_bars':    STYLE_GREEN + '|' * done_bar_number,
+        'working_bars': STYLE_YELLOW + '|' * working_bar_number,
+        'spaces':       STYLE_DEFAULT + ' ' * (length - done_bar_number - working_bar_number),
+        'percentage':   STYLE_DEFAULT + ' {:6.2f}'.format(done_ratio * 100)})
 
-def print_progress(print_control, total, done, working):
-    """ Prints the progress of a process with a stylish colored progress bar.
+
+def format_duration(seconds):
+    """ Returns a duration as h:mm:ss.
     """
-    with print_control['lock']:
-        if not print_control['finished']:
-            rows, columns = get_terminal_size()
-            progress_bar_length = int(columns / 2)
-            done_ratio         = done / total
-            working_ratio      = working / total
-            done_bar_number    = int(done_ratio * progress_bar_length)
-            working_bar_number = math.ceil(working_ratio * progress_bar_length)
-
-            finished = (done == total)
-
-            sys.stderr.write('\r{bold}[{done_bars}{working_bars}{spaces}{bold}]{percentage} %'.format(**{
-                'bold':         STYLE_BOLD,
-                'default':      STYLE_DEFAULT,
-                'done_bars':    STYLE_GREEN + '|' * done_bar_number,
-                'working_bars': STYLE_YELLOW + '|' * working_bar_number,
-                'spaces':       STYLE_DEFAULT + ' ' * (progress_bar_length - done_bar_number - working_bar_number),
-                'percentage':   STYLE_DEFAULT + ' {:6.2f}'.format(done_ratio * 100 if not finished else 100)}))
-
-            if finished:
-                sys.stdout.write("\n")
-                print_control['finished'] = True
+    (minutes, seconds) = divmod(int(seconds), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# pylint configuration
+# pylint: disable=bad-whitespace, line-too-long, multiple-imports, multiple-statements
+
+import threading
+import time
+import zlib
+import lzma
+
+# zstd is only available with python >= 3.14 or the zstandard package.
+try:
+    from compression import zstd
+    zstd_compress = zstd.compress
+    zstd_decompress = zstd.decompress
+except ImportError:
+    try:
+        import zstandard
+        zstd_compress = zstandard.compress
+        zstd_decompress = zstandard.decompress
+    except ImportError:
+        zstd_compress = None
+
+# Compression codecs by name: (compress, decompress),
+# tuned to keep up with a gigabit link (except lzma, which compresses most).
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+    'lzma': (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+}
+if zstd_compress is not None:
+    CODECS['zstd'] = (zstd_compress, zstd_decompress)
+
+# Codec chosen by 'auto', the first one available.
+PREFERRED_CODECS = ['zstd', 'zlib']
+
+# Flag starting each chunk of a compressed stream.
+RAW = 0
+COMPRESSED = 1
+
+# A stream stops being compressed after this number of chunks in a row did not shrink.
+MAX_INCOMPRESSIBLE_CHUNKS = 2
+
+# CPU time of the current thread (of the process with python < 3.7).
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+
+def resolve(codec, available):
+    """ The codec to use among the available ones for a codec asked for
+    (a name, 'auto' or 'none').
+    return: its name, or None for no compression.
+    """
+    if codec == 'auto':
+        return next((name for name in PREFERRED_CODECS if name in available), None)
+    if codec in available:
+        return codec
+    # Every client knows zlib.
+    return 'zlib' if codec != 'none' and 'zlib' in available else None
+
+
+class CompressionStats:
+    """ Bytes of results before and after compression,
+    and CPU time spent compressing or decompressing them.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_time = 0.0
+
+    def add(self, raw_bytes, wire_bytes, cpu_time):
+        with self.lock:
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += wire_bytes
+            self.cpu_time += cpu_time
+
+    def report(self, action):
+        return "Compression: {:.1f} MB of results sent in {:.1f} MB ({:.1f} MB saved), {:.2f} s of CPU {}".format(
+            self.raw_bytes / 1e6, self.wire_bytes / 1e6, (self.raw_bytes - self.wire_bytes) / 1e6,
+            self.cpu_time, action)